@@ -0,0 +1,60 @@
+"""channel conversation slots
+
+Revision ID: 0f4dafbf7edf
+Revises: 7816a555e62a
+Create Date: 2026-10-18 20:39:29.450618
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0f4dafbf7edf'
+down_revision = '7816a555e62a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('channels', sa.Column('conversation_hour', sa.Integer(), server_default='9', nullable=False))
+    op.add_column('channels', sa.Column('timezone', sa.String(), server_default='UTC', nullable=False))
+
+    # all channels used to be paired on the same day, spread them across the weekday working hours in utc
+    op.execute(
+        """
+        UPDATE channels c
+        SET conversation_day = (s.n % 40) / 8, conversation_hour = 9 + s.n % 8
+        FROM (SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM channels) s
+        WHERE c.id = s.id
+        """
+    )
+    op.execute(
+        """
+        UPDATE channels c
+        SET next_pairing_on = CASE WHEN s.slot < s.due_after THEN s.slot + interval '1 week' ELSE s.slot END
+        FROM (
+            SELECT
+                id,
+                due_after,
+                date_trunc('week', due_after) + conversation_day * interval '1 day' + conversation_hour * interval '1 hour' AS slot
+            FROM (
+                SELECT
+                    id,
+                    conversation_day,
+                    conversation_hour,
+                    CASE
+                        WHEN last_sent_on IS NULL THEN date_trunc('hour', now() at time zone 'utc')
+                        ELSE last_sent_on + conversation_frequency_weeks * interval '1 week'
+                    END AS due_after
+                FROM channels
+            ) d
+        ) s
+        WHERE c.id = s.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('channels', 'timezone')
+    op.drop_column('channels', 'conversation_hour')
@@ -0,0 +1,52 @@
+"""composite indexes for member and conversation queries
+
+Revision ID: 1db7d883ee39
+Revises: 9497ffcc7e0a
+Create Date: 2026-10-18 20:26:33.254778
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1db7d883ee39'
+down_revision = '9497ffcc7e0a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # indexes are built and dropped concurrently so the tables stay writable, which can't run in a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channel_members_channel_team_opted', 'channel_members', ['channel_id', 'team_id', 'is_opted'], unique=False, postgresql_include=['member_id'], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_channel_team', 'channel_conversations', ['channel_id', 'team_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_partially_sent', 'channel_conversations', ['id'], unique=False, postgresql_where=sa.text("sent_on IS NULL AND (conversations ->> 'status') = 'PARTIALLY_SENT'"), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_midpoint_pending', 'channel_conversations', ['sent_on'], unique=False, postgresql_where=sa.text("(conversations -> 'midpoint_status') IS NULL"), postgresql_concurrently=True, if_not_exists=True)
+
+        # covered by the primary keys, the unique constraints or the composite indexes above
+        op.drop_index('ix_channel_conversations_channel_id', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_conversations_id', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_conversations_team_id', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_members_channel_id', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_members_id', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_members_team_id', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channels_channel_id', table_name='channels', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channels_id', table_name='channels', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channels_id', 'channels', ['id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channels_channel_id', 'channels', ['channel_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_members_team_id', 'channel_members', ['team_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_members_id', 'channel_members', ['id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_members_channel_id', 'channel_members', ['channel_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_team_id', 'channel_conversations', ['team_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_id', 'channel_conversations', ['id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_channel_id', 'channel_conversations', ['channel_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+        op.drop_index('ix_channel_conversations_midpoint_pending', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_conversations_partially_sent', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_conversations_channel_team', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_members_channel_team_opted', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
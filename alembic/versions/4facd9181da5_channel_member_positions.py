@@ -0,0 +1,79 @@
+"""channel member positions
+
+Revision ID: 4facd9181da5
+Revises: 260f13a0b22e
+Create Date: 2026-10-18 20:58:45.546486
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '4facd9181da5'
+down_revision = '260f13a0b22e'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 10000
+
+# members keep their place in the channel's circle, members missing from it go after in the order they were added
+BACKFILL_POSITIONS = """
+UPDATE channel_members m
+SET position = coalesce(array_position(c.members_circle, m.member_id)::bigint, 2147483647::bigint + m.id)
+FROM channels c
+WHERE c.channel_id = m.channel_id AND c.team_id = m.team_id
+    AND m.id > :after_id AND m.id <= :until_id AND m.position IS NULL
+"""
+
+# members of channels that are gone, if any, are put last
+BACKFILL_REMAINING_POSITIONS = "UPDATE channel_members SET position = 2147483647::bigint + id WHERE position IS NULL"
+
+# members added from now on go after everyone
+RESTART_POSITIONS = "SELECT setval('channel_members_position_seq', coalesce(max(position), 0) + 1, false) FROM channel_members"
+
+RESTORE_CIRCLES = """
+UPDATE channels c
+SET members_circle = members.member_ids
+FROM (
+    SELECT channel_id, team_id, array_agg(member_id ORDER BY position) AS member_ids
+    FROM channel_members
+    WHERE is_opted
+    GROUP BY channel_id, team_id
+) members
+WHERE c.channel_id = members.channel_id AND c.team_id = members.team_id
+"""
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence('channel_members_position_seq')))
+    op.add_column('channel_members', sa.Column('position', sa.BigInteger(), nullable=True))
+
+    # the backfill commits a batch of members at a time so that channel_members isn't locked for the whole update
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        max_id = conn.execute(sa.text("SELECT max(id) FROM channel_members")).scalar() or 0
+        for after_id in range(0, max_id, BACKFILL_BATCH_SIZE):
+            conn.execute(sa.text(BACKFILL_POSITIONS), {"after_id": after_id, "until_id": after_id + BACKFILL_BATCH_SIZE})
+
+    op.execute(BACKFILL_REMAINING_POSITIONS)
+    op.execute(RESTART_POSITIONS)
+    op.alter_column('channel_members', 'position', nullable=False, server_default=sa.text("nextval('channel_members_position_seq')"))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channel_members_channel_team_opted_position', 'channel_members', ['channel_id', 'team_id', 'is_opted', 'position'], unique=False, postgresql_include=['member_id'], postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_channel_members_channel_team_opted', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
+
+    op.drop_column('channels', 'members_circle')
+
+
+def downgrade() -> None:
+    op.add_column('channels', sa.Column('members_circle', postgresql.ARRAY(sa.VARCHAR()), autoincrement=False, nullable=True))
+    op.execute(RESTORE_CIRCLES)
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channel_members_channel_team_opted', 'channel_members', ['channel_id', 'team_id', 'is_opted'], unique=False, postgresql_include=['member_id'], postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_channel_members_channel_team_opted_position', table_name='channel_members', postgresql_concurrently=True, if_exists=True)
+
+    op.drop_column('channel_members', 'position')
+    op.execute(sa.schema.DropSequence(sa.Sequence('channel_members_position_seq')))
@@ -0,0 +1,104 @@
+"""conversation pairs
+
+Revision ID: 5d2d00aee2ad
+Revises: 1db7d883ee39
+Create Date: 2026-10-18 20:29:30.651367
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5d2d00aee2ad'
+down_revision = '1db7d883ee39'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+# copies the pairs of a range of conversations out of their json, skipping conversations already copied
+# so the backfill can be run again if it gets interrupted
+BACKFILL_PAIRS = """
+INSERT INTO conversation_pairs (conversation_id, channel_id, team_id, member_ids, status, dm_channel_id, intro_sent_on, midpoint_sent_on)
+SELECT
+    c.id,
+    c.channel_id,
+    c.team_id,
+    ARRAY(SELECT jsonb_array_elements_text(p.pair -> 'pair')),
+    coalesce(p.pair ->> 'status', 'GENERATED'),
+    p.pair ->> 'channel_id',
+    CASE WHEN p.pair ->> 'status' = 'INTRO_SENT' THEN coalesce(c.sent_on, c.created_on) END,
+    (p.pair ->> 'midpoint_sent_on')::timestamp
+FROM channel_conversations c
+CROSS JOIN LATERAL jsonb_array_elements(c.conversations -> 'pairs') WITH ORDINALITY AS p(pair, position)
+WHERE c.id > :after_id AND c.id <= :until_id
+    AND c.channel_id IS NOT NULL AND c.team_id IS NOT NULL
+    AND jsonb_typeof(c.conversations -> 'pairs') = 'array'
+    AND NOT EXISTS (SELECT 1 FROM conversation_pairs cp WHERE cp.conversation_id = c.id)
+ORDER BY c.id, p.position
+"""
+
+# writes the pairs back into the json of their conversation
+RESTORE_PAIRS = """
+UPDATE channel_conversations c
+SET conversations = c.conversations || jsonb_strip_nulls(jsonb_build_object(
+    'pairs', pairs.pairs,
+    'midpoint_status', CASE WHEN pairs.midpoint_sent THEN 'SENT' END
+))
+FROM (
+    SELECT
+        conversation_id,
+        jsonb_agg(
+            jsonb_strip_nulls(jsonb_build_object(
+                'status', status,
+                'pair', to_jsonb(member_ids),
+                'channel_id', dm_channel_id,
+                'midpoint_sent_on', midpoint_sent_on::date::text
+            ))
+            ORDER BY id
+        ) AS pairs,
+        bool_or(midpoint_sent_on IS NOT NULL) AS midpoint_sent
+    FROM conversation_pairs
+    GROUP BY conversation_id
+) pairs
+WHERE c.id = pairs.conversation_id
+"""
+
+
+def upgrade() -> None:
+    op.create_table('conversation_pairs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=False),
+    sa.Column('channel_id', sa.String(), nullable=False),
+    sa.Column('team_id', sa.String(), nullable=False),
+    sa.Column('member_ids', postgresql.ARRAY(sa.String()), nullable=False),
+    sa.Column('status', sa.String(), server_default='GENERATED', nullable=False),
+    sa.Column('dm_channel_id', sa.String(), nullable=True),
+    sa.Column('intro_sent_on', sa.DateTime(), nullable=True),
+    sa.Column('midpoint_sent_on', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['conversation_id'], ['channel_conversations.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_conversation_pairs_conversation_id', 'conversation_pairs', ['conversation_id'], unique=False)
+    op.create_index('ix_conversation_pairs_generated', 'conversation_pairs', ['conversation_id'], unique=False, postgresql_where=sa.text("status = 'GENERATED'"))
+    op.create_index('ix_conversation_pairs_midpoint_pending', 'conversation_pairs', ['intro_sent_on'], unique=False, postgresql_where=sa.text("status = 'INTRO_SENT' AND midpoint_sent_on IS NULL"))
+
+    # the backfill commits a batch of conversations at a time so that channel_conversations isn't locked
+    # for the whole copy, the json pairs are left in place for a downgrade
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        max_id = conn.execute(sa.text("SELECT max(id) FROM channel_conversations")).scalar() or 0
+        for after_id in range(0, max_id, BACKFILL_BATCH_SIZE):
+            conn.execute(sa.text(BACKFILL_PAIRS), {"after_id": after_id, "until_id": after_id + BACKFILL_BATCH_SIZE})
+
+        op.drop_index('ix_channel_conversations_midpoint_pending', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    op.execute(sa.text(RESTORE_PAIRS))
+    op.create_index('ix_channel_conversations_midpoint_pending', 'channel_conversations', ['sent_on'], unique=False, postgresql_where=sa.text("(conversations -> 'midpoint_status') IS NULL"))
+    op.drop_index('ix_conversation_pairs_midpoint_pending', table_name='conversation_pairs')
+    op.drop_index('ix_conversation_pairs_generated', table_name='conversation_pairs')
+    op.drop_index('ix_conversation_pairs_conversation_id', table_name='conversation_pairs')
+    op.drop_table('conversation_pairs')
@@ -0,0 +1,37 @@
+"""next pairing on
+
+Revision ID: 7816a555e62a
+Revises: 7c6be8488dea
+Create Date: 2026-10-18 20:36:48.321208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7816a555e62a'
+down_revision = '7c6be8488dea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # now() is stable, so existing rows take the default without the table being rewritten
+    op.add_column('channels', sa.Column('next_pairing_on', sa.DateTime(), server_default=sa.text("(now() at time zone 'utc')"), nullable=False))
+    op.execute(
+        """
+        UPDATE channels
+        SET next_pairing_on = last_sent_on + conversation_frequency_weeks * interval '1 week'
+        WHERE last_sent_on IS NOT NULL
+        """
+    )
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channels_next_pairing_on', 'channels', ['next_pairing_on'], unique=False, postgresql_where=sa.text('is_active = true'), postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_channels_next_pairing_on', table_name='channels', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('channels', 'next_pairing_on')
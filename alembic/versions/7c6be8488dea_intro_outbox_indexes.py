@@ -0,0 +1,34 @@
+"""intro outbox indexes
+
+Revision ID: 7c6be8488dea
+Revises: 5d2d00aee2ad
+Create Date: 2026-10-18 20:33:13.529177
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c6be8488dea'
+down_revision = '5d2d00aee2ad'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_channel_conversations_unsent', 'channel_conversations', ['created_on'], unique=False, postgresql_where=sa.text('sent_on IS NULL'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_conversation_pairs_unsent', 'conversation_pairs', ['conversation_id'], unique=False, postgresql_where=sa.text("status != 'INTRO_SENT'"), postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_channel_conversations_partially_sent', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_conversation_pairs_generated', table_name='conversation_pairs', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    # opening a group DM again returns the same one, so opened pairs can go back to being generated
+    op.execute("UPDATE conversation_pairs SET status = 'GENERATED' WHERE status = 'OPENED'")
+    with op.get_context().autocommit_block():
+        op.create_index('ix_conversation_pairs_generated', 'conversation_pairs', ['conversation_id'], unique=False, postgresql_where=sa.text("status = 'GENERATED'"), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_channel_conversations_partially_sent', 'channel_conversations', ['id'], unique=False, postgresql_where=sa.text("sent_on IS NULL AND (conversations ->> 'status') = 'PARTIALLY_SENT'"), postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_conversation_pairs_unsent', table_name='conversation_pairs', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_channel_conversations_unsent', table_name='channel_conversations', postgresql_concurrently=True, if_exists=True)
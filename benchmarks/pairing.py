@@ -0,0 +1,194 @@
+"""
+Simulate pairing channels of growing sizes over many rounds with member churn, and report
+the timing and fairness of the pairs. Exits with 1 when a metric crosses its threshold.
+
+Runs offline: the channel's member order and pair history are kept in memory the way
+the app keeps them in postgres, and no Slack call is made. The app's settings still have to
+be set in the environment since the pairing tasks are imported, nothing is connected to.
+
+    python -m benchmarks.pairing --sizes 2,3,5,10,101,1000,5000,50000 --group-sizes 2,3,4 --rounds 26
+
+Churn happens between rounds, as fractions of the channel: members join and are put last
+in the order, leave or opt out, and some of those who opted out opt back in.
+
+Metrics, for each channel and group size:
+    round ms       median and max time to group a round
+    peak KiB       memory allocated while grouping the last round
+    groups         mean number of groups, i.e. group DMs, per round
+    repeat rate    share of the pairs of members grouped together who had met within the history horizon
+    uneven         most rounds a single member spent in a group larger or smaller than the group size,
+                   against the share they'd get if those were spread evenly across the members seen
+"""
+import argparse
+import math
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from collections import Counter
+from datetime import date, timedelta
+
+import src.helpers as helpers
+
+from src.tasks.pairing import PAIR_HISTORY_HORIZON
+
+
+ROUND_PERIOD = timedelta(weeks=2)
+
+
+class SimulatedChannel:
+    def __init__(self, size: int, group_size: int, rng: random.Random):
+        self.rng = rng
+        self.group_size = group_size
+        self.rotation_round = 0
+        self.next_member = size
+        self.members = [f"U{i:06d}" for i in range(size)]
+        self.opted_out = []
+        self.last_met = {}
+
+    def group(self, today: date):
+        # the history of the channel as read by crud.get_pair_history
+        met_after = today - PAIR_HISTORY_HORIZON
+        last_met = {key: met_on for key, met_on in self.last_met.items() if met_on > met_after}
+
+        started_at = time.perf_counter()
+        groups = helpers.group_members(
+            self.members, self.group_size, self.rotation_round, last_met, today, PAIR_HISTORY_HORIZON.days
+        )
+        elapsed = time.perf_counter() - started_at
+        self.rotation_round += 1
+
+        return groups, last_met, elapsed
+
+    def record(self, groups, today: date):
+        for group in groups:
+            for i, member_a in enumerate(group):
+                for member_b in group[i + 1 :]:
+                    self.last_met[helpers.pair_key(member_a, member_b)] = today
+
+    def churn(self, args):
+        size = len(self.members)
+        leaving = set(self.rng.sample(self.members, self._count(size * (args.leave_rate + args.opt_out_rate))))
+        opting_out = set(self.rng.sample(sorted(leaving), self._count(len(leaving) * args.opt_out_share)))
+        self.members = [m for m in self.members if m not in leaving]
+        self.opted_out.extend(opting_out)
+
+        opting_in = self.rng.sample(self.opted_out, self._count(len(self.opted_out) * args.opt_in_rate))
+        joining = [f"U{self.next_member + i:06d}" for i in range(self._count(size * args.join_rate))]
+        self.next_member += len(joining)
+        self.members.extend(opting_in + joining)
+        opted_in = set(opting_in)
+        self.opted_out = [m for m in self.opted_out if m not in opted_in]
+
+    def _count(self, expected: float) -> int:
+        # rounds fractions up or down at random so small channels churn too
+        count = int(expected)
+        return count + (self.rng.random() < expected - count)
+
+
+def simulate(size: int, group_size: int, args) -> dict:
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    channel = SimulatedChannel(size, group_size, rng)
+    today = date(2024, 1, 1)
+    timings, uneven, seen = [], Counter(), set(channel.members)
+    group_count, pair_count, repeat_count, peak = 0, 0, 0, 0
+
+    for round_number in range(args.rounds):
+        last_round = round_number == args.rounds - 1
+        if last_round:
+            tracemalloc.start()
+        groups, last_met, elapsed = channel.group(today)
+        if last_round:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            timings.append(elapsed)
+
+        group_count += len(groups)
+        for group in groups:
+            for i, member_a in enumerate(group):
+                for member_b in group[i + 1 :]:
+                    pair_count += 1
+                    repeat_count += helpers.pair_key(member_a, member_b) in last_met
+            if len(group) != group_size:
+                uneven.update(group)
+
+        channel.record(groups, today)
+        channel.churn(args)
+        seen.update(channel.members)
+        today += ROUND_PERIOD
+
+    return {
+        "size": size,
+        "group_size": group_size,
+        "median_ms": statistics.median(timings or [0]) * 1000,
+        "max_ms": max(timings or [0]) * 1000,
+        "peak_kib": peak / 1024,
+        "groups": group_count / args.rounds,
+        "repeat_rate": repeat_count / pair_count if pair_count else 0,
+        "max_uneven": max(uneven.values(), default=0),
+        "expected_uneven": sum(uneven.values()) / len(seen),
+    }
+
+
+def check(result: dict, args) -> list:
+    failures = []
+    if result["max_ms"] > args.max_round_seconds * 1000:
+        failures.append(f"a round took {result['max_ms']:.0f}ms, over {args.max_round_seconds}s")
+
+    # repeats are only avoidable when there are enough members to meet new ones every round within the horizon
+    rounds_in_horizon = PAIR_HISTORY_HORIZON // ROUND_PERIOD
+    if result["size"] > 2 * rounds_in_horizon * result["group_size"] and result["repeat_rate"] > args.max_repeat_rate:
+        failures.append(f"repeat rate {result['repeat_rate']:.2%}, over {args.max_repeat_rate:.2%}")
+
+    # a member's uneven groups are roughly poisson distributed, allow a few deviations above the even share and
+    # a couple more for the churn shifting members back to where the uneven groups are
+    expected = result["expected_uneven"]
+    allowed = math.ceil(expected + args.uneven_deviations * math.sqrt(expected)) + 2
+    if result["max_uneven"] > allowed:
+        failures.append(f"a member was in {result['max_uneven']} uneven groups, over {allowed}")
+
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="2,3,5,10,101,1000,5000,50000", help="comma separated channel sizes")
+    parser.add_argument("--group-sizes", default="2,3,4", help="comma separated group sizes")
+    parser.add_argument("--rounds", type=int, default=26)
+    parser.add_argument("--join-rate", type=float, default=0.02, help="share of the channel joining each round")
+    parser.add_argument("--leave-rate", type=float, default=0.01, help="share of the channel leaving each round")
+    parser.add_argument("--opt-out-rate", type=float, default=0.01, help="share of the channel opting out each round")
+    parser.add_argument("--opt-in-rate", type=float, default=0.25, help="share of those opted out opting back in")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-round-seconds", type=float, default=1.0)
+    parser.add_argument("--max-repeat-rate", type=float, default=0.01)
+    parser.add_argument("--uneven-deviations", type=float, default=4.0)
+    args = parser.parse_args()
+    args.opt_out_share = args.opt_out_rate / ((args.leave_rate + args.opt_out_rate) or 1)
+
+    failed = False
+    print(
+        f"{'size':>8} {'group':>5} {'median ms':>10} {'max ms':>10} {'peak KiB':>10} {'groups':>9}"
+        f" {'repeats':>8} {'uneven':>12}"
+    )
+    for size in (int(s) for s in args.sizes.split(",")):
+        for group_size in (int(g) for g in args.group_sizes.split(",")):
+            result = simulate(size, group_size, args)
+            failures = check(result, args)
+            failed = failed or bool(failures)
+            print(
+                f"{result['size']:>8} {result['group_size']:>5} {result['median_ms']:>10.2f} {result['max_ms']:>10.2f}"
+                f" {result['peak_kib']:>10.0f} {result['groups']:>9.1f} {result['repeat_rate']:>8.2%}"
+                f" {result['max_uneven']:>4} / {result['expected_uneven']:<5.1f}"
+                + "".join(f"\n{'':>8} FAIL {failure}" for failure in failures)
+            )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Seed a large dataset and report the query plans and timings of the hot query shapes.
+
+Run it from the repository root against a scratch database, with and without the
+latest migration applied to compare:
+
+    python -m benchmarks.query_plans --channels 2000 --members 200 --conversations 50 --pairs 10
+
+The seeded rows all belong to teams prefixed with `bench_` and are deleted afterwards.
+"""
+import argparse
+import statistics
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select, text
+from sqlalchemy.dialects import postgresql
+
+from src.db import database, models
+
+
+SEED_QUERIES = [
+    """
+    INSERT INTO channels (team_id, channel_id, is_active, last_sent_on, conversation_frequency_weeks, send_midpoint_reminder, added_on, next_pairing_on)
+    SELECT 'bench_T' || (c % :teams), 'bench_C' || c, c % 5 <> 0, current_date - (c % 28), 2, true, now(), current_date - (c % 28) + 14
+    FROM generate_series(1, :channels) c
+    """,
+    """
+    INSERT INTO channel_members (channel_id, team_id, member_id, is_opted, added_on)
+    SELECT 'bench_C' || c, 'bench_T' || (c % :teams), 'U' || m, m % 10 <> 0, now()
+    FROM generate_series(1, :channels) c, generate_series(1, :members) m
+    """,
+    """
+    INSERT INTO channel_conversations (channel_id, team_id, conversations, created_on, sent_on)
+    SELECT
+        'bench_C' || c,
+        'bench_T' || (c % :teams),
+        jsonb_build_object(
+            'status', CASE WHEN (c + k) % 100 = 0 THEN 'PARTIALLY_SENT' ELSE 'INTRO_SENT' END,
+            'frequency', 2
+        ),
+        current_date - k * 14 + 8,
+        CASE WHEN (c + k) % 100 = 0 THEN NULL ELSE current_date - k * 14 + 8 END
+    FROM generate_series(1, :channels) c, generate_series(1, :conversations) k
+    """,
+    """
+    INSERT INTO conversation_pairs (conversation_id, channel_id, team_id, member_ids, status, dm_channel_id, intro_sent_on, midpoint_sent_on)
+    SELECT
+        c.id,
+        c.channel_id,
+        c.team_id,
+        ARRAY['U' || (2 * p), 'U' || (2 * p + 1)],
+        CASE WHEN c.sent_on IS NULL AND p % 2 = 0 THEN 'GENERATED' ELSE 'INTRO_SENT' END,
+        CASE WHEN c.sent_on IS NULL AND p % 2 = 0 THEN NULL ELSE 'D' || c.id || '_' || p END,
+        CASE WHEN c.sent_on IS NULL AND p % 2 = 0 THEN NULL ELSE c.created_on END,
+        CASE WHEN c.created_on < current_date - 8 THEN c.created_on + 8 END
+    FROM channel_conversations c, generate_series(1, :pairs) p
+    WHERE c.team_id LIKE 'bench\\_%'
+    """,
+]
+
+CLEANUP_QUERIES = [
+    "DELETE FROM conversation_pairs WHERE team_id LIKE 'bench\\_%'",
+    "DELETE FROM channel_conversations WHERE team_id LIKE 'bench\\_%'",
+    "DELETE FROM channel_members WHERE team_id LIKE 'bench\\_%'",
+    "DELETE FROM channels WHERE team_id LIKE 'bench\\_%'",
+]
+
+
+def query_shapes(conn, channels: int, teams: int):
+    channel_id, team_id = f"bench_C{channels // 2}", f"bench_T{(channels // 2) % teams}"
+    conversation_id = conn.execute(
+        text("SELECT min(id) FROM channel_conversations WHERE team_id LIKE 'bench\\_%' AND sent_on IS NULL")
+    ).scalar()
+    channels = models.Channels
+    members = models.ChannelMembers
+    conversations = models.ChannelConversations
+    pairs = models.ConversationPairs
+    midpoint_intros_sent_from = datetime.combine(datetime.utcnow().date() - timedelta(8), datetime.min.time())
+
+    return {
+        "channels due for pairing": select(channels.id)
+        .where(and_(channels.is_active == True, channels.next_pairing_on <= datetime.utcnow()))
+        .order_by(channels.next_pairing_on)
+        .limit(100)
+        .with_for_update(skip_locked=True),
+        "opted in member ids of a channel in rotation order": select(members.member_id)
+        .where(and_(members.channel_id == channel_id, members.team_id == team_id, members.is_opted == True))
+        .order_by(members.position),
+        "member of a channel": select(members).where(
+            and_(members.member_id == "U7", members.channel_id == channel_id, members.team_id == team_id)
+        ),
+        "unsent intros": select(conversations).where(
+            and_(conversations.sent_on == None, conversations.created_on >= datetime.utcnow().date() - timedelta(weeks=1))
+        ),
+        "pending midpoint reminders": select(pairs).where(
+            and_(
+                pairs.status == "INTRO_SENT",
+                pairs.midpoint_sent_on == None,
+                pairs.intro_sent_on >= midpoint_intros_sent_from,
+                pairs.intro_sent_on < midpoint_intros_sent_from + timedelta(days=1),
+            )
+        ),
+        "pairs left to retry": select(pairs).where(
+            and_(pairs.conversation_id == conversation_id, pairs.status != "INTRO_SENT")
+        ),
+        "conversations of a channel": select(conversations).where(
+            and_(conversations.channel_id == channel_id, conversations.team_id == team_id)
+        ),
+    }
+
+
+def compile_query(query):
+    compiled = query.compile(dialect=postgresql.psycopg2.dialect())
+    return str(compiled), compiled.params
+
+
+def seed(conn, args):
+    started_at = time.perf_counter()
+    for query in SEED_QUERIES:
+        conn.execute(
+            text(query),
+            {
+                "channels": args.channels,
+                "members": args.members,
+                "conversations": args.conversations,
+                "pairs": args.pairs,
+                "teams": args.teams,
+            },
+        )
+    conn.execute(text("VACUUM ANALYZE channels, channel_members, channel_conversations, conversation_pairs"))
+    print(f"seeded in {time.perf_counter() - started_at:.1f}s")
+
+
+def report(conn, args):
+    for name, query in query_shapes(conn, args.channels, args.teams).items():
+        sql, params = compile_query(query)
+        timings = []
+        for _ in range(args.repeat):
+            started_at = time.perf_counter()
+            conn.exec_driver_sql(sql, params).fetchall()
+            timings.append((time.perf_counter() - started_at) * 1000)
+
+        plan = conn.exec_driver_sql(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params).fetchall()
+        print(f"\n== {name}: median {statistics.median(timings):.2f}ms, max {max(timings):.2f}ms")
+        for (line,) in plan:
+            print(f"   {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=200, help="members per channel")
+    parser.add_argument("--conversations", type=int, default=50, help="conversations per channel")
+    parser.add_argument("--pairs", type=int, default=10, help="pairs per conversation")
+    parser.add_argument("--teams", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded rows")
+    args = parser.parse_args()
+
+    with database.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            seed(conn, args)
+            report(conn, args)
+        finally:
+            if not args.keep:
+                for query in CLEANUP_QUERIES:
+                    conn.execute(text(query))
+
+
+if __name__ == "__main__":
+    main()
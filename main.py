@@ -1,13 +1,17 @@
 
-from fastapi import FastAPI, Request
-from slack_bolt.adapter.fastapi import SlackRequestHandler
+import secrets
+import settings
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from slack_bolt.adapter.fastapi.async_handler import AsyncSlackRequestHandler
 
 from src.slack_app import app
+from src.tasks import monitoring
 
 
 api = FastAPI()
 
-app_handler = SlackRequestHandler(app)
+app_handler = AsyncSlackRequestHandler(app)
 
 
 @api.post("/slack/events")
@@ -24,3 +28,12 @@ async def install(req: Request):
 async def oauth_redirect(req: Request):
     return await app_handler.handle(req)
 
+
+@api.get("/metrics/queues")
+def queue_metrics(authorization: str = Header(None)):
+    # a sync route, fastapi runs it on its thread pool rather than on the event loop
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    if not settings.METRICS_TOKEN or not secrets.compare_digest((authorization or "").encode(), expected.encode()):
+        raise HTTPException(status_code=404)
+
+    return monitoring.get_queue_metrics()
@@ -10,6 +10,48 @@ SLACK_SIGNING_SECRET = os.environ["SLACK_SIGNING_SECRET"]
 DATABASE_URL = os.environ["DATABASE_URL"]
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# url of the asyncpg engine of the web process, to be set when DATABASE_URL has options asyncpg doesn't take, like sslmode
+ASYNC_DATABASE_URL = os.environ.get(
+    "ASYNC_DATABASE_URL", DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+)
 
 
 REDIS_URL = os.environ["REDIS_URL"]
+
+# number of times a slack api call rejected with a 429 is retried after waiting out its Retry-After
+SLACK_MAX_RETRIES = int(os.environ.get("SLACK_MAX_RETRIES", 5))
+
+# maximum slack api requests in flight at once per workspace on the async send path
+SLACK_MAX_CONCURRENT_REQUESTS = int(os.environ.get("SLACK_MAX_CONCURRENT_REQUESTS", 10))
+
+# size and expiry of the per process cache of slack installations and clients
+SLACK_CLIENT_CACHE_SIZE = int(os.environ.get("SLACK_CLIENT_CACHE_SIZE", 1000))
+SLACK_CLIENT_CACHE_TTL_SECONDS = int(os.environ.get("SLACK_CLIENT_CACHE_TTL_SECONDS", 300))
+
+# days after which the bot and deactivated users index of a workspace is rebuilt from users.list
+WORKSPACE_USERS_REFRESH_DAYS = int(os.environ.get("WORKSPACE_USERS_REFRESH_DAYS", 7))
+
+# sqlalchemy engine and connection pool, set per process type to size the pools of the web and worker processes
+DATABASE_ECHO = os.environ.get("DATABASE_ECHO", "false").lower() == "true"
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "true").lower() == "true"
+DATABASE_POOL_RECYCLE_SECONDS = int(os.environ.get("DATABASE_POOL_RECYCLE_SECONDS", 1800))
+# statements running longer than this are cancelled by postgres, 0 disables the timeout
+DATABASE_STATEMENT_TIMEOUT_MS = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS", 30000))
+# statements taking at least this long are logged with their duration, 0 disables the logging
+DATABASE_SLOW_QUERY_MS = int(os.environ.get("DATABASE_SLOW_QUERY_MS", 500))
+
+# seconds the member_joined_channel and member_left_channel events of a channel are buffered before they're applied at once
+MEMBER_EVENTS_FLUSH_SECONDS = int(os.environ.get("MEMBER_EVENTS_FLUSH_SECONDS", 10))
+
+# seconds the ids of handled slack events are kept to drop the retries of an event, slack retries for a few minutes
+SLACK_EVENT_DEDUP_SECONDS = int(os.environ.get("SLACK_EVENT_DEDUP_SECONDS", 60 * 60))
+
+# interactive and bulk tasks are spread over this many queues of each class by workspace, which workers take turns on
+CELERY_WORKSPACE_QUEUES = int(os.environ.get("CELERY_WORKSPACE_QUEUES", 8))
+# classes of queues the workers of a process consume, to run a separately sized pool per class
+CELERY_WORKER_QUEUE_CLASSES = os.environ.get("CELERY_WORKER_QUEUE_CLASSES", "interactive,bulk,scheduled").split(",")
+
+# bearer token the queue metrics are served with at /metrics/queues, they aren't served at all without one
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
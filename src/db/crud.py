@@ -1,11 +1,14 @@
-import random
 import src.helpers as helpers
 
-from typing import List
-from sqlalchemy import delete, and_, or_
+from collections import defaultdict
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from sqlalchemy import Integer, String, delete, select, update, func, literal, any_, and_, or_, true, tuple_
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from sqlalchemy.dialects.postgresql import insert
-from datetime import datetime, timedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from datetime import date, datetime, time, timedelta
 
 from . import models
 
@@ -23,45 +26,170 @@ def get_channel(db: Session, channel_id: str, team_id: str) -> models.Channels:
     )
 
 
-def get_channels_eligible_for_pairing(db: Session, limit: int = 10):
+def claim_channels_due_for_pairing(db: Session, limit: int, lease: timedelta) -> List[Row]:
+    """
+    Claim a batch of the active channels due for pairing by pushing their next pairing back by `lease`.
+
+    Rows locked by a concurrent claim are skipped rather than waited on, so schedulers can run side by
+    side without claiming the same channel. A claimed channel that isn't paired is due again once the
+    lease runs out.
+
+    Returns:
+        list: Rows of the primary key and the team ID of each claimed channel
+    """
+    now = datetime.utcnow()
+    due_channels = (
+        select(models.Channels.id)
+        .where(and_(models.Channels.is_active == True, models.Channels.next_pairing_on <= now))
+        .order_by(models.Channels.next_pairing_on)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    update_query = (
+        update(models.Channels)
+        .where(models.Channels.id.in_(due_channels))
+        .values(next_pairing_on=now + lease)
+        .returning(models.Channels.id, models.Channels.team_id)
+    )
+    channels = db.execute(update_query, execution_options={"synchronize_session": False}).all()
+    db.commit()
+
+    return channels
+
+
+def get_channel_if_eligible_for_pairing(db: Session, id: int) -> models.Channels:
     return (
         db.query(models.Channels)
-        .where(
-            and_(
-                models.Channels.is_active == True,
-                or_(
-                    models.Channels.last_sent_on == None,
-                    models.Channels.last_sent_on <= datetime.utcnow().date() - (models.Channels.conversation_frequency_weeks * timedelta(weeks=1))
-                ),
-            )
-        )
-        .limit(limit)
-        .all()
+        .where(and_(models.Channels.id == id, _eligible_for_pairing()))
+        .first()
     )
 
 
-def add_channel(db: Session, channel_id: str, team_id: str, enterprise_id: str):
+def set_channel_last_sent_on(db: Session, channel: models.Channels, last_sent_on: date):
+    channel.last_sent_on = last_sent_on
+    channel.next_pairing_on = _next_pairing_on(channel)
+    db.commit()
+
+
+def set_channel_active(db: Session, channel: models.Channels, is_active: bool):
+    """Enable or disable a channel, an enabled channel that's overdue is next paired in its first slot from now."""
+    channel.is_active = is_active
+    if is_active:
+        first_slot = helpers.next_conversation_time(
+            datetime.utcnow(), channel.conversation_day, channel.conversation_hour, channel.timezone
+        )
+        channel.next_pairing_on = max(_next_pairing_on(channel), first_slot)
+    db.commit()
+
+
+def set_channel_group_size(db: Session, channel: models.Channels, group_size: int):
+    channel.group_size = group_size
+    db.commit()
+
+
+def set_channel_schedule(db: Session, channel: models.Channels, day: int, hour: int, timezone: str):
+    channel.conversation_day = day
+    channel.conversation_hour = hour
+    channel.timezone = timezone
+    channel.next_pairing_on = _next_pairing_on(channel)
+    db.commit()
+
+
+def add_channel(db: Session, channel_id: str, team_id: str, enterprise_id: str, timezone: str = "UTC"):
+    day, hour = get_least_loaded_slot(db, timezone)
     channel = models.Channels(
         channel_id=channel_id,
         team_id=team_id,
         enterprise_id=enterprise_id,
         is_active=True,
+        conversation_day=day,
+        conversation_hour=hour,
+        timezone=timezone,
+        added_on=datetime.utcnow(),
     )
+    channel.next_pairing_on = _next_pairing_on(channel)
     db.add(channel)
     db.commit()
     db.refresh(channel)
     return channel
 
 
-def get_member(
-    db: Session, member_id: str, channel_id: str, team_id: str
-) -> models.ChannelMembers:
-    condition = [
-        models.ChannelMembers.member_id == member_id,
-        models.ChannelMembers.channel_id == channel_id,
-        models.ChannelMembers.team_id == team_id,
-    ]
-    return db.query(models.ChannelMembers).where(and_(*condition)).first()
+def get_weekly_pairing_load(db: Session) -> Dict[int, float]:
+    """
+    Return the average number of channels paired per week in each hour of the week, keyed by the
+    hour of the week in utc with 0 being monday midnight.
+    """
+    slots = (
+        db.query(
+            models.Channels.conversation_day,
+            models.Channels.conversation_hour,
+            models.Channels.timezone,
+            models.Channels.conversation_frequency_weeks,
+            func.count(),
+        )
+        .where(models.Channels.is_active == True)
+        .group_by(
+            models.Channels.conversation_day,
+            models.Channels.conversation_hour,
+            models.Channels.timezone,
+            models.Channels.conversation_frequency_weeks,
+        )
+    )
+    load = defaultdict(float)
+    for day, hour, timezone, frequency_weeks, count in slots:
+        load[helpers.utc_hour_of_week(day, hour, timezone)] += count / frequency_weeks
+
+    return load
+
+
+def get_least_loaded_slot(
+    db: Session, timezone: str, days: Iterable[int] = range(5), hours: Iterable[int] = range(9, 17)
+) -> Tuple[int, int]:
+    """
+    Pick the weekly slot, among the given days and hours in the timezone, with the fewest channels paired in it,
+    the earliest one on a tie.
+
+    Returns:
+        tuple: The day of the week and the hour of the slot in the timezone
+    """
+    load = get_weekly_pairing_load(db)
+    slots = [(day, hour) for day in days for hour in hours]
+    return min(slots, key=lambda slot: load[helpers.utc_hour_of_week(*slot, timezone)])
+
+
+def get_projected_pairing_load(db: Session, start: datetime, end: datetime) -> List[Row]:
+    """
+    Project the pairing work of each hour between `start` and `end` from when channels are next due.
+
+    Returns:
+        list: Rows of the hour, the number of channels due in it and their number of opted in members
+    """
+    members = (
+        select(
+            models.ChannelMembers.channel_id,
+            models.ChannelMembers.team_id,
+            func.count().label("count"),
+        )
+        .where(models.ChannelMembers.is_opted == True)
+        .group_by(models.ChannelMembers.channel_id, models.ChannelMembers.team_id)
+        .subquery()
+    )
+    hour = func.date_trunc("hour", models.Channels.next_pairing_on).label("hour")
+    query = (
+        select(hour, func.count().label("channels"), func.coalesce(func.sum(members.c.count), 0).label("members"))
+        .select_from(models.Channels)
+        .outerjoin(members, _channel_of(members.c))
+        .where(
+            and_(
+                models.Channels.is_active == True,
+                models.Channels.next_pairing_on >= start,
+                models.Channels.next_pairing_on < end,
+            )
+        )
+        .group_by(hour)
+        .order_by(hour)
+    )
+    return db.execute(query).all()
 
 
 def add_member_if_not_exists(
@@ -73,8 +201,6 @@ def add_member_if_not_exists(
         .on_conflict_do_nothing(index_elements=["member_id", "channel_id", "team_id"])
     )
     result = db.execute(insert_query)
-    if channel.members_circle and member_id not in channel.members_circle:
-        channel.members_circle.insert(1, member_id)
     db.commit()
 
     return result.rowcount
@@ -82,16 +208,51 @@ def add_member_if_not_exists(
 
 def delete_member(db: Session, member_id: str, channel_id: str, team_id: str):
     condition = [
+        models.ChannelMembers.member_id == member_id,
         models.ChannelMembers.channel_id == channel_id,
         models.ChannelMembers.team_id == team_id,
-        models.ChannelMembers.member_id == member_id,
     ]
-    channel = get_channel(db, channel_id, team_id)
-    if channel.members_circle and member_id in channel.members_circle:
-        channel.members_circle.remove(member_id)
-        channel.members_circle = _rotate_members_circle(channel.members_circle)
+    result = db.execute(delete(models.ChannelMembers).where(and_(*condition)))
+    _delete_members_pair_history(db, channel_id, team_id, [member_id])
+    db.commit()
+
+    return result.rowcount
+
+
+def add_members_if_not_exist(db: Session, member_ids: List[str], channel: models.Channels) -> List[str]:
+    """Insert the members missing from the channel in a single statement and return the ids of those added."""
+    if not member_ids:
+        return []
+
+    values = [
+        {"member_id": member_id, "channel_id": channel.channel_id, "team_id": channel.team_id}
+        for member_id in member_ids
+    ]
+    insert_query = (
+        insert(models.ChannelMembers)
+        .values(values)
+        .on_conflict_do_nothing(index_elements=["member_id", "channel_id", "team_id"])
+        .returning(models.ChannelMembers.member_id)
+    )
+    inserted = [m for (m,) in db.execute(insert_query)]
+    db.commit()
+
+    return inserted
+
+
+def delete_members(db: Session, member_ids: Set[str], channel: models.Channels) -> int:
+    """Delete the given members of the channel in a single statement."""
+    if not member_ids:
+        return 0
+
+    condition = [
+        models.ChannelMembers.channel_id == channel.channel_id,
+        models.ChannelMembers.team_id == channel.team_id,
+        models.ChannelMembers.member_id == any_(literal(list(member_ids), ARRAY(String))),
+    ]
     delete_query = delete(models.ChannelMembers).where(and_(*condition))
-    result = db.execute(delete_query)
+    result = db.execute(delete_query, execution_options={"synchronize_session": False})
+    _delete_members_pair_history(db, channel.channel_id, channel.team_id, list(member_ids))
     db.commit()
 
     return result.rowcount
@@ -112,49 +273,531 @@ def get_cached_channel_member_ids(
     return [m for (m,) in local_members]
 
 
-def save_channel_conversations(db: Session, channel, pairs):
-    conversation_pairs = []
-    for pair in pairs:
-        conversation_pair = {"status": "GENERATED", "pair": pair}
-        conversation_pairs.append(conversation_pair)
+def get_rotation_member_ids(db: Session, channel: models.Channels) -> List[str]:
+    """Return the ids of the opted in members of the channel in the order they rotate in."""
+    condition = [
+        models.ChannelMembers.channel_id == channel.channel_id,
+        models.ChannelMembers.team_id == channel.team_id,
+        models.ChannelMembers.is_opted == True,
+    ]
+    query = select(models.ChannelMembers.member_id).where(and_(*condition)).order_by(models.ChannelMembers.position)
+    return list(db.execute(query).scalars())
+
 
-    conversations = {"status": "GENERATED", "pairs": conversation_pairs, "frequency": channel.conversation_frequency_weeks}
+def save_channel_conversations(db: Session, channel, pairs):
+    """
+    Save a round of pairs of a channel and mark the channel as paired today in the same transaction,
+    so that a worker stopping in between can't leave the round saved and the channel due again.
+    """
+    paired_on = datetime.utcnow().date()
+    channel.last_sent_on = paired_on
+    channel.next_pairing_on = _next_pairing_on(channel)
+    conversations = {"status": "GENERATED", "frequency": channel.conversation_frequency_weeks}
     conversation = models.ChannelConversations(
         channel_id=channel.channel_id,
         team_id=channel.team_id,
         conversations=conversations,
     )
     db.add(conversation)
+    db.flush()
+    db.add_all(
+        models.ConversationPairs(
+            conversation_id=conversation.id,
+            channel_id=channel.channel_id,
+            team_id=channel.team_id,
+            member_ids=pair,
+        )
+        for pair in pairs
+    )
+    _record_pair_history(db, channel, pairs, paired_on)
     db.commit()
     db.refresh(conversation)
     return conversation
 
 
-def get_enterprise_id(db, team_id, channel_id):
+def get_pair_history(db: Session, channel: models.Channels, met_after: date) -> Dict[Tuple[str, str], date]:
+    """Return when each pair of members of the channel who met after `met_after` last met, keyed by helpers.pair_key."""
+    history = models.PairHistory
+    condition = [
+        history.channel_id == channel.channel_id,
+        history.team_id == channel.team_id,
+        history.last_met_on > met_after,
+    ]
+    query = select(history.member_a, history.member_b, history.last_met_on).where(and_(*condition))
+    return {(member_a, member_b): met_on for member_a, member_b, met_on in db.execute(query)}
+
+
+def delete_pair_history(db: Session, met_before: date) -> int:
+    """Delete the history of the pairs who last met before `met_before`, which pairing doesn't look at anymore."""
+    delete_query = delete(models.PairHistory).where(models.PairHistory.last_met_on < met_before)
+    result = db.execute(delete_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+    return result.rowcount
+
+
+def get_conversation_pairs(db: Session, conversation_id: int) -> List[models.ConversationPairs]:
     return (
-        db.query(models.Channels.enterprise_id)
+        db.query(models.ConversationPairs)
+        .where(models.ConversationPairs.conversation_id == conversation_id)
+        .order_by(models.ConversationPairs.id)
+        .all()
+    )
+
+
+def get_unsent_pairs(db: Session, conversation_ids: List[int]) -> List[models.ConversationPairs]:
+    condition = [
+        models.ConversationPairs.conversation_id == any_(literal(conversation_ids, ARRAY(Integer))),
+        models.ConversationPairs.status != "INTRO_SENT",
+    ]
+    return db.query(models.ConversationPairs).where(and_(*condition)).order_by(models.ConversationPairs.id).all()
+
+
+def iter_unsent_conversations(db: Session, created_after: date, page_size: int = 100) -> Iterator[List[Row]]:
+    """
+    Page through the conversations created since `created_after` that still have intros to send.
+
+    Yields:
+        list: Rows of the conversation id, channel id, team id, channel primary key and enterprise id,
+            all from the same workspace
+    """
+    conversations = models.ChannelConversations
+    query = (
+        select(
+            conversations.id,
+            conversations.channel_id,
+            conversations.team_id,
+            models.Channels.id.label("channel_pk"),
+            models.Channels.enterprise_id,
+        )
+        .join(models.Channels, _channel_of(conversations))
+        .where(and_(conversations.sent_on == None, conversations.created_on >= created_after))
+    )
+    return _iter_workspace_pages(db, query, conversations.team_id, conversations.id, page_size)
+
+
+def iter_pairs_pending_midpoint_reminder(db: Session, intro_sent_on: date, page_size: int = 100) -> Iterator[List[Row]]:
+    """
+    Page through the pairs introduced on the given day that haven't had their midpoint reminder yet.
+
+    Yields:
+        list: Rows of the pair id, DM channel id, team id and enterprise id, all from the same workspace
+    """
+    pairs = models.ConversationPairs
+    intros_sent_from = datetime.combine(intro_sent_on, time.min)
+    query = (
+        select(pairs.id, pairs.dm_channel_id, pairs.team_id, models.Channels.enterprise_id)
+        .join(models.Channels, _channel_of(pairs))
         .where(
             and_(
-                models.Channels.team_id == team_id,
-                models.Channels.channel_id == channel_id,
+                pairs.status == "INTRO_SENT",
+                pairs.midpoint_sent_on == None,
+                pairs.intro_sent_on >= intros_sent_from,
+                pairs.intro_sent_on < intros_sent_from + timedelta(days=1),
             )
         )
+    )
+    return _iter_workspace_pages(db, query, pairs.team_id, pairs.id, page_size)
+
+
+def mark_pair_opened(db: Session, pair_id: int, dm_channel_id: str):
+    update_query = (
+        update(models.ConversationPairs)
+        .where(and_(models.ConversationPairs.id == pair_id, models.ConversationPairs.status == "GENERATED"))
+        .values(status="OPENED", dm_channel_id=dm_channel_id)
+    )
+    db.execute(update_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+
+def mark_pair_intro_sent(db: Session, pair_id: int):
+    update_query = (
+        update(models.ConversationPairs)
+        .where(and_(models.ConversationPairs.id == pair_id, models.ConversationPairs.status == "OPENED"))
+        .values(status="INTRO_SENT", intro_sent_on=datetime.utcnow())
+    )
+    db.execute(update_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+
+def mark_pair_midpoint_sent(db: Session, pair_id: int):
+    update_query = (
+        update(models.ConversationPairs)
+        .where(models.ConversationPairs.id == pair_id)
+        .values(midpoint_sent_on=datetime.utcnow())
+    )
+    db.execute(update_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+
+def finish_conversation_intros(db: Session, conversation_ids: List[int]) -> Set[int]:
+    """
+    Mark the conversations none of whose pairs are waiting on their intro as sent, the others as partially sent.
+
+    Returns:
+        set: The ids of the conversations whose intros have all been sent
+    """
+    conversations = models.ChannelConversations
+    unsent_pairs = select(models.ConversationPairs.id).where(
+        and_(
+            models.ConversationPairs.conversation_id == conversations.id,
+            models.ConversationPairs.status != "INTRO_SENT",
+        )
+    )
+    condition = [
+        conversations.id == any_(literal(conversation_ids, ARRAY(Integer))),
+        conversations.sent_on == None,
+    ]
+
+    sent_query = (
+        update(conversations)
+        .where(and_(*condition, ~unsent_pairs.exists()))
+        .values(conversations=_with_status("INTRO_SENT"), sent_on=datetime.utcnow().date())
+        .returning(conversations.id)
+    )
+    sent = {c for (c,) in db.execute(sent_query, execution_options={"synchronize_session": False})}
+    partially_sent_query = (
+        update(conversations)
+        .where(and_(*condition, unsent_pairs.exists()))
+        .values(conversations=_with_status("PARTIALLY_SENT"))
+    )
+    db.execute(partially_sent_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+    return sent
+
+
+def get_or_start_member_sync(db: Session, channel_id: str, team_id: str) -> models.ChannelMemberSyncs:
+    insert_query = (
+        insert(models.ChannelMemberSyncs)
+        .values(channel_id=channel_id, team_id=team_id, started_on=datetime.utcnow(), updated_on=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=["channel_id", "team_id"])
+    )
+    db.execute(insert_query)
+    db.commit()
+    condition = [
+        models.ChannelMemberSyncs.channel_id == channel_id,
+        models.ChannelMemberSyncs.team_id == team_id,
+    ]
+    return db.query(models.ChannelMemberSyncs).where(and_(*condition)).first()
+
+
+def save_member_sync_progress(
+    db: Session, sync: models.ChannelMemberSyncs, member_ids: List[str], cursor: str, lease_token: int = None
+) -> bool:
+    """
+    Save the cursor and the members seen by a sync, under the fencing token of the lease it runs under.
+
+    Returns:
+        bool: False if the sync was saved under a later lease since, and nothing was saved
+    """
+    syncs = models.ChannelMemberSyncs
+    update_query = (
+        update(syncs)
+        .where(and_(syncs.id == sync.id, _fenced(syncs, lease_token)))
+        .values(
+            cursor=cursor,
+            seen_member_ids=func.array_cat(syncs.seen_member_ids, literal(member_ids, ARRAY(String))),
+            updated_on=datetime.utcnow(),
+            lease_token=func.coalesce(lease_token, syncs.lease_token),
+        )
+    )
+    result = db.execute(update_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+    return result.rowcount > 0
+
+
+def delete_member_sync(db: Session, sync: models.ChannelMemberSyncs, lease_token: int = None) -> bool:
+    """Delete the checkpoint of a sync, returns False if it was saved under a later lease and was kept."""
+    syncs = models.ChannelMemberSyncs
+    delete_query = delete(syncs).where(and_(syncs.id == sync.id, _fenced(syncs, lease_token)))
+    result = db.execute(delete_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+    return result.rowcount > 0
+
+
+def save_workspace_users(db: Session, team_id: str, users: List[dict], synced_on: datetime = None):
+    if not users:
+        return
+
+    db.execute(_upsert_workspace_users(team_id, users, synced_on))
+    db.commit()
+
+
+async def async_save_workspace_users(db: AsyncSession, team_id: str, users: List[dict]):
+    if not users:
+        return
+
+    await db.execute(_upsert_workspace_users(team_id, users))
+    await db.commit()
+
+
+def get_workspace_user(db: Session, team_id: str, user_id: str) -> models.WorkspaceUsers:
+    condition = [
+        models.WorkspaceUsers.team_id == team_id,
+        models.WorkspaceUsers.user_id == user_id,
+    ]
+    return db.query(models.WorkspaceUsers).where(and_(*condition)).first()
+
+
+def get_workspace_users(db: Session, team_id: str, user_ids: List[str]) -> List[models.WorkspaceUsers]:
+    condition = [
+        models.WorkspaceUsers.team_id == team_id,
+        models.WorkspaceUsers.user_id == any_(literal(list(user_ids), ARRAY(String))),
+    ]
+    return db.query(models.WorkspaceUsers).where(and_(*condition)).all()
+
+
+def get_workspace_users_synced_on(db: Session, team_id: str) -> datetime:
+    return (
+        db.query(func.max(models.WorkspaceUsers.synced_on))
+        .where(models.WorkspaceUsers.team_id == team_id)
+        .scalar()
+    )
+
+
+def get_excluded_user_ids(db: Session, team_id: str) -> Set[str]:
+    condition = [
+        models.WorkspaceUsers.team_id == team_id,
+        or_(models.WorkspaceUsers.is_bot == True, models.WorkspaceUsers.is_deleted == True),
+    ]
+    users = db.query(models.WorkspaceUsers.user_id).where(and_(*condition)).all()
+    return {u for (u,) in users}
+
+
+def start_reconciliation_run(db: Session) -> List[int]:
+    """Create a reconciliation run with a shard per workspace that has channels and return the shard ids."""
+    run = models.ReconciliationRuns(started_on=datetime.utcnow())
+    db.add(run)
+    db.flush()
+    workspaces = db.query(models.Channels.team_id, func.max(models.Channels.enterprise_id)).group_by(
+        models.Channels.team_id
+    )
+    shards = [
+        models.ReconciliationShards(run_id=run.id, team_id=team_id, enterprise_id=enterprise_id)
+        for (team_id, enterprise_id) in workspaces
+    ]
+    db.add_all(shards)
+    db.commit()
+
+    return [shard.id for shard in shards]
+
+
+def get_reconciliation_shard(db: Session, id: int) -> models.ReconciliationShards:
+    return db.query(models.ReconciliationShards).where(models.ReconciliationShards.id == id).first()
+
+
+def get_workspace_channels(db: Session, team_id: str, after_id: int = None) -> List[models.Channels]:
+    condition = [models.Channels.team_id == team_id]
+    if after_id is not None:
+        condition.append(models.Channels.id > after_id)
+    return db.query(models.Channels).where(and_(*condition)).order_by(models.Channels.id).all()
+
+
+def save_reconciliation_progress(
+    db: Session,
+    shard: models.ReconciliationShards,
+    channel_id: int,
+    members_removed: int,
+    failed: bool = False,
+    lease_token: int = None,
+) -> bool:
+    """
+    Save the last channel reconciled by a shard and add to its counts, under the fencing token of its lease.
+
+    Returns:
+        bool: False if the shard was saved under a later lease since, and nothing was saved
+    """
+    shards = models.ReconciliationShards
+    update_query = (
+        update(shards)
+        .where(and_(shards.id == shard.id, _fenced(shards, lease_token)))
+        .values(
+            last_channel_id=channel_id,
+            channels_failed=shards.channels_failed + int(failed),
+            channels_reconciled=shards.channels_reconciled + int(not failed),
+            members_removed=shards.members_removed + members_removed,
+            lease_token=func.coalesce(lease_token, shards.lease_token),
+        )
+    )
+    result = db.execute(update_query, execution_options={"synchronize_session": False})
+    db.commit()
+
+    return result.rowcount > 0
+
+
+def finish_reconciliation_shard(
+    db: Session, shard: models.ReconciliationShards, lease_token: int = None
+) -> models.ReconciliationRuns:
+    """
+    Mark a shard as finished, the last shard of the run to finish also closes the run with its totals.
+    A shard saved under a later lease since is left to that lease's holder to finish.
+
+    Returns:
+        The run if it was finished by this shard, None otherwise
+    """
+    shards = models.ReconciliationShards
+    update_query = (
+        update(shards)
+        .where(and_(shards.id == shard.id, _fenced(shards, lease_token)))
+        .values(finished_on=datetime.utcnow())
+    )
+    if db.execute(update_query, execution_options={"synchronize_session": False}).rowcount == 0:
+        db.commit()
+        return None
+    db.commit()
+
+    pending_shards = select(shards.id).where(and_(shards.run_id == shard.run_id, shards.finished_on == None))
+    update_query = (
+        update(models.ReconciliationRuns)
+        .where(
+            and_(
+                models.ReconciliationRuns.id == shard.run_id,
+                models.ReconciliationRuns.finished_on == None,
+                ~pending_shards.exists(),
+            )
+        )
+        .values(finished_on=datetime.utcnow())
+        .returning(models.ReconciliationRuns.id)
+    )
+    finished = db.execute(update_query, execution_options={"synchronize_session": False}).first()
+    if finished is None:
+        db.commit()
+        return None
+
+    run = db.query(models.ReconciliationRuns).where(models.ReconciliationRuns.id == shard.run_id).first()
+    (run.channels_reconciled, run.channels_failed, run.members_removed) = (
+        db.query(
+            func.coalesce(func.sum(shards.channels_reconciled), 0),
+            func.coalesce(func.sum(shards.channels_failed), 0),
+            func.coalesce(func.sum(shards.members_removed), 0),
+        )
+        .where(shards.run_id == shard.run_id)
         .first()
-    )[0]
+    )
+    db.commit()
+
+    return run
+
+
+def _iter_workspace_pages(db: Session, query, team_id_column, id_column, page_size: int) -> Iterator[List[Row]]:
+    """
+    Run the query a page at a time in order of workspace, paging on (team id, id) rather than offsets,
+    and yield each page split up by workspace. The transaction is ended after every page so that
+    nothing is held while the caller works through it.
+    """
+    last_key = None
+    while True:
+        page_query = query
+        if last_key is not None:
+            page_query = page_query.where(tuple_(team_id_column, id_column) > tuple_(*last_key))
+        rows = db.execute(page_query.order_by(team_id_column, id_column).limit(page_size)).all()
+        db.commit()
+
+        for _, workspace_rows in groupby(rows, key=lambda row: row.team_id):
+            yield list(workspace_rows)
+
+        if len(rows) < page_size:
+            return
+        last_key = (rows[-1].team_id, rows[-1].id)
+
+
+def _upsert_workspace_users(team_id: str, users: List[dict], synced_on: datetime = None):
+    values = [
+        {
+            "team_id": team_id,
+            "user_id": user["id"],
+            "is_bot": helpers.is_bot_user(user),
+            "is_deleted": user.get("deleted", False),
+            "updated_on": datetime.utcnow(),
+            "synced_on": synced_on,
+        }
+        for user in users
+    ]
+    insert_query = insert(models.WorkspaceUsers).values(values)
+    update_columns = ["is_bot", "is_deleted", "updated_on"] + (["synced_on"] if synced_on else [])
+    return insert_query.on_conflict_do_update(
+        index_elements=["team_id", "user_id"],
+        set_={column: insert_query.excluded[column] for column in update_columns},
+    )
+
+
+def _record_pair_history(db: Session, channel: models.Channels, pairs: List[List[str]], met_on: date):
+    values = {
+        helpers.pair_key(member_a, member_b)
+        for pair in pairs
+        for i, member_a in enumerate(pair)
+        for member_b in pair[i + 1 :]
+    }
+    if not values:
+        return
+
+    history = models.PairHistory
+    insert_query = insert(history).values(
+        [
+            {
+                "channel_id": channel.channel_id,
+                "team_id": channel.team_id,
+                "member_a": member_a,
+                "member_b": member_b,
+                "last_met_on": met_on,
+            }
+            for member_a, member_b in sorted(values)
+        ]
+    )
+    insert_query = insert_query.on_conflict_do_update(
+        index_elements=["channel_id", "team_id", "member_a", "member_b"],
+        set_={"last_met_on": insert_query.excluded.last_met_on, "times_met": history.times_met + 1},
+    )
+    db.execute(insert_query)
+
+
+def _delete_members_pair_history(db: Session, channel_id: str, team_id: str, member_ids: List[str]):
+    history = models.PairHistory
+    members = literal(member_ids, ARRAY(String))
+    condition = [
+        history.channel_id == channel_id,
+        history.team_id == team_id,
+        or_(history.member_a == any_(members), history.member_b == any_(members)),
+    ]
+    db.execute(delete(history).where(and_(*condition)), execution_options={"synchronize_session": False})
+
 
+def _fenced(model, lease_token: int):
+    # rows saved under a lease only take writes from the same or a later lease, writes outside of a lease aren't fenced
+    if lease_token is None:
+        return true()
+    return or_(model.lease_token == None, model.lease_token <= lease_token)
 
-def _rotate_members_circle(members):
-    count = len(members)
-    excluded_member = ""
-    if count % 2 != 0:
-        random_member_to_remove = random.randrange(count)
-        excluded_member = members[random_member_to_remove]
-        del members[random_member_to_remove]
 
-    _, members_circle = helpers.round_robin_match(members)
+def _next_pairing_on(channel: models.Channels) -> datetime:
+    if channel.last_sent_on is None:
+        due_after = channel.added_on or datetime.utcnow()
+    else:
+        due_after = datetime.combine(
+            channel.last_sent_on + timedelta(weeks=channel.conversation_frequency_weeks), time.min
+        )
+    return helpers.next_conversation_time(
+        due_after, channel.conversation_day, channel.conversation_hour, channel.timezone
+    )
+
+
+def _with_status(status: str):
+    return models.ChannelConversations.conversations.op("||")(func.jsonb_build_object("status", status))
 
-    if excluded_member:
-        members_circle.insert(1, excluded_member)
 
-    return members_circle
+def _channel_of(model):
+    return and_(models.Channels.channel_id == model.channel_id, models.Channels.team_id == model.team_id)
+
+
+def _eligible_for_pairing():
+    return and_(
+        models.Channels.is_active == True,
+        or_(
+            models.Channels.last_sent_on == None,
+            models.Channels.last_sent_on <= datetime.utcnow().date() - (models.Channels.conversation_frequency_weeks * timedelta(weeks=1))
+        ),
+    )
     
\ No newline at end of file
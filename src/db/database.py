@@ -1,21 +1,76 @@
 import settings
 import logging
+import time
+import redis
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from redis import asyncio as aioredis
 
 
-from slack_sdk.oauth.installation_store.sqlalchemy import SQLAlchemyInstallationStore
-from slack_sdk.oauth.state_store.sqlalchemy import SQLAlchemyOAuthStateStore
+from slack_sdk.oauth.installation_store.sqlalchemy import (
+    AsyncSQLAlchemyInstallationStore,
+    SQLAlchemyInstallationStore,
+)
+from slack_sdk.oauth.state_store.sqlalchemy import AsyncSQLAlchemyOAuthStateStore, SQLAlchemyOAuthStateStore
 
 
 logger = logging.getLogger(__name__)
 
 
-engine = create_engine(settings.DATABASE_URL, echo=True)
+connect_args = {}
+if settings.DATABASE_STATEMENT_TIMEOUT_MS > 0:
+    connect_args["options"] = f"-c statement_timeout={settings.DATABASE_STATEMENT_TIMEOUT_MS}"
+
+engine = create_engine(
+    settings.DATABASE_URL,
+    echo=settings.DATABASE_ECHO,
+    pool_size=settings.DATABASE_POOL_SIZE,
+    max_overflow=settings.DATABASE_MAX_OVERFLOW,
+    pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE_SECONDS,
+    connect_args=connect_args,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the web process handles slack requests on its event loop, with the same pool settings over asyncpg
+async_connect_args = {}
+if settings.DATABASE_STATEMENT_TIMEOUT_MS > 0:
+    async_connect_args["server_settings"] = {"statement_timeout": str(settings.DATABASE_STATEMENT_TIMEOUT_MS)}
+
+async_engine = create_async_engine(
+    settings.ASYNC_DATABASE_URL,
+    echo=settings.DATABASE_ECHO,
+    pool_size=settings.DATABASE_POOL_SIZE,
+    max_overflow=settings.DATABASE_MAX_OVERFLOW,
+    pool_pre_ping=settings.DATABASE_POOL_PRE_PING,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE_SECONDS,
+    connect_args=async_connect_args,
+)
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# state shared by the web and worker processes that doesn't need to outlive a redeploy, on the celery broker's redis
+redis_client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+async_redis_client = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_started_at = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - context._query_started_at) * 1000
+    if 0 < settings.DATABASE_SLOW_QUERY_MS <= duration_ms:
+        logger.warning(
+            "slow query", extra={"duration_ms": round(duration_ms, 1), "statement": statement}
+        )
+
 
 installation_store = SQLAlchemyInstallationStore(
     client_id=settings.SLACK_CLIENT_ID,
@@ -27,6 +82,16 @@ oauth_state_store = SQLAlchemyOAuthStateStore(
     engine=engine,
     logger=logger,
 )
+async_installation_store = AsyncSQLAlchemyInstallationStore(
+    client_id=settings.SLACK_CLIENT_ID,
+    engine=async_engine,
+    logger=logger,
+)
+async_oauth_state_store = AsyncSQLAlchemyOAuthStateStore(
+    expiration_seconds=120,
+    engine=async_engine,
+    logger=logger,
+)
 
 Base = declarative_base()
 
@@ -0,0 +1,189 @@
+import functools
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Callable, Optional
+
+from .database import redis_client
+
+
+logger = logging.getLogger(__name__)
+
+# the fencing tokens of all leases come from a single counter, a lease taken later always has a larger token
+FENCING_TOKEN_KEY = "lease_fencing_token"
+# how long a lease outlives its last renewal, i.e. how long the work of a dead worker stays blocked
+DEFAULT_LEASE_TTL = timedelta(minutes=1)
+
+_acquire_script = redis_client.register_script(
+    """
+    if redis.call('exists', KEYS[1]) == 1 then
+        return 0
+    end
+    local token = redis.call('incr', KEYS[2])
+    redis.call('set', KEYS[1], token, 'px', ARGV[1])
+    return token
+    """
+)
+_renew_script = redis_client.register_script(
+    """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+)
+_release_script = redis_client.register_script(
+    """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+)
+
+_current_lease = ContextVar("current_lease", default=None)
+
+
+class LeaseLost(Exception):
+    """Raised when the holder of a lease finds out that it expired or was taken over."""
+
+
+class Lease:
+    """
+    A lease on a named piece of work held in redis, renewed by a background thread until it's released.
+
+    The lease expires on its own `ttl` after its last renewal, so a worker that dies doesn't block the
+    work for longer than that. Every acquisition gets a fencing token larger than any before it, and
+    only the holder of the current token can renew or release the lease. Writes the lease guards are
+    saved with the token and rejected once a later token was saved, see `ensure_fenced`.
+    """
+
+    def __init__(self, name: str, ttl: timedelta = DEFAULT_LEASE_TTL):
+        self.name = name
+        self.key = f"lease:{name}"
+        self.ttl_ms = int(ttl.total_seconds() * 1000)
+        self.token = None
+        self._expires_at = 0.0
+        self._stopped = threading.Event()
+        self._renewer = None
+
+    def acquire(self) -> bool:
+        """Take the lease without blocking, returns whether it was taken."""
+        started_at = time.monotonic()
+        token = _acquire_script(keys=[self.key, FENCING_TOKEN_KEY], args=[self.ttl_ms])
+        if not token:
+            return False
+
+        self.token = int(token)
+        self._expires_at = started_at + self.ttl_ms / 1000
+        self._renewer = threading.Thread(target=self._keep_renewed, name=f"lease-{self.name}", daemon=True)
+        self._renewer.start()
+        return True
+
+    def renew(self) -> bool:
+        """Push back the expiry of the lease, returns False if the lease isn't held with this token anymore."""
+        started_at = time.monotonic()
+        if not _renew_script(keys=[self.key], args=[self.token, self.ttl_ms]):
+            self._expires_at = 0.0
+            return False
+
+        self._expires_at = started_at + self.ttl_ms / 1000
+        return True
+
+    def ensure_held(self):
+        """Raise LeaseLost unless the lease is still held with this token, to check before doing more work."""
+        if time.monotonic() >= self._expires_at or redis_client.get(self.key) != str(self.token):
+            raise LeaseLost(f"lease {self.name} with token {self.token} was lost")
+
+    def release(self):
+        self._stopped.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        if self.token is not None:
+            _release_script(keys=[self.key], args=[self.token])
+
+    def _keep_renewed(self):
+        # renewing three times per ttl leaves room for a couple of failed renewals before the lease expires
+        while not self._stopped.wait(self.ttl_ms / 3000):
+            try:
+                if not self.renew():
+                    logger.warning("lease was lost", extra={"lease": self.name, "token": self.token})
+                    return
+            except Exception:
+                logger.warning("could not renew the lease", extra={"lease": self.name}, exc_info=True)
+
+
+@contextmanager
+def hold_lease(name: str, ttl: timedelta = DEFAULT_LEASE_TTL):
+    """
+    Try to take a lease without blocking and hold it for the duration of the block.
+
+    Args:
+        name (str): The name of the work the lease is on
+        ttl (timedelta): How long the lease outlives its last renewal
+
+    Yields:
+        Lease: The lease, or None if it's held by someone else
+    """
+    lease = Lease(name, ttl)
+    if not lease.acquire():
+        yield None
+        return
+
+    reset_token = _current_lease.set(lease)
+    try:
+        yield lease
+    finally:
+        _current_lease.reset(reset_token)
+        lease.release()
+
+
+def leased(key: Callable[..., str] = None, ttl: timedelta = DEFAULT_LEASE_TTL):
+    """
+    Run the decorated task only while holding a lease on it, a run started while the lease is held elsewhere is skipped.
+
+    Args:
+        key (Callable, optional): Builds the part of the lease name that depends on the task's arguments,
+            so that runs with different arguments don't exclude each other. One lease for the task if not set
+        ttl (timedelta): How long the lease outlives its last renewal
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            name = f"{func.__module__}.{func.__name__}"
+            if key is not None:
+                name = f"{name}:{key(*args, **kwargs)}"
+
+            with hold_lease(name, ttl) as lease:
+                if lease is None:
+                    logger.info("lease is held by another worker, skipping", extra={"lease": name})
+                    return None
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def ensure_held():
+    """Raise LeaseLost if the lease the current task runs under was lost, a no-op outside of a lease."""
+    lease = _current_lease.get()
+    if lease is not None:
+        lease.ensure_held()
+
+
+def current_token() -> Optional[int]:
+    """The fencing token of the lease the current task runs under, None outside of a lease."""
+    lease = _current_lease.get()
+    return lease.token if lease is not None else None
+
+
+def ensure_fenced(written: bool):
+    """Raise LeaseLost if a write made with the current lease's token was rejected for a later token."""
+    if not written:
+        raise LeaseLost(f"a write under lease token {current_token()} was rejected, a later lease took over")
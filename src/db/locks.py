@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from typing import Iterable
+from sqlalchemy import func, select
+
+from .database import engine
+
+
+# first key of the postgres advisory locks, keeps channel locks apart from any other advisory lock
+CHANNEL_PAIRING_LOCK = 1
+
+
+@contextmanager
+def channel_lock(channel_id: int):
+    """
+    Try to take a postgres advisory lock for pairing a channel without blocking.
+
+    The lock is held on its own connection so it survives the commits made while
+    pairs are sent, and it is released by postgres if the worker dies. The connection
+    is in autocommit so that it doesn't sit idle in a transaction while the lock is held.
+
+    Args:
+        channel_id (int): The primary key of the channel
+
+    Yields:
+        bool: Whether the lock was acquired
+    """
+    with channel_locks([channel_id]) as acquired:
+        yield channel_id in acquired
+
+
+@contextmanager
+def channel_locks(channel_ids: Iterable[int]):
+    """
+    Try to take the pairing locks of several channels without blocking, all held on a single connection.
+
+    Args:
+        channel_ids (Iterable[int]): The primary keys of the channels
+
+    Yields:
+        set: The primary keys of the channels whose lock was acquired
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        acquired = {
+            channel_id
+            for channel_id in set(channel_ids)
+            if conn.execute(select(func.pg_try_advisory_lock(CHANNEL_PAIRING_LOCK, channel_id))).scalar()
+        }
+        try:
+            yield acquired
+        finally:
+            for channel_id in acquired:
+                conn.execute(select(func.pg_advisory_unlock(CHANNEL_PAIRING_LOCK, channel_id)))
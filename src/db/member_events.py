@@ -0,0 +1,93 @@
+from typing import Dict, Iterator, Tuple
+
+from .database import async_redis_client, redis_client
+
+
+# a channel's flush marker outlives its flush task by this much, the events a lost or failed task left
+# buffered are then picked up by the next sweep for channels without a pending flush
+FLUSH_MARKER_TIMEOUT_SECONDS = 5 * 60
+# events buffered longer than this were never flushed, e.g. in a channel that was removed since
+EVENTS_EXPIRY_SECONDS = 24 * 60 * 60
+
+JOINED = "joined"
+LEFT = "left"
+
+
+def buffer_member_event(channel_id: str, team_id: str, member_id: str, event: str) -> bool:
+    """
+    Buffer a member joining or leaving a channel until the channel's events are flushed.
+
+    Only the latest event of a member is kept, a member who joined and left within the
+    window is applied as having left.
+
+    Args:
+        channel_id (str): The ID of the Slack channel
+        team_id (str): The ID of the Slack team/workspace
+        member_id (str): The ID of the Slack user
+        event (str): JOINED or LEFT
+
+    Returns:
+        bool: Whether no flush of the channel's events is pending yet, and one should be scheduled
+    """
+    with redis_client.pipeline() as pipe:
+        _buffer(pipe, channel_id, team_id, member_id, event)
+        return bool(pipe.execute()[-1])
+
+
+async def async_buffer_member_event(channel_id: str, team_id: str, member_id: str, event: str) -> bool:
+    """The same as buffer_member_event, for the listeners running on the event loop."""
+    async with async_redis_client.pipeline() as pipe:
+        _buffer(pipe, channel_id, team_id, member_id, event)
+        return bool((await pipe.execute())[-1])
+
+
+def take_member_events(channel_id: str, team_id: str) -> Dict[str, str]:
+    """
+    Remove and return the buffered events of a channel, the events buffered from then on schedule another flush.
+
+    Returns:
+        dict: The latest event of each member, by member ID
+    """
+    with redis_client.pipeline() as pipe:
+        pipe.hgetall(_events_key(channel_id, team_id))
+        pipe.delete(_events_key(channel_id, team_id), _flush_key(channel_id, team_id))
+        return pipe.execute()[0]
+
+
+def restore_member_events(channel_id: str, team_id: str, events: Dict[str, str]):
+    """Put back events taken by a flush that failed, without overwriting the events buffered since."""
+    if not events:
+        return
+
+    with redis_client.pipeline() as pipe:
+        for member_id, event in events.items():
+            pipe.hsetnx(_events_key(channel_id, team_id), member_id, event)
+        pipe.expire(_events_key(channel_id, team_id), EVENTS_EXPIRY_SECONDS)
+        pipe.execute()
+
+
+def claim_unflushed_channels() -> Iterator[Tuple[str, str]]:
+    """
+    Find the channels with buffered events that no flush is pending for, and mark a flush as pending for each.
+
+    Yields:
+        tuple: The channel ID and team ID of each channel whose flush is to be scheduled by the caller
+    """
+    for key in redis_client.scan_iter(match=_events_key("*", "*"), count=1000):
+        _, team_id, channel_id = key.split(":", 2)
+        if redis_client.set(_flush_key(channel_id, team_id), 1, nx=True, ex=FLUSH_MARKER_TIMEOUT_SECONDS):
+            yield channel_id, team_id
+
+
+def _buffer(pipe, channel_id: str, team_id: str, member_id: str, event: str):
+    pipe.hset(_events_key(channel_id, team_id), member_id, event)
+    pipe.expire(_events_key(channel_id, team_id), EVENTS_EXPIRY_SECONDS)
+    pipe.set(_flush_key(channel_id, team_id), 1, nx=True, ex=FLUSH_MARKER_TIMEOUT_SECONDS)
+
+
+def _events_key(channel_id: str, team_id: str) -> str:
+    return f"member_events:{team_id}:{channel_id}"
+
+
+def _flush_key(channel_id: str, team_id: str) -> str:
+    return f"member_events_flush:{team_id}:{channel_id}"
@@ -1,15 +1,21 @@
 from sqlalchemy import (
+    BigInteger,
     Boolean,
     Column,
     Date,
     DateTime,
+    ForeignKey,
+    Index,
     Integer,
+    Sequence,
     String,
     UniqueConstraint,
     ForeignKeyConstraint,
+    and_,
+    text,
 )
 from sqlalchemy.dialects.postgresql import JSONB, ARRAY
-from sqlalchemy.ext.mutable import MutableDict, MutableList
+from sqlalchemy.ext.mutable import MutableDict
 
 from datetime import datetime
 
@@ -19,30 +25,47 @@ from .database import Base
 class Channels(Base):
     __tablename__ = "channels"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     team_id = Column(String, index=True)
     enterprise_id = Column(String, nullable=True)
-    channel_id = Column(String, index=True)
+    channel_id = Column(String)
     is_active = Column(Boolean)
     last_sent_on = Column(Date, nullable=True)
+    # the weekly slot intros are sent in, day of the week (0 being monday) and hour in the channel's timezone
     conversation_day = Column(Integer, default=2)
+    conversation_hour = Column(Integer, nullable=False, server_default="9", default=9)
+    timezone = Column(String, nullable=False, server_default="UTC", default="UTC")
     conversation_frequency_weeks = Column(Integer, nullable=False, server_default="2", default=2)
     send_midpoint_reminder = Column(Boolean, nullable=False, server_default="t", default=True)
     added_on = Column(DateTime, default=datetime.utcnow)
-    members_circle = Column(MutableList.as_mutable(ARRAY(String)))
+    # how many members are put in a conversation, and how many rounds the members were grouped for so far
+    group_size = Column(Integer, nullable=False, server_default="2", default=2)
+    rotation_round = Column(Integer, nullable=False, server_default="0", default=0)
+    # when the channel is next due for pairing, kept in step with last_sent_on and the frequency
+    next_pairing_on = Column(
+        DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"), default=datetime.utcnow
+    )
+
+    __table_args__ = (
+        UniqueConstraint("channel_id", "team_id", name="channel_uc"),
+        Index("ix_channels_next_pairing_on", next_pairing_on, postgresql_where=is_active == True),
+    )
 
-    __table_args__ = (UniqueConstraint("channel_id", "team_id", name="channel_uc"),)
+
+# positions of the members in the rotation of their channel, members who join are put last
+member_position_seq = Sequence("channel_members_position_seq", metadata=Base.metadata)
 
 
 class ChannelMembers(Base):
     __tablename__ = "channel_members"
 
-    id = Column(Integer, primary_key=True, index=True)
-    channel_id = Column(String, index=True)
-    team_id = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String)
+    team_id = Column(String)
     member_id = Column(String)
     is_opted = Column(Boolean, nullable=False, server_default="t", default=True)
     added_on = Column(DateTime, default=datetime.utcnow)
+    position = Column(BigInteger, nullable=False, server_default=member_position_seq.next_value())
 
     __table_args__ = (
         UniqueConstraint(
@@ -51,15 +74,24 @@ class ChannelMembers(Base):
         ForeignKeyConstraint(
             [channel_id, team_id], [Channels.channel_id, Channels.team_id]
         ),
+        # covers listing a channel's (opted in) member ids, in their rotation order, with an index only scan
+        Index(
+            "ix_channel_members_channel_team_opted_position",
+            channel_id,
+            team_id,
+            is_opted,
+            position,
+            postgresql_include=["member_id"],
+        ),
     )
 
 
 class ChannelConversations(Base):
     __tablename__ = "channel_conversations"
 
-    id = Column(Integer, primary_key=True, index=True)
-    channel_id = Column(String, index=True)
-    team_id = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String)
+    team_id = Column(String)
     conversations = Column(MutableDict.as_mutable(JSONB))
     created_on = Column(Date, default=datetime.utcnow)
     sent_on = Column(Date, nullable=True)
@@ -68,4 +100,145 @@ class ChannelConversations(Base):
         ForeignKeyConstraint(
             [channel_id, team_id], [Channels.channel_id, Channels.team_id]
         ),
+        Index("ix_channel_conversations_channel_team", channel_id, team_id),
+        # conversations with intros left to be sent by send_failed_intros
+        Index(
+            "ix_channel_conversations_unsent",
+            created_on,
+            postgresql_where=sent_on == None,
+        ),
     )
+
+
+class ConversationPairs(Base):
+    """A group of members introduced to each other by a conversation, with the progress of its messages."""
+
+    __tablename__ = "conversation_pairs"
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(Integer, ForeignKey("channel_conversations.id"), nullable=False)
+    channel_id = Column(String, nullable=False)
+    team_id = Column(String, nullable=False)
+    member_ids = Column(ARRAY(String), nullable=False)
+    # GENERATED, then OPENED once the group DM is open and its id saved, then INTRO_SENT
+    status = Column(String, nullable=False, server_default="GENERATED", default="GENERATED")
+    dm_channel_id = Column(String, nullable=True)
+    intro_sent_on = Column(DateTime, nullable=True)
+    midpoint_sent_on = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_conversation_pairs_conversation_id", conversation_id),
+        # pairs left to be retried by send_failed_intros
+        Index(
+            "ix_conversation_pairs_unsent",
+            conversation_id,
+            postgresql_where=status != "INTRO_SENT",
+        ),
+        # pairs waiting on their midpoint reminder, looked up by when their intro was sent
+        Index(
+            "ix_conversation_pairs_midpoint_pending",
+            intro_sent_on,
+            postgresql_where=and_(status == "INTRO_SENT", midpoint_sent_on == None),
+        ),
+    )
+
+
+class PairHistory(Base):
+    """When two members of a channel were last paired, one row per pair of members with `member_a` < `member_b`."""
+
+    __tablename__ = "pair_history"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String, nullable=False)
+    team_id = Column(String, nullable=False)
+    member_a = Column(String, nullable=False)
+    member_b = Column(String, nullable=False)
+    last_met_on = Column(Date, nullable=False)
+    times_met = Column(Integer, nullable=False, server_default="1", default=1)
+
+    __table_args__ = (
+        ForeignKeyConstraint(
+            [channel_id, team_id], [Channels.channel_id, Channels.team_id]
+        ),
+        UniqueConstraint("channel_id", "team_id", "member_a", "member_b", name="pair_history_uc"),
+        # the recent meetings of a channel read before pairing it, answered from the index alone
+        Index(
+            "ix_pair_history_channel_team_met",
+            channel_id,
+            team_id,
+            last_met_on,
+            postgresql_include=["member_a", "member_b"],
+        ),
+    )
+
+
+class ChannelMemberSyncs(Base):
+    """Checkpoint of a member sync of a channel in progress, removed once the sync completes."""
+
+    __tablename__ = "channel_member_syncs"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String, nullable=False)
+    team_id = Column(String, nullable=False)
+    cursor = Column(String, nullable=True)
+    seen_member_ids = Column(ARRAY(String), nullable=False, server_default="{}", default=list)
+    started_on = Column(DateTime, default=datetime.utcnow)
+    updated_on = Column(DateTime, default=datetime.utcnow)
+    # fencing token of the latest lease the sync was saved under, saves under an earlier lease are rejected
+    lease_token = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("channel_id", "team_id", name="channel_member_sync_uc"),
+        ForeignKeyConstraint(
+            [channel_id, team_id], [Channels.channel_id, Channels.team_id]
+        ),
+    )
+
+
+class WorkspaceUsers(Base):
+    __tablename__ = "workspace_users"
+
+    id = Column(Integer, primary_key=True)
+    team_id = Column(String, nullable=False)
+    user_id = Column(String, nullable=False)
+    is_bot = Column(Boolean, nullable=False, server_default="f", default=False)
+    is_deleted = Column(Boolean, nullable=False, server_default="f", default=False)
+    updated_on = Column(DateTime, default=datetime.utcnow)
+    # set only when the user was seen by a full users.list sync of the workspace
+    synced_on = Column(DateTime, nullable=True)
+
+    __table_args__ = (UniqueConstraint("team_id", "user_id", name="workspace_user_uc"),)
+
+
+class ReconciliationRuns(Base):
+    """A run of the weekly reconciliation of cached channel members with slack."""
+
+    __tablename__ = "reconciliation_runs"
+
+    id = Column(Integer, primary_key=True)
+    started_on = Column(DateTime, default=datetime.utcnow)
+    finished_on = Column(DateTime, nullable=True)
+    channels_reconciled = Column(Integer, nullable=False, server_default="0", default=0)
+    channels_failed = Column(Integer, nullable=False, server_default="0", default=0)
+    members_removed = Column(Integer, nullable=False, server_default="0", default=0)
+
+
+class ReconciliationShards(Base):
+    """The part of a reconciliation run covering the channels of one workspace, with its progress."""
+
+    __tablename__ = "reconciliation_shards"
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("reconciliation_runs.id"), nullable=False)
+    team_id = Column(String, nullable=False)
+    enterprise_id = Column(String, nullable=True)
+    # primary key of the last channel reconciled, channels are processed in order of their keys
+    last_channel_id = Column(Integer, nullable=True)
+    channels_reconciled = Column(Integer, nullable=False, server_default="0", default=0)
+    channels_failed = Column(Integer, nullable=False, server_default="0", default=0)
+    members_removed = Column(Integer, nullable=False, server_default="0", default=0)
+    finished_on = Column(DateTime, nullable=True)
+    # fencing token of the latest lease the progress was saved under, saves under an earlier lease are rejected
+    lease_token = Column(BigInteger, nullable=True)
+
+    __table_args__ = (UniqueConstraint("run_id", "team_id", name="reconciliation_shard_uc"),)
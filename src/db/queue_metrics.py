@@ -0,0 +1,72 @@
+import json
+import time
+
+from typing import List
+
+from .database import redis_client
+
+
+# latest waits kept per queue to compute its percentiles from
+WAIT_SAMPLE_SIZE = 1000
+
+
+def record_wait(queue: str, seconds: float):
+    """Record how long a task waited in a queue before a worker started it."""
+    with redis_client.pipeline() as pipe:
+        pipe.lpush(_waits_key(queue), round(seconds, 3))
+        pipe.ltrim(_waits_key(queue), 0, WAIT_SAMPLE_SIZE - 1)
+        pipe.execute()
+
+
+def get_queue_metrics(queues: List[str]) -> List[dict]:
+    """
+    Read the depth and latency of celery queues on the redis broker.
+
+    Args:
+        queues (list): The names of the queues
+
+    Returns:
+        list: For each queue, the number of tasks waiting, the age of the oldest one, and the median and
+            95th percentile of the latest waits of the tasks that were started, in seconds
+    """
+    with redis_client.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.llen(queue)
+            # kombu pushes to the head of the list and pops from its tail
+            pipe.lindex(queue, -1)
+            pipe.lrange(_waits_key(queue), 0, -1)
+        results = pipe.execute()
+
+    now = time.time()
+    metrics = []
+    for i, queue in enumerate(queues):
+        depth, oldest, waits = results[3 * i : 3 * i + 3]
+        waits = sorted(float(w) for w in waits)
+        metrics.append(
+            {
+                "queue": queue,
+                "depth": depth,
+                "oldest_seconds": _age(oldest, now),
+                "wait_p50_seconds": _percentile(waits, 0.5),
+                "wait_p95_seconds": _percentile(waits, 0.95),
+            }
+        )
+
+    return metrics
+
+
+def _age(message: str | None, now: float) -> float | None:
+    if message is None:
+        return None
+    enqueued_at = json.loads(message).get("headers", {}).get("enqueued_at")
+    return None if enqueued_at is None else round(now - enqueued_at, 3)
+
+
+def _percentile(values: List[float], q: float) -> float | None:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _waits_key(queue: str) -> str:
+    return f"queue_waits:{queue}"
@@ -0,0 +1,15 @@
+from .database import async_redis_client
+
+
+async def async_claim_event(event_id: str, expiry_seconds: int) -> bool:
+    """
+    Mark a Slack event as handled, a single SET NX so concurrent deliveries of an event can't both claim it.
+
+    Args:
+        event_id (str): The event_id of the event callback, the same across the retries of an event
+        expiry_seconds (int): How long the event is remembered, longer than Slack keeps retrying it
+
+    Returns:
+        bool: Whether the event wasn't handled yet
+    """
+    return bool(await async_redis_client.set(f"slack_event:{event_id}", 1, nx=True, ex=expiry_seconds))
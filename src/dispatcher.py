@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import logging
+import time
+import weakref
+import settings
+
+from typing import List
+from slack_sdk.errors import SlackApiError
+
+from src.db import database
+
+
+logger = logging.getLogger(__name__)
+
+# requests per minute and burst size for each of the slack web api rate limit tiers
+# https://api.slack.com/apis/rate-limits
+TIER_LIMITS = {
+    1: (1, 1),
+    2: (20, 3),
+    3: (50, 5),
+    4: (100, 10),
+    # chat.postMessage has its own limit, kept for the whole workspace so that posting to many DMs is throttled
+    "post_message": (100, 10),
+}
+# the limits slack also applies per channel on top of the workspace's, roughly one message per second
+CHANNEL_TIER_LIMITS = {
+    "post_message": (60, 3),
+}
+
+METHOD_TIERS = {
+    "chat.postMessage": "post_message",
+    "conversations.history": 3,
+    "conversations.info": 3,
+    "conversations.members": 4,
+    "conversations.open": 3,
+    "users.info": 4,
+    "users.list": 2,
+}
+DEFAULT_TIER = 3
+
+# takes a token from the bucket, or when ARGV[4] is set holds back every token for that many seconds,
+# and returns the seconds to wait before the token can be used
+_TAKE_TOKEN_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local pause = tonumber(ARGV[4])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+if pause > 0 then
+    tokens = math.min(tokens, 0) - pause * rate
+else
+    tokens = tokens - 1
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(math.max(now, updated_at)))
+redis.call('expire', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+if tokens >= 0 or pause > 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+_take_token = database.redis_client.register_script(_TAKE_TOKEN_SCRIPT)
+
+
+class TokenBucket:
+    """
+    A token bucket kept in redis, so that all the worker processes of all the hosts share the same budget.
+
+    The buckets are refilled from the wall clock of the callers, which are expected to be kept in sync.
+    """
+
+    def __init__(self, key: str, requests_per_minute: int, capacity: int):
+        self.key = key
+        self.rate = requests_per_minute / 60
+        self.capacity = capacity
+
+    def reserve(self) -> float:
+        """
+        Take a token from the bucket.
+
+        Returns:
+            float: Seconds the caller has to wait before the token can be used
+        """
+        return float(_take_token(keys=[self.key], args=self._args(0)))
+
+    def pause(self, seconds: float):
+        """Hold back any new token for the next `seconds`, used when slack responds with a Retry-After."""
+        _take_token(keys=[self.key], args=self._args(seconds))
+
+    def _args(self, pause: float):
+        return [self.rate, self.capacity, time.time(), pause]
+
+
+class SlackDispatcher:
+    """
+    Sends slack web api calls under a token bucket per workspace and rate limit tier,
+    and also per channel for the methods slack limits per channel.
+
+    A call rejected with a 429 pauses the workspace's bucket of its tier for the duration
+    of the Retry-After header and then only that call is retried. Async calls take their tokens from a thread,
+    the workers run each task in a new event loop which a shared async redis client can't follow.
+    """
+
+    def __init__(self, max_retries: int = settings.SLACK_MAX_RETRIES):
+        self.max_retries = max_retries
+
+    def bucket(self, workspace: str, method: str) -> TokenBucket:
+        tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+        return TokenBucket(f"slack_rate:{workspace}:{tier}", *TIER_LIMITS[tier])
+
+    def buckets(self, workspace: str, method: str, channel: str = None) -> List[TokenBucket]:
+        """The buckets a call takes a token from, the workspace's bucket first and then the channel's if any."""
+        buckets = [self.bucket(workspace, method)]
+        tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+        if channel and tier in CHANNEL_TIER_LIMITS:
+            buckets.append(TokenBucket(f"slack_rate:{workspace}:{tier}:{channel}", *CHANNEL_TIER_LIMITS[tier]))
+        return buckets
+
+    def call(self, workspace: str, method: str, func, *args, **kwargs):
+        buckets = self.buckets(workspace, method, kwargs.get("channel"))
+        attempt = 0
+        while True:
+            time.sleep(_reserve(buckets))
+            try:
+                return func(*args, **kwargs)
+            except SlackApiError as e:
+                retry_after = _retry_after(e)
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning(
+                    "rate limited by slack",
+                    extra={"workspace": workspace, "method": method, "retry_after": retry_after},
+                )
+                buckets[0].pause(retry_after)
+
+    async def async_call(self, workspace: str, method: str, func, *args, **kwargs):
+        buckets = self.buckets(workspace, method, kwargs.get("channel"))
+        attempt = 0
+        while True:
+            await asyncio.sleep(await asyncio.to_thread(_reserve, buckets))
+            try:
+                return await func(*args, **kwargs)
+            except SlackApiError as e:
+                retry_after = _retry_after(e)
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                logger.warning(
+                    "rate limited by slack",
+                    extra={"workspace": workspace, "method": method, "retry_after": retry_after},
+                )
+                await asyncio.to_thread(buckets[0].pause, retry_after)
+
+
+class RateLimitedClient:
+    """Wraps a slack WebClient so that every api method call goes through the dispatcher."""
+
+    def __init__(self, client, workspace: str, slack_dispatcher: SlackDispatcher = None):
+        self.client = client
+        self.workspace = workspace
+        self.dispatcher = slack_dispatcher or dispatcher
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        return functools.partial(self.dispatcher.call, self.workspace, name.replace("_", "."), attr)
+
+
+class AsyncRateLimitedClient:
+    """
+    Wraps a slack AsyncWebClient so that every api method call goes through the dispatcher,
+    with at most `max_concurrency` requests in flight for the workspace across all of its clients
+    in the event loop.
+    """
+
+    def __init__(
+        self,
+        client,
+        workspace: str,
+        max_concurrency: int = settings.SLACK_MAX_CONCURRENT_REQUESTS,
+        slack_dispatcher: SlackDispatcher = None,
+    ):
+        self.client = client
+        self.workspace = workspace
+        self.dispatcher = slack_dispatcher or dispatcher
+        self.max_concurrency = max_concurrency
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            async with _workspace_semaphore(self.workspace, self.max_concurrency):
+                return await self.dispatcher.async_call(self.workspace, name.replace("_", "."), attr, *args, **kwargs)
+
+        return call
+
+
+def _reserve(buckets: List[TokenBucket]) -> float:
+    # a token is taken from every bucket, the call waits for the one that's furthest out
+    return max([bucket.reserve() for bucket in buckets])
+
+
+def _workspace_semaphore(workspace: str, max_concurrency: int) -> asyncio.Semaphore:
+    # semaphores can't be shared between event loops, and the workers run each task in a new one
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if workspace not in semaphores:
+        semaphores[workspace] = asyncio.Semaphore(max_concurrency)
+    return semaphores[workspace]
+
+
+def _retry_after(error: SlackApiError):
+    if error.response is None or error.response.status_code != 429:
+        return None
+    headers = {k.lower(): v for k, v in (error.response.headers or {}).items()}
+    return int(headers.get("retry-after", 1))
+
+
+# the semaphores bounding the requests in flight per workspace, for each running event loop
+_semaphores = weakref.WeakKeyDictionary()
+
+# shared by all slack clients in the process, the limits themselves are shared through redis
+dispatcher = SlackDispatcher()
@@ -1,31 +1,232 @@
-from src.db import models
-from typing import List, Tuple
+import math
+import random
 
+from typing import Dict, List, Tuple
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from zoneinfo import ZoneInfo
 
-def generate_member_model_list(member_ids, exclude_members, channel_id, team_id):
-    members = []
-    for member in member_ids:
-        if member not in exclude_members:
-            members.append(
-                models.ChannelMembers(channel_id=channel_id, member_id=member, team_id=team_id)
-            )
 
-    return members
+def is_bot_user(user: dict) -> bool:
+    # slackbot isn't flagged as a bot by the api
+    return user.get("is_bot", False) or user["id"] == "USLACKBOT"
 
 
-def round_robin_match(members: List) -> Tuple[List[List], List]:
-    count = len(members)
-    midpoint = count // 2
-    if count % 2 != 0:
-        raise ValueError("matching is supported for even number of members only")
+def group_sizes(count: int, group_size: int) -> List[int]:
+    """
+    Split `count` members into groups as close to `group_size` as possible, the sizes differing by one at most.
 
-    members_rotated_circle = members[0:1] + members[-1:] + members[1:-1]
+    The members left over join groups of `group_size` one each. If there are more left over than groups,
+    there is one more group and some groups are one member short instead.
+    """
+    if count < 2:
+        return []
+    groups = count // group_size
+    if groups == 0:
+        return [count]
+    if count % group_size > groups:
+        groups += 1
+    return [count // groups + (i < count % groups) for i in range(groups)]
 
-    pairs = []
-    for i in range(midpoint):
-        if i >= midpoint:
+
+def rotation_groups(members: List, group_size: int, rotation_round: int) -> List[List]:
+    """
+    Group the members for a round of their rotation, computed from the member order and the round alone.
+
+    Members are paired by the circle method (https://en.wikipedia.org/wiki/Round-robin_tournament#Circle_method)
+    with the circle turned by one position each round, so pairs don't repeat for `len(members) - 1` rounds
+    while the members don't change. With an odd number of members an empty seat is fixed in the circle and
+    whoever sits next to it joins the first group with another pair, which gives everyone that seat in turn.
+
+    Larger groups are made from pairs taken a stride apart, the stride changing every round so that members
+    of neighbouring pairs aren't grouped together again, and starting from a pair that changes every round
+    so that the groups made larger or smaller by left over members go to different members.
+    """
+    circle = list(members)
+    if len(circle) % 2 != 0:
+        circle.insert(0, None)
+    if len(circle) < 2:
+        return []
+
+    fixed, rest = circle[0], circle[1:]
+    shift = rotation_round % len(rest)
+    circle = [fixed] + rest[len(rest) - shift :] + rest[: len(rest) - shift]
+
+    count = len(circle)
+    pairs = [(circle[i], circle[count - 1 - i]) for i in range(count // 2)]
+    order = []
+    if fixed is None:
+        # the member next to the empty seat leads the first group with the pair across the circle, those turn
+        # with the circle so everyone takes both places once in a cycle, rounds apart from each other
+        order.append(pairs.pop(0)[1])
+        order.extend(pairs.pop(len(pairs) // 2) if pairs else [])
+    if pairs:
+        stride, start = _rotation_stride(len(pairs), rotation_round), 2 * rotation_round
+        order.extend(m for i in range(len(pairs)) for m in pairs[(start + i * stride) % len(pairs)])
+
+    groups, start = [], 0
+    for size in group_sizes(len(order), group_size):
+        groups.append(order[start : start + size])
+        start += size
+    return groups
+
+
+def _rotation_stride(count: int, rotation_round: int) -> int:
+    # the round's stride out of 1, 4, 7... skipping those sharing a factor with count, so that every pair is
+    # visited. Growing by 3 keeps both the distance and the sum of the places of grouped members changing
+    # while the circle turns by one position a round.
+    candidate = 0
+    while True:
+        stride = (3 * candidate) % count + 1
+        candidate += 1
+        if math.gcd(stride, count) == 1:
+            if rotation_round == 0:
+                return stride
+            rotation_round -= 1
+
+
+def pair_key(member_a: str, member_b: str) -> Tuple[str, str]:
+    return (member_a, member_b) if member_a < member_b else (member_b, member_a)
+
+
+def pairing_cost(member_a, member_b, last_met: Dict[Tuple[str, str], date], today: date, horizon_days: int) -> int:
+    """How recently two members met, the days left before their last meeting is `horizon_days` old, 0 if it is."""
+    met_on = last_met.get(pair_key(member_a, member_b))
+    if met_on is None:
+        return 0
+    return max(0, horizon_days - (today - met_on).days)
+
+
+def avoid_recent_groups(
+    groups: List[List],
+    last_met: Dict[Tuple[str, str], date],
+    today: date,
+    horizon_days: int,
+    sample_size: int = 50,
+    max_passes: int = 3,
+) -> List[List]:
+    """
+    Rework groups so that members who met recently are grouped with members they met longer ago.
+
+    A member of a group where some met within the horizon swaps places with a member of one of a sample
+    of the other groups whenever that lowers the summed pairing cost of the two groups, until the group
+    has no cost left or no swap helps. Only the groups with a cost and a sample of others are looked at,
+    so with a sparse history this stays close to linear in the number of members. Group sizes are kept.
+
+    Args:
+        groups (list): Groups of members, as generated by rotation_groups
+        last_met (dict): The day each pair of members last met, keyed by pair_key
+        today (date): The day the groups are made
+        horizon_days (int): Meetings older than this many days don't count against grouping members again
+
+    Returns:
+        list: The reworked groups
+    """
+    groups = [list(group) for group in groups]
+    # inlined pairing_cost, it is called for every candidate swap
+    since = today - timedelta(days=horizon_days)
+
+    def cost(member, others):
+        total = 0
+        for other in others:
+            met_on = last_met.get((member, other) if member < other else (other, member))
+            if met_on is not None and met_on > since:
+                total += (met_on - since).days
+        return total
+
+    def group_cost(group):
+        return sum(cost(member, group[i + 1 :]) for i, member in enumerate(group))
+
+    def find_swap(i):
+        # the best swap of a member of group i, settling for the first that takes away all the member's cost
+        best = None
+        candidates = random.sample(range(len(groups)), min(sample_size, len(groups)))
+        for x, member in enumerate(groups[i]):
+            rest_i = groups[i][:x] + groups[i][x + 1 :]
+            member_cost = cost(member, rest_i)
+            if member_cost == 0:
+                continue
+            for j in candidates:
+                if j == i:
+                    continue
+                for y, other in enumerate(groups[j]):
+                    rest_j = groups[j][:y] + groups[j][y + 1 :]
+                    gain = member_cost + cost(other, rest_j) - cost(other, rest_i) - cost(member, rest_j)
+                    if gain > 0 and (best is None or gain > best[0]):
+                        best = (gain, x, j, y)
+                if best is not None and best[0] >= member_cost:
+                    return best
+        return best
+
+    costs = [group_cost(group) for group in groups]
+    for _ in range(max_passes):
+        improved = False
+        for i in sorted((i for i, c in enumerate(costs) if c > 0), key=lambda i: -costs[i]):
+            while costs[i] > 0:
+                swap = find_swap(i)
+                if swap is None:
+                    break
+                _, x, j, y = swap
+                groups[i][x], groups[j][y] = groups[j][y], groups[i][x]
+                costs[i], costs[j] = group_cost(groups[i]), group_cost(groups[j])
+                improved = True
+
+        if not improved:
             break
 
-        pairs.append([members_rotated_circle[i], members_rotated_circle[count - 1 - i]])
+    return groups
+
+
+def group_members(
+    members: List,
+    group_size: int,
+    rotation_round: int,
+    last_met: Dict[Tuple[str, str], date],
+    today: date,
+    horizon_days: int,
+) -> List[List]:
+    """
+    Group the members of a channel for a round.
+
+    Args:
+        members (list): The members in their rotation order
+        group_size (int): How many members to put in a group, left over members make some groups larger
+        rotation_round (int): How many rounds the channel was grouped for before
+        last_met (dict): The day each pair of members last met, keyed by pair_key
+        today (date): The day the groups are made
+        horizon_days (int): Meetings older than this many days don't count against grouping members again
+
+    Returns:
+        list: The groups
+    """
+    # The rotation only proposes the groups, members who met recently (e.g. after members joined or left
+    # and the order changed) swap places with members of other groups
+    groups = rotation_groups(members, group_size, rotation_round)
+    return avoid_recent_groups(groups, last_met, today, horizon_days)
+
+
+def next_conversation_time(after: datetime, day: int, hour: int, timezone: str) -> datetime:
+    """
+    Find the start of the first conversation slot of a channel at or after a time.
+
+    Args:
+        after (datetime): Naive utc time, the slot it falls in counts as being at or after it
+        day (int): Day of the week of the slot in the channel's timezone, 0 being monday
+        hour (int): Hour of the day of the slot in the channel's timezone
+        timezone (str): IANA name of the channel's timezone
+
+    Returns:
+        datetime: The start of the slot as a naive utc time
+    """
+    local_after = after.replace(tzinfo=dt_timezone.utc).astimezone(ZoneInfo(timezone))
+    local_after = local_after.replace(minute=0, second=0, microsecond=0)
+    slot = local_after.replace(hour=hour) + timedelta(days=(day - local_after.weekday()) % 7)
+    if slot < local_after:
+        slot += timedelta(weeks=1)
+
+    return slot.astimezone(dt_timezone.utc).replace(tzinfo=None)
+
 
-    return pairs, members_rotated_circle
+def utc_hour_of_week(day: int, hour: int, timezone: str) -> int:
+    """Return the hour of the week in utc, 0 being monday midnight, that a local conversation slot currently falls on."""
+    slot = next_conversation_time(datetime.utcnow(), day, hour, timezone)
+    return slot.weekday() * 24 + slot.hour
@@ -1,141 +1,213 @@
 import settings
+import asyncio
+import calendar
 import logging
+import aiohttp
 import src.tasks.member_management as membership_tasks
 import src.tasks.pairing as pairing_tasks
+import src.tasks.commands as command_tasks
 
-from slack_bolt.oauth.oauth_settings import OAuthSettings
-from slack_bolt.app import App
+from slack_bolt.oauth.async_oauth_settings import AsyncOAuthSettings
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.response import BoltResponse
+from slack_bolt.listener.async_builtins import AsyncTokenRevocationListeners
+from slack_sdk.oauth.installation_store.models import Installation
 from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
 
-from src.db import database, crud
+from celery.worker.control import control_command
+
+from src.db import database, crud, member_events, slack_events
+from src.cache import TTLCache
+from src.dispatcher import RateLimitedClient, AsyncRateLimitedClient
+from task_runner import celery
 
 
 # set up logging
 logging.basicConfig(level=logging.WARN)
 logger = logging.getLogger(__name__)
 
-# slack app with OAuth store
-app = App(
+# slack app with OAuth store, its listeners run on the web process' event loop and must not block it
+app = AsyncApp(
     logger=logger,
     signing_secret=settings.SLACK_SIGNING_SECRET,
-    installation_store=database.installation_store,
-    oauth_settings=OAuthSettings(
+    installation_store=database.async_installation_store,
+    oauth_settings=AsyncOAuthSettings(
         client_id=settings.SLACK_CLIENT_ID,
         client_secret=settings.SLACK_CLIENT_SECRET,
-        state_store=database.oauth_state_store,
+        state_store=database.async_oauth_state_store,
     ),
 )
 
 
-def get_slack_client(enterprise_id: str | None, team_id: str) -> WebClient:
-    installation = database.installation_store.find_installation(
-        enterprise_id=enterprise_id, team_id=team_id
+@app.middleware
+async def drop_duplicate_events(body, next, logger: logging.Logger):
+    # slack redelivers an event with the same event_id when it isn't acked in time, only the first delivery is handled
+    event_id = body.get("event_id")
+    if event_id:
+        try:
+            claimed = await slack_events.async_claim_event(event_id, settings.SLACK_EVENT_DEDUP_SECONDS)
+        except Exception:
+            # handling an event twice is better than dropping it
+            logger.warning("could not check if the event was already handled", exc_info=True)
+            claimed = True
+        if not claimed:
+            logger.info("dropped a duplicate event", extra={"event_id": event_id})
+            return BoltResponse(status=200, body="")
+
+    return await next()
+
+
+# process local caches so that hot paths don't query the installation tables and build a client on every call
+_installations = TTLCache(settings.SLACK_CLIENT_CACHE_SIZE, settings.SLACK_CLIENT_CACHE_TTL_SECONDS)
+_clients = TTLCache(settings.SLACK_CLIENT_CACHE_SIZE, settings.SLACK_CLIENT_CACHE_TTL_SECONDS)
+
+token_revocation = AsyncTokenRevocationListeners(database.async_installation_store)
+
+# sizes of the conversation groups a channel can be set to
+GROUP_SIZES = range(2, 5)
+# days of the week a channel can be scheduled on, by their number starting from monday
+WEEKDAYS = [day.lower() for day in calendar.day_name]
+
+
+def get_installation(enterprise_id: str | None, team_id: str) -> Installation:
+    key = (enterprise_id, team_id)
+    installation = _installations.get(key)
+    if installation is None:
+        installation = database.installation_store.find_installation(
+            enterprise_id=enterprise_id, team_id=team_id
+        )
+        if installation is not None:
+            _installations.set(key, installation)
+
+    return installation
+
+
+def get_slack_client(enterprise_id: str | None, team_id: str) -> RateLimitedClient:
+    key = (enterprise_id, team_id)
+    client = _clients.get(key)
+    if client is None:
+        installation = get_installation(enterprise_id, team_id)
+        client = RateLimitedClient(WebClient(token=installation.bot_token), team_id or enterprise_id)
+        _clients.set(key, client)
+
+    return client
+
+
+def get_async_slack_client(
+    enterprise_id: str | None, team_id: str, session: aiohttp.ClientSession
+) -> AsyncRateLimitedClient:
+    installation = get_installation(enterprise_id, team_id)
+
+    return AsyncRateLimitedClient(
+        AsyncWebClient(token=installation.bot_token, session=session), team_id or enterprise_id
     )
 
-    return WebClient(token=installation.bot_token)
+
+@control_command(args=[("enterprise_id", str), ("team_id", str)])
+def invalidate_slack_client(state, enterprise_id: str | None, team_id: str):
+    """Drop the cached installation and client of a workspace, also runs on the workers as a broadcast command."""
+    _installations.pop((enterprise_id, team_id))
+    _clients.pop((enterprise_id, team_id))
+
+
+@app.event("tokens_revoked")
+async def handle_tokens_revoked(event, context):
+    await token_revocation.handle_tokens_revoked_events(event, context)
+    await _broadcast_invalidation(context.enterprise_id, context.team_id)
+
+
+@app.event("app_uninstalled")
+async def handle_app_uninstalled(context):
+    await token_revocation.handle_app_uninstalled_events(context)
+    await _broadcast_invalidation(context.enterprise_id, context.team_id)
+
+
+async def _broadcast_invalidation(enterprise_id, team_id):
+    invalidate_slack_client(None, enterprise_id, team_id)
+    await asyncio.to_thread(
+        celery.control.broadcast,
+        "invalidate_slack_client",
+        arguments={"enterprise_id": enterprise_id, "team_id": team_id},
+    )
+
+
+@app.event("user_change")
+@app.event("team_join")
+async def handle_user_change(event, context):
+    async with database.AsyncSessionLocal() as db:
+        await crud.async_save_workspace_users(db, context.team_id, [event["user"]])
 
 
 @app.event("member_joined_channel")
-def handle_member_joined(body, context):
-    event = body["event"]
-    membership_tasks.add_member_to_db.delay(event["user"], context.channel_id, context.team_id)
+async def handle_member_joined(body, context):
+    await _buffer_member_event(body["event"]["user"], context, member_events.JOINED)
 
 
 @app.event("member_left_channel")
-def handle_member_left(body, context, logger: logging.Logger):
-    event = body["event"]
-    with database.SessionLocal() as db:
-        result = crud.delete_member(
-            db, event["user"], context.channel_id, context.team_id
+async def handle_member_left(body, context):
+    await _buffer_member_event(body["event"]["user"], context, member_events.LEFT)
+
+
+async def _buffer_member_event(member_id, context, event):
+    # bursts of joins, like a user group added to the channel, are applied and welcomed together once the window is over
+    if await member_events.async_buffer_member_event(context.channel_id, context.team_id, member_id, event):
+        await _queue(
+            membership_tasks.apply_member_events,
+            context.channel_id,
+            context.team_id,
+            countdown=settings.MEMBER_EVENTS_FLUSH_SECONDS,
         )
-        if result < 1:
-            fields = {
-                "user": event["user"],
-                "channel": context.channel_id,
-                "team_id": context.team_id,
-            }
-            logger.warning("no user deleted", extra=fields)
 
 
 @app.command("/smores")
-def handle_smores_command(
-    ack, command, respond, say, client, context, logger: logging.Logger
-):
-    try:
-        ack()
-
-        action = command["text"].strip().split(" ")[0].lower()
-        channel_id = command["channel_id"]
-
-        if action in ["enable", "disable"]:
-            _handle_activation(client, say, respond, action, context, channel_id, logger)
-        elif action in ["force_chat"]:
-            pairing_tasks.force_generate_conversations.delay(channel_id)
-            respond("conversations queued to be sent.")
-        elif action in ["opt_in", "opt_out"]:
-            _handle_member_inclusion(respond, action, context, context.user_id)
-        elif action in ["exclude"]:
-            member_id = command["text"].strip().split(" ")[-1]
-            if _remove_from_channel(member_id, context.channel_id, context.team_id):
-                respond(f"User <@{member_id}> as been removed from pairings.")
-            else:
-                respond(f"User <@{member_id}> not found in the channel pairings.")
-        else:
-            respond(
-                f"Action `{action}` not recognized. Supported actions are `enable | disable | force_chat | exclude | opt_out | opt_in`"
-            )
+async def handle_smores_command(ack, command, context):
+    # slack needs the command acked within 3 seconds, anything touching the database or slack is queued
+    words = command["text"].strip().split(" ")
+    action, argument = words[0].lower(), words[-1]
+    channel_id = command["channel_id"]
+
+    if action in ["enable", "disable", "exclude", "opt_out"]:
+        await ack()
+        await _queue_command(action, argument, command, context)
+    elif action in ["group_size"]:
+        if not argument.isdigit() or int(argument) not in GROUP_SIZES:
+            await ack(f"Group size should be a number from {GROUP_SIZES.start} to {GROUP_SIZES.stop - 1}.")
             return
-
-    # TODO: handle exceptions better individually
-    except Exception:
-        logger.exception("failed to handle command", command)
-
-
-def _handle_activation(client, say, respond, action, context, channel_id, logger):
-    try:
-        client.conversations_info(channel=channel_id)
-    except SlackApiError as e:
-        if e.response.data["error"] == "channel_not_found":
-            respond(
-                "For private channels, please add the bot user to the channel first"
-            )
-        else:
-            logger.exception("got error getting channel info")
-        return
-
-    # while this works for now, eventually move it to background task
-    # as slack requires to respond in under 3 seconds
-    with database.SessionLocal() as db:
-        channel = crud.get_channel(db, channel_id, context.team_id)
-
-        if channel is None and action == "enable":
-            crud.add_channel(db, channel_id, context.team_id, context.enterprise_id)
-            membership_tasks.cache_channel_members.delay(
-                channel_id, context.team_id, context.enterprise_id
-            )
-        else:
-            channel.is_active = True if action == "enable" else False
-            db.commit()
-
-        say(f"S'mores fireside chats {action}d")
-
-
-def _handle_member_inclusion(respond, action, context, member_id):
-    if action == "opt_out":
-        _remove_from_channel(member_id, context.channel_id, context.team_id)
-        respond(
-            "You are now opted out from pairings in this channel. Use `opt_in` command to rejoin."
-        )
+        await ack()
+        await _queue_command(action, argument, command, context)
+    elif action in ["schedule"]:
+        day, hour = (words[1:] + ["", ""])[:2]
+        if day.lower() not in WEEKDAYS or not hour.isdigit() or int(hour) > 23:
+            await ack("Schedule should be a day of the week and an hour from 0 to 23, e.g. `schedule monday 10`.")
+            return
+        await ack()
+        await _queue_command(action, f"{WEEKDAYS.index(day.lower())} {int(hour)}", command, context)
+    elif action in ["force_chat"]:
+        await _queue(pairing_tasks.force_generate_conversations, channel_id, context.team_id)
+        await ack("conversations queued to be sent.")
+    elif action in ["opt_in"]:
+        await _queue(membership_tasks.add_member_to_db, context.user_id, channel_id, context.team_id)
+        await ack("You are now opted in for pairings in this channel.")
     else:
-        membership_tasks.add_member_to_db.delay(member_id, context.channel_id, context.team_id)
-        respond("You are now opted in for pairings in this channel.")
+        await ack(
+            f"Action `{action}` not recognized. Supported actions are `enable | disable | force_chat | exclude | opt_out | opt_in | group_size | schedule`"
+        )
+
+
+async def _queue_command(action, argument, command, context):
+    await _queue(
+        command_tasks.run_smores_command,
+        action,
+        argument,
+        command["channel_id"],
+        context.team_id,
+        context.enterprise_id,
+        context.user_id,
+        command["response_url"],
+    )
 
 
-def _remove_from_channel(member_id, channel_id, team_id):
-    with database.SessionLocal() as db:
-        member = crud.get_member(db, member_id, channel_id, team_id)
-        if not member:
-            return False
-        crud.delete_member(db, member_id, channel_id, team_id)
-        return True
+async def _queue(task, *args, **options):
+    # publishing to the broker blocks, so it's done on a thread rather than on the event loop
+    await asyncio.to_thread(task.apply_async, args, **options)
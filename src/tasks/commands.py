@@ -0,0 +1,132 @@
+import calendar
+import logging
+import src.slack_app as slack
+import src.tasks.member_management as membership_tasks
+
+from slack_sdk.errors import SlackApiError
+from slack_sdk.webhook import WebhookClient
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.db import crud, database
+from task_runner import celery
+
+
+logger = logging.getLogger(__name__)
+
+
+@celery.task
+def run_smores_command(
+    action: str, argument: str, channel_id: str, team_id: str, enterprise_id: str, user_id: str, response_url: str
+):
+    """
+    Run a `/smores` action that needs the database or Slack, out of the request that was acked.
+
+    Args:
+        action (str): One of enable, disable, exclude, opt_out, group_size or schedule
+        argument (str): The last word of the command, the user to exclude or the group size,
+            or the number of the day of the week and the hour to schedule
+        channel_id (str): The ID of the Slack channel the command was run in
+        team_id (str): The ID of the Slack team/workspace
+        enterprise_id (str): The ID of the Slack enterprise
+        user_id (str): The ID of the Slack user who ran the command
+        response_url (str): The URL the results are posted to, valid for 30 minutes after the command
+
+    The command isn't retried, a failure is reported back to the user so they can run it again.
+    """
+    fields = {"action": action, "channel": channel_id, "team_id": team_id, "user": user_id}
+    try:
+        if action in ["enable", "disable"]:
+            _handle_activation(action, channel_id, team_id, enterprise_id, user_id, response_url)
+        elif action in ["opt_out"]:
+            _remove_from_channel(user_id, channel_id, team_id)
+            _respond(response_url, "You are now opted out from pairings in this channel. Use `opt_in` command to rejoin.")
+        elif action in ["exclude"]:
+            if _remove_from_channel(argument, channel_id, team_id):
+                _respond(response_url, f"User <@{argument}> as been removed from pairings.")
+            else:
+                _respond(response_url, f"User <@{argument}> not found in the channel pairings.")
+        elif action in ["group_size"]:
+            _handle_group_size(int(argument), channel_id, team_id, response_url)
+        elif action in ["schedule"]:
+            day, hour = (int(value) for value in argument.split())
+            _handle_schedule(day, hour, channel_id, team_id, enterprise_id, user_id, response_url)
+        else:
+            raise ValueError(f"unknown action {action}")
+    except SlackApiError as e:
+        logger.warning("slack call of the command failed", extra={**fields, "error": e.response.get("error")})
+        _respond(response_url, f"Slack couldn't complete `{action}` right now, please try again.")
+    except SQLAlchemyError:
+        logger.exception("database error handling the command", extra=fields)
+        _respond(response_url, f"Something went wrong running `{action}`, please try again.")
+
+
+def _handle_activation(action, channel_id, team_id, enterprise_id, user_id, response_url):
+    sc = slack.get_slack_client(enterprise_id, team_id)
+    try:
+        sc.conversations_info(channel=channel_id)
+    except SlackApiError as e:
+        if e.response.data["error"] != "channel_not_found":
+            raise
+        _respond(response_url, "For private channels, please add the bot user to the channel first")
+        return
+
+    with database.SessionLocal() as db:
+        channel = crud.get_channel(db, channel_id, team_id)
+
+        if channel is None and action == "enable":
+            timezone = _user_timezone(sc, user_id)
+            crud.add_channel(db, channel_id, team_id, enterprise_id, timezone)
+            membership_tasks.cache_channel_members.delay(channel_id, team_id, enterprise_id)
+        elif channel is None:
+            _respond(response_url, "S'mores is not enabled in this channel.")
+            return
+        else:
+            crud.set_channel_active(db, channel, action == "enable")
+
+    _respond(response_url, f"S'mores fireside chats {action}d", in_channel=True)
+
+
+def _user_timezone(sc, user_id):
+    # channels are scheduled in the timezone of whoever enabled them
+    try:
+        return sc.users_info(user=user_id).data["user"].get("tz") or "UTC"
+    except SlackApiError:
+        logger.warning("could not get the timezone of the user", exc_info=True)
+        return "UTC"
+
+
+def _handle_group_size(group_size, channel_id, team_id, response_url):
+    with database.SessionLocal() as db:
+        channel = crud.get_channel(db, channel_id, team_id)
+        if channel is None:
+            _respond(response_url, "S'mores is not enabled in this channel, use `enable` first.")
+            return
+        crud.set_channel_group_size(db, channel, group_size)
+
+    _respond(response_url, f"Conversations will now be sent to groups of {group_size}.")
+
+
+def _handle_schedule(day, hour, channel_id, team_id, enterprise_id, user_id, response_url):
+    with database.SessionLocal() as db:
+        channel = crud.get_channel(db, channel_id, team_id)
+        if channel is None:
+            _respond(response_url, "S'mores is not enabled in this channel, use `enable` first.")
+            return
+        # the slot is in the timezone of whoever scheduled it, the same as when the channel is enabled
+        timezone = _user_timezone(slack.get_slack_client(enterprise_id, team_id), user_id)
+        crud.set_channel_schedule(db, channel, day, hour, timezone)
+
+    _respond(
+        response_url,
+        f"Conversations will now be sent on {calendar.day_name[day]}s at {hour}:00 ({timezone}).",
+        in_channel=True,
+    )
+
+
+def _remove_from_channel(member_id, channel_id, team_id):
+    with database.SessionLocal() as db:
+        return crud.delete_member(db, member_id, channel_id, team_id) > 0
+
+
+def _respond(response_url, text, in_channel=False):
+    WebhookClient(response_url).send(text=text, response_type="in_channel" if in_channel else "ephemeral")
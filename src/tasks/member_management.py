@@ -1,18 +1,28 @@
+import settings
+import asyncio
 import logging
-import time
-import src.helpers as helpers
+import aiohttp
 import src.slack_app as slack
 
+from typing import Iterator, List, Set, Tuple
+from datetime import datetime, timedelta
 from slack_sdk.errors import SlackApiError
 
-from src.db import crud, models, database
+from src.db import crud, database, leases, member_events
 from task_runner import celery
 
 
 logger = logging.getLogger(__name__)
 
+# a member sync checkpoint not updated for this long is dropped instead of resumed
+MEMBER_SYNC_EXPIRY = timedelta(hours=1)
+# members joining at once who aren't in the workspace users index are looked up one by one up to this many,
+# past that the whole index is rebuilt from users.list which returns 200 users a call
+USERS_INFO_LOOKUP_LIMIT = 200
+
 
 @celery.task(autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+@leases.leased(key=lambda channel_id, team_id, enterprise_id: f"{team_id}:{channel_id}")
 def cache_channel_members(channel_id, team_id, enterprise_id):
     """
     Cache all members of a Slack channel in the database.
@@ -23,36 +33,39 @@ def cache_channel_members(channel_id, team_id, enterprise_id):
         enterprise_id (str): The ID of the Slack enterprise
         
     This function:
-    1. Fetches all members from the Slack channel
-    2. Compares with locally cached members
-    3. Saves new members to the database
+    1. Streams the members of the Slack channel page by page, resuming from the
+       checkpoint of an interrupted sync if there is one
+    2. Saves the members missing from the local cache with a single insert per page
+    3. Deletes the cached members that are no longer in the channel with a single delete
     4. Triggers a task to exclude bots from cached users
     """
     sc = slack.get_slack_client(enterprise_id, team_id)
+    lease_token = leases.current_token()
     with database.SessionLocal() as db:
-        members_data = sc.conversations_members(channel=channel_id, limit=200).data
-        local_members = crud.get_cached_channel_member_ids(db, channel_id, team_id)
-        members = helpers.generate_member_model_list(
-            members_data["members"], local_members, channel_id, team_id
-        )
-
-        next_cursor = members_data["response_metadata"]["next_cursor"]
-        while next_cursor:
-            members_data = sc.conversations_members(channel=channel_id, limit=200, cursor=next_cursor).data
-            members += helpers.generate_member_model_list(
-                members_data["members"], local_members, channel_id, team_id
-            )
+        channel = crud.get_channel(db, channel_id, team_id)
+        sync = crud.get_or_start_member_sync(db, channel_id, team_id)
+        if sync.updated_on < datetime.utcnow() - MEMBER_SYNC_EXPIRY:
+            # slack's cursors don't stay valid forever, start an abandoned sync over
+            leases.ensure_fenced(crud.delete_member_sync(db, sync, lease_token))
+            sync = crud.get_or_start_member_sync(db, channel_id, team_id)
+        local_members = set(crud.get_cached_channel_member_ids(db, channel_id, team_id))
+        seen_members = set(sync.seen_member_ids)
 
-            next_cursor = members_data["response_metadata"]["next_cursor"]
+        # a sync resumed from its cursor can't start over from the first page
+        if sync.cursor or not seen_members:
+            for page, next_cursor in iter_channel_member_pages(sc, channel_id, sync.cursor):
+                leases.ensure_held()
+                crud.add_members_if_not_exist(db, [m for m in page if m not in local_members], channel)
+                leases.ensure_fenced(crud.save_member_sync_progress(db, sync, page, next_cursor, lease_token))
+                seen_members.update(page)
 
-        db.bulk_save_objects(members)
-        db.commit()
+        crud.delete_members(db, local_members - seen_members, channel)
+        leases.ensure_fenced(crud.delete_member_sync(db, sync, lease_token))
 
         # run the task to check if any of the users were bots and remove them
         exclude_bots_from_cached_users.delay(channel_id, team_id, enterprise_id)
 
 
-
 @celery.task
 def exclude_bots_from_cached_users(channel_id: str, team_id: str, enterprise_id: str):
     """
@@ -65,18 +78,18 @@ def exclude_bots_from_cached_users(channel_id: str, team_id: str, enterprise_id:
         
     This function:
     1. Gets all cached members for the channel
-    2. Checks each member's user info from Slack
-    3. Removes any members that are identified as bots
+    2. Looks them up in the workspace's index of bots and deactivated users
+    3. Removes any members that are identified as bots or deactivated
     """
     with database.SessionLocal() as db:
-        sc = slack.get_slack_client(enterprise_id, team_id)
+        channel = crud.get_channel(db, channel_id, team_id)
+        if channel is None:
+            # the channel was removed since the task was queued
+            return
+
+        excluded_users = get_excluded_user_ids(db, team_id, enterprise_id)
         members = crud.get_cached_channel_member_ids(db, channel_id, team_id)
-        for member in members:
-            user_data = sc.users_info(user=member).data
-            if user_data["user"]["is_bot"]:
-                # TODO: handle 429 errors from slack api
-                time.sleep(1.2)
-                crud.delete_member(db, member, channel_id, team_id)
+        crud.delete_members(db, excluded_users.intersection(members), channel)
 
 
 @celery.task(autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 5})
@@ -91,7 +104,7 @@ def add_member_to_db(member_id: str, channel_id: str, team_id: str):
         
     This function:
     1. Verifies the channel exists
-    2. Checks if the user is a bot
+    2. Checks if the user is a bot, from the workspace users index or Slack if the user isn't indexed yet
     3. Adds the member to the database if they don't exist
     4. Sends a welcome message to the user if they were added
     """
@@ -100,50 +113,159 @@ def add_member_to_db(member_id: str, channel_id: str, team_id: str):
         if not channel:
             return
         sc = slack.get_slack_client(channel.enterprise_id, team_id)
-        user_data = sc.users_info(user=member_id).data
+        user = crud.get_workspace_user(db, team_id, member_id)
+        if user is None:
+            user_data = sc.users_info(user=member_id).data
+            crud.save_workspace_users(db, team_id, [user_data["user"]])
+            user = crud.get_workspace_user(db, team_id, member_id)
         fields = {
             "user": member_id,
             "channel": channel_id,
             "team_id": team_id,
         }
-        if user_data["user"]["is_bot"]:
-            logger.warn("user is a bot", extra=fields)
+        if user.is_bot or user.is_deleted:
+            logger.warn("user is a bot or deactivated", extra=fields)
             return
         result = crud.add_member_if_not_exists(db, member_id, channel)
         if result < 1:
             logger.warning("no user inserted", extra=fields)
         else:
-            sc.chat_postMessage(
-                channel=member_id,
-                text=f"You're opted into S'mores chat since you joined the channel <#{channel_id}>. If you do not want to participate in pairings while staying the channel then you can run command `/smores opt_out` in the channel.",
-            )
+            sc.chat_postMessage(channel=member_id, text=_welcome_message(channel_id))
+
+
+@celery.task(autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+def apply_member_events(channel_id: str, team_id: str):
+    """
+    Apply the members who joined and left a channel since the last flush of its buffered events.
+
+    Args:
+        channel_id (str): The ID of the Slack channel
+        team_id (str): The ID of the Slack team/workspace
+
+    This function:
+    1. Takes the buffered events of the channel, the latest one of each member
+    2. Deletes the members who left with a single delete
+    3. Looks up the members who joined in the workspace users index, indexing those missing from it
+    4. Adds the members who joined, except bots and deactivated users, with a single insert
+    5. Sends a welcome message to the members who were added, through the rate limited client
+
+    Flushes of a channel hold a lease so that they can't apply its events out of order, a flush
+    started while another one runs is pushed back.
+    """
+    with leases.hold_lease(f"{__name__}.apply_member_events:{team_id}:{channel_id}") as lease:
+        if lease is None:
+            apply_member_events.apply_async((channel_id, team_id), countdown=settings.MEMBER_EVENTS_FLUSH_SECONDS)
+            return
+
+        _apply_member_events(channel_id, team_id)
+
+
+@celery.task
+@leases.leased()
+def flush_stale_member_events():
+    """Schedule a flush of the channels whose buffered events were left behind by a flush that was lost or failed."""
+    for channel_id, team_id in member_events.claim_unflushed_channels():
+        logger.info("flushing stale member events", extra={"channel": channel_id, "team": team_id})
+        apply_member_events.delay(channel_id, team_id)
+
+
+def _apply_member_events(channel_id: str, team_id: str):
+    events = member_events.take_member_events(channel_id, team_id)
+    if not events:
+        return
+
+    try:
+        with database.SessionLocal() as db:
+            channel = crud.get_channel(db, channel_id, team_id)
+            if not channel:
+                return
+
+            left = {m for m, event in events.items() if event == member_events.LEFT}
+            removed = crud.delete_members(db, left, channel)
+
+            enterprise_id = channel.enterprise_id
+            joined = [m for m, event in events.items() if event == member_events.JOINED]
+            pairable = get_pairable_user_ids(db, joined, team_id, enterprise_id)
+            added = crud.add_members_if_not_exist(db, pairable, channel)
+    except Exception:
+        member_events.restore_member_events(channel_id, team_id, events)
+        raise
+
+    fields = {
+        "channel": channel_id,
+        "team_id": team_id,
+        "joined": len(joined),
+        "added": len(added),
+        "left": len(left),
+        "removed": removed,
+    }
+    logger.info("member events applied", extra=fields)
+
+    if added:
+        asyncio.run(_send_welcome_messages(enterprise_id, team_id, channel_id, added))
 
 
 @celery.task
+@leases.leased()
 def remove_disabled_users():
     """
     Remove users from the database who are no longer in their respective Slack channels.
-    
+
+    This function starts a reconciliation run and queues a shard task for each workspace,
+    so that workspaces are reconciled in parallel while each workspace's calls stay within
+    its own slack rate limits.
+    """
+    with database.SessionLocal() as db:
+        shard_ids = crud.start_reconciliation_run(db)
+
+    for shard_id in shard_ids:
+        reconcile_workspace_members.delay(shard_id)
+
+
+@celery.task(acks_late=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 5})
+@leases.leased(key=lambda shard_id: shard_id)
+def reconcile_workspace_members(shard_id: int):
+    """
+    Remove users who left the channels of a workspace as part of a reconciliation run.
+
+    Args:
+        shard_id (int): The ID of the reconciliation shard of the workspace
+
     This function:
-    1. Gets all channels from the database
+    1. Goes through the workspace's channels after the last one the shard reconciled
     2. For each channel, checks for members who have left
-    3. Removes those members from the database
+    3. Removes those members from the database in a single delete and saves the shard's progress,
+       so a retried or redelivered task resumes from the next channel
+    4. Logs the duration and counts of the run once its last shard finishes
     """
+    lease_token = leases.current_token()
     with database.SessionLocal() as db:
-        channels: list[models.Channels] = db.query(models.Channels).all()
-        removed_members_in_channel = {}
+        shard = crud.get_reconciliation_shard(db, shard_id)
+        if shard is None or shard.finished_on is not None:
+            return
 
-        for c in channels:
-            time.sleep(1)
+        for c in crud.get_workspace_channels(db, shard.team_id, shard.last_channel_id):
+            leases.ensure_held()
             try:
-                removed_members_in_channel[c.channel_id] = get_members_drift(c.channel_id, c.team_id, c.enterprise_id)
+                diff = get_members_drift(c.channel_id, c.team_id, c.enterprise_id)
             except SlackApiError:
                 logger.exception("Error getting members drift")
+                leases.ensure_fenced(crud.save_reconciliation_progress(db, shard, c.id, 0, True, lease_token))
+                continue
+
+            removed = crud.delete_members(db, diff["removed_on_slack"], c)
+            leases.ensure_fenced(crud.save_reconciliation_progress(db, shard, c.id, removed, lease_token=lease_token))
 
-        for c in channels:
-            diff = removed_members_in_channel.get(c.channel_id, {})
-            for removed in diff.get('removed_on_slack', []):
-                crud.delete_member(db, removed, c.channel_id, c.team_id)
+        run = crud.finish_reconciliation_shard(db, shard, lease_token)
+        if run is not None:
+            fields = {
+                "run": run.id,
+                "duration_seconds": (run.finished_on - run.started_on).total_seconds(),
+                "channels_reconciled": run.channels_reconciled,
+                "channels_failed": run.channels_failed,
+                "members_removed": run.members_removed,
+            }
+            logger.info("members reconciliation finished", extra=fields)
 
 
 def get_slack_members_list(channel_id, team_id, enterprise_id, exclude_bots=True):
@@ -160,43 +282,43 @@ def get_slack_members_list(channel_id, team_id, enterprise_id, exclude_bots=True
         set: A set of member IDs in the channel, excluding bots if exclude_bots is True
         
     Note:
-        This function handles pagination and rate limiting from the Slack API
+        This function handles pagination, rate limiting is handled by the slack client's dispatcher
     """
     sc = slack.get_slack_client(enterprise_id, team_id)
-    members_data = sc.conversations_members(channel=channel_id, limit=200).data
+    members = []
+    for page, _ in iter_channel_member_pages(sc, channel_id):
+        members += page
 
-    members = members_data["members"]
-    next_cursor = members_data["response_metadata"]["next_cursor"]
-    while next_cursor:
-        members_data = sc.conversations_members(channel=channel_id, limit=200, cursor=next_cursor).data
-        members += members_data["members"]
+    if exclude_bots:
+        with database.SessionLocal() as db:
+            members = set(members) - get_excluded_user_ids(db, team_id, enterprise_id)
 
-        next_cursor = members_data["response_metadata"]["next_cursor"]
+    return members
 
-    bots = []
-    if exclude_bots:
-        i = 0
-        while i < len(members):
-            member = members[i]
-            try:
-                user_data = sc.users_info(user=member).data
-                if user_data["user"]["is_bot"]:
-                    bots.append(member)
-            except SlackApiError as e:
-                if s := e.response.headers["retry-after"]:
-                    time.sleep(2 * int(s))
-                else:
-                    time.sleep(10)
-                continue
-            except Exception as e:
-                logger.exception(e)
-                return
 
-            i += 1
+def iter_channel_member_pages(sc, channel_id, cursor=None) -> Iterator[Tuple[List[str], str]]:
+    """
+    Stream the members of a Slack channel one page at a time.
 
-        members = set(members) - set(bots)
+    Args:
+        sc: The slack client of the workspace
+        channel_id (str): The ID of the Slack channel
+        cursor (str, optional): Cursor of the page to start from, the first page if not set
 
-    return members
+    Yields:
+        tuple: The member IDs of a page and the cursor of the next page, empty on the last page
+    """
+    while True:
+        if cursor:
+            members_data = sc.conversations_members(channel=channel_id, limit=200, cursor=cursor).data
+        else:
+            members_data = sc.conversations_members(channel=channel_id, limit=200).data
+        cursor = members_data["response_metadata"]["next_cursor"]
+
+        yield members_data["members"], cursor
+
+        if not cursor:
+            return
 
 
 def get_members_drift(channel_id, team_id, enterprise_id):
@@ -222,3 +344,91 @@ def get_members_drift(channel_id, team_id, enterprise_id):
         "new_on_slack": set(slack_members) - set(cached_members),
         "removed_on_slack": set(cached_members) - set(slack_members),
     }
+
+
+def get_pairable_user_ids(db, user_ids, team_id, enterprise_id) -> List[str]:
+    """
+    Get the users who are neither bots nor deactivated among the given users of a workspace.
+
+    Args:
+        db: The database session
+        user_ids (list): The IDs of the Slack users
+        team_id (str): The ID of the Slack team/workspace
+        enterprise_id (str): The ID of the Slack enterprise
+
+    Returns:
+        list: The user IDs that can be paired, in the given order
+
+    Note:
+        Users missing from the workspace users index are looked up with users.info, or with
+        users.list when there are more than USERS_INFO_LOOKUP_LIMIT of them
+    """
+    if not user_ids:
+        return []
+
+    users = {u.user_id: u for u in crud.get_workspace_users(db, team_id, user_ids)}
+    unknown = [u for u in user_ids if u not in users]
+    if len(unknown) > USERS_INFO_LOOKUP_LIMIT:
+        sync_workspace_users(db, team_id, enterprise_id)
+    elif unknown:
+        sc = slack.get_slack_client(enterprise_id, team_id)
+        crud.save_workspace_users(db, team_id, [sc.users_info(user=u).data["user"] for u in unknown])
+    if unknown:
+        users = {u.user_id: u for u in crud.get_workspace_users(db, team_id, user_ids)}
+
+    return [u for u in user_ids if u in users and not users[u].is_bot and not users[u].is_deleted]
+
+
+def get_excluded_user_ids(db, team_id, enterprise_id) -> Set[str]:
+    """
+    Get the ids of the bots and deactivated users of a workspace.
+
+    Args:
+        db: The database session
+        team_id (str): The ID of the Slack team/workspace
+        enterprise_id (str): The ID of the Slack enterprise
+
+    Returns:
+        set: The user IDs that should not be paired
+
+    Note:
+        The index is kept up to date by `user_change` events and rebuilt with users.list
+        when it has not been synced for WORKSPACE_USERS_REFRESH_DAYS
+    """
+    synced_on = crud.get_workspace_users_synced_on(db, team_id)
+    if synced_on is None or synced_on < datetime.utcnow() - timedelta(days=settings.WORKSPACE_USERS_REFRESH_DAYS):
+        sync_workspace_users(db, team_id, enterprise_id)
+
+    return crud.get_excluded_user_ids(db, team_id)
+
+
+def sync_workspace_users(db, team_id, enterprise_id):
+    """Index all users of a workspace, page by page from users.list."""
+    sc = slack.get_slack_client(enterprise_id, team_id)
+    synced_on = datetime.utcnow()
+    users_data = sc.users_list(limit=200).data
+    crud.save_workspace_users(db, team_id, users_data["members"], synced_on)
+
+    next_cursor = users_data["response_metadata"]["next_cursor"]
+    while next_cursor:
+        users_data = sc.users_list(limit=200, cursor=next_cursor).data
+        crud.save_workspace_users(db, team_id, users_data["members"], synced_on)
+
+        next_cursor = users_data["response_metadata"]["next_cursor"]
+
+
+async def _send_welcome_messages(enterprise_id, team_id, channel_id, member_ids):
+    async with aiohttp.ClientSession() as session:
+        client = slack.get_async_slack_client(enterprise_id, team_id, session)
+        await asyncio.gather(*(_send_welcome_message(client, channel_id, m) for m in member_ids))
+
+
+async def _send_welcome_message(client, channel_id, member_id):
+    try:
+        await client.chat_postMessage(channel=member_id, text=_welcome_message(channel_id))
+    except Exception:
+        logger.exception("error sending welcome message", extra={"user": member_id, "channel": channel_id})
+
+
+def _welcome_message(channel_id):
+    return f"You're opted into S'mores chat since you joined the channel <#{channel_id}>. If you do not want to participate in pairings while staying the channel then you can run command `/smores opt_out` in the channel."
@@ -0,0 +1,23 @@
+import logging
+
+from src.db import queue_metrics
+from task_runner import celery, queue_names, BULK, INTERACTIVE, LEGACY_QUEUE, SCHEDULED
+
+
+logger = logging.getLogger(__name__)
+
+
+@celery.task
+def report_queue_metrics():
+    """Log the depth and latency of every task queue, to size the worker pool of each class of work."""
+    metrics = get_queue_metrics()
+    for queue in metrics:
+        logger.info("queue metrics", extra=queue)
+
+    return metrics
+
+
+def get_queue_metrics():
+    return queue_metrics.get_queue_metrics(
+        [name for queue_class in (INTERACTIVE, BULK, SCHEDULED) for name in queue_names(queue_class)] + [LEGACY_QUEUE]
+    )
@@ -1,204 +1,288 @@
+import asyncio
 import logging
 import random
-import os
-import time
+import aiohttp
 import src.constants as constants
 import src.helpers as helpers
 import src.slack_app as slack
 
 
-from sqlalchemy import and_
+from typing import List, NamedTuple, Set
 from datetime import datetime, timedelta
+from slack_sdk.errors import SlackApiError
 
-from src.db import crud, models, database
+from src.db import crud, models, database, locks, leases
 from task_runner import celery
 
 
 logger = logging.getLogger(__name__)
 
+# channels claimed per query by the scheduler, and how long a claimed channel is kept from being claimed again
+PAIRING_CLAIM_BATCH_SIZE = 100
+PAIRING_CLAIM_LEASE = timedelta(hours=1)
+# intros of conversations older than this aren't worth sending anymore
+INTRO_RETRY_PERIOD = timedelta(weeks=1)
+# metadata event type carrying the idempotency key of an intro
+INTRO_EVENT_TYPE = "smores_intro"
+# number of latest messages of a group DM searched for an intro that was already sent
+INTRO_HISTORY_LIMIT = 20
+# members who met longer ago than this are paired as if they never met
+PAIR_HISTORY_HORIZON = timedelta(weeks=26)
+
+
+class IntroDelivery(NamedTuple):
+    """What's needed to send the intro of a pair, read before the transaction is closed."""
+
+    pair_id: int
+    channel_id: str
+    member_ids: List[str]
+    status: str
+    dm_channel_id: str | None
+
 
 @celery.task
+@leases.leased()
 def match_pairs_periodic():
-    # TODO: allow configuring of which day to start conversations on per channel basis
-    # TODO: If another task starts while previous one is already running that can potentially add issues, use mutex to prevent that. Currently not an issue because running on a single process.
-    # Instead of start sending messages at sunday night, this makes the day start at 9am EST. TODO: Make it configurable per channel
-    if datetime.utcnow().weekday() != int(os.environ.get("CONVERSATION_DAY", 0)):
-        return
+    # runs every hour, channels come due in their own weekly slot so the pairing is spread across the week
 
-    with database.SessionLocal() as db:
-        while True:
-            channels = crud.get_channels_eligible_for_pairing(db, 10)
-            if len(channels) == 0:
-                break
-            for channel in channels:
-                generate_and_send_conversations(channel, db)
+    # only schedule the work here so that channels are paired in parallel by the workers, claimed
+    # channels are pushed out of the due range so every batch picks up new ones
+    while True:
+        with database.SessionLocal() as db:
+            channels = crud.claim_channels_due_for_pairing(db, PAIRING_CLAIM_BATCH_SIZE, PAIRING_CLAIM_LEASE)
+
+        for channel in channels:
+            generate_channel_conversations.delay(channel.id, channel.team_id)
+
+        if len(channels) < PAIRING_CLAIM_BATCH_SIZE:
+            return
+        leases.ensure_held()
+
+
+@celery.task
+def generate_channel_conversations(id: int, team_id: str):
+    """
+    Pair the members of a channel and send the intros if the channel is still due.
+
+    Args:
+        id (int): The primary key of the channel
+        team_id (str): The ID of the Slack team/workspace of the channel, the task is queued by it
+
+    A channel can get queued again by the next scheduler run before its task is picked up,
+    so the channel is locked and its eligibility checked again before any pairs are sent.
+    """
+    with locks.channel_lock(id) as acquired:
+        if not acquired:
+            logger.info("channel is already being paired", extra={"channel": id, "team_id": team_id})
+            return
+
+        with database.SessionLocal() as db:
+            channel = crud.get_channel_if_eligible_for_pairing(db, id)
+            if channel is None:
+                return
+
+            generate_and_send_conversations(channel, db)
 
 
 @celery.task
-def force_generate_conversations(channel_id):
+def force_generate_conversations(channel_id: str, team_id: str):
     with database.SessionLocal() as db:
-        channel = db.query(models.Channels).where(models.Channels.channel_id == channel_id).first()
+        channel = crud.get_channel(db, channel_id, team_id)
         if channel is None:
             return
 
-        generate_and_send_conversations(channel, db)
+        with locks.channel_lock(channel.id) as acquired:
+            if not acquired:
+                logger.info("channel is already being paired", extra={"channel": channel.id})
+                return
+
+            generate_and_send_conversations(channel, db)
 
 
 @celery.task
+@leases.leased()
 def send_failed_intros():
     with database.SessionLocal() as db:
-        pending_intros = (
-            db.query(models.ChannelConversations)
-            .where(
-                and_(
-                    models.ChannelConversations.sent_on == None,
-                    models.ChannelConversations.conversations["status"].astext == "PARTIALLY_SENT",
-                )
-            )
-            .all()
-        )
-        for intro in pending_intros:
-            enterprise_id = crud.get_enterprise_id(db, intro.team_id, intro.channel_id)
-            client = slack.get_slack_client(enterprise_id, intro.team_id)
-
-            all_convos_sent = True
-            for conv in intro.conversations["pairs"]:
-                if conv["status"] != "GENERATED":
-                    continue
-                # TODO: handle 429 errors from slack api
-                time.sleep(1.2)
-                try:
-                    response = client.conversations_open(users=conv["pair"])
-                    client.chat_postMessage(
-                        text=_intro_message(intro.channel_id, conv["pair"]),
-                        channel=response.data["channel"]["id"],
+        created_after = datetime.utcnow().date() - INTRO_RETRY_PERIOD
+        for conversations in crud.iter_unsent_conversations(db, created_after):
+            leases.ensure_held()
+            # channels are locked while their intros are sent, which skips conversations still being sent the first time
+            with locks.channel_locks(c.channel_pk for c in conversations) as locked:
+                conversation_ids = [c.id for c in conversations if c.channel_pk in locked]
+                if conversation_ids:
+                    send_conversation_intros(
+                        db, conversations[0].enterprise_id, conversations[0].team_id, conversation_ids
                     )
-                    conv["status"] = "INTRO_SENT"
-                    conv["channel_id"] = response.data["channel"]["id"]
-                except Exception:
-                    all_convos_sent = False
-                    logger.exception("error opening conversation")
 
-            if all_convos_sent:
-                intro.conversations["status"] = "INTRO_SENT"
-                intro.sent_on = datetime.utcnow().date()
-            else:
-                intro.conversations["status"] = "PARTIALLY_SENT"
 
-            db.commit()
+@celery.task
+@leases.leased()
+def send_midpoint_reminder():
+    with database.SessionLocal() as db:
+        intro_sent_on = datetime.utcnow().date() - timedelta(8)
+        for pairs in crud.iter_pairs_pending_midpoint_reminder(db, intro_sent_on):
+            leases.ensure_held()
+            asyncio.run(_send_midpoint_reminders(pairs[0].enterprise_id, pairs[0].team_id, pairs))
 
 
 @celery.task
-def send_midpoint_reminder():
+@leases.leased()
+def report_pairing_load(hours: int = 7 * 24):
+    """Log the number of channels and members due for pairing in each of the next `hours` hours."""
+    start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
     with database.SessionLocal() as db:
-        midpoint_convos = (
-            db.query(models.ChannelConversations)
-            .where(
-                and_(
-                    models.ChannelConversations.conversations.op("->")("midpoint_status") == None,
-                    models.ChannelConversations.sent_on == datetime.utcnow().date() - timedelta(8),
-                )
-            )
-            .all()
+        load = crud.get_projected_pairing_load(db, start, start + timedelta(hours=hours))
+
+    for row in load:
+        logger.info(
+            "projected pairing load",
+            extra={"hour": row.hour.isoformat(), "channels": row.channels, "members": row.members},
         )
 
-        for intro in midpoint_convos:
-            enterprise_id = crud.get_enterprise_id(db, intro.team_id, intro.channel_id)
-            client = slack.get_slack_client(enterprise_id, intro.team_id)
-
-            all_convos_sent = True
-            for conv in intro.conversations["pairs"]:
-                if conv["status"] != "INTRO_SENT" or "midpoint_sent_on" in conv:
-                    continue
-                time.sleep(1.2)
-                try:
-                    client.chat_postMessage(
-                        text=":wave: Mid point reminder - if you haven't met yet, make it happen!",
-                        channel=conv["channel_id"],
-                    )
-                    conv["midpoint_sent_on"] = datetime.utcnow().date().isoformat()
-                except Exception:
-                    all_convos_sent = False
-                    logger.exception("error sending midpoint")
+    return {row.hour.isoformat(): {"channels": row.channels, "members": row.members} for row in load}
 
-            intro.conversations["midpoint_status"] = "SENT" if all_convos_sent else "PARTIALLY_SENT"
-            db.commit()
+
+@celery.task
+@leases.leased()
+def prune_pair_history():
+    """Delete the pair history older than the horizon, it's no longer used to tell who met recently."""
+    with database.SessionLocal() as db:
+        deleted = crud.delete_pair_history(db, datetime.utcnow().date() - PAIR_HISTORY_HORIZON)
+
+    logger.info("pruned the pair history", extra={"pairs": deleted})
 
 
 def generate_and_send_conversations(channel, db):
-    conv_pairs = create_conversation_pairs(channel, db)
-    if not conv_pairs:
+    # the channel is marked as paired along with its pairs before anything is sent, pairs whose intro fails
+    # are picked up by send_failed_intros
+    conversation = create_conversation_pairs(channel, db)
+    if not conversation:
         return
 
-    client = slack.get_slack_client(channel.enterprise_id, channel.team_id)
-    all_convos_sent = True
-    for conv_pair in conv_pairs.conversations.get("pairs", []):
-        # TODO: handle 429 errors from slack api
-        time.sleep(1.2)
-        try:
-            response = client.conversations_open(users=conv_pair["pair"])
-            client.chat_postMessage(
-                text=_intro_message(channel.channel_id, conv_pair["pair"]),
-                channel=response.data["channel"]["id"],
-            )
-            conv_pair["status"] = "INTRO_SENT"
-            conv_pair["channel_id"] = response.data["channel"]["id"]
-        except Exception:
-            all_convos_sent = False
-            logger.exception("error opening conversation")
-
-    channel.last_sent_on = datetime.utcnow().date()
-    if all_convos_sent:
-        conv_pairs.conversations["status"] = "INTRO_SENT"
-        conv_pairs.sent_on = datetime.utcnow().date()
-    else:
-        conv_pairs.conversations["status"] = "PARTIALLY_SENT"
+    send_conversation_intros(db, channel.enterprise_id, channel.team_id, [conversation.id])
+
 
+def send_conversation_intros(db, enterprise_id, team_id, conversation_ids) -> Set[int]:
+    """
+    Send the intros of the pairs still waiting on theirs in conversations of the same workspace.
+
+    Each pair goes GENERATED -> OPENED -> INTRO_SENT and every step is committed on its own as soon
+    as it's done, so a worker dying halfway only loses the step it was on. No transaction is held
+    open while slack is called.
+
+    Returns:
+        set: The ids of the conversations whose intros have all been sent
+    """
+    deliveries = [
+        IntroDelivery(p.id, p.channel_id, p.member_ids, p.status, p.dm_channel_id)
+        for p in crud.get_unsent_pairs(db, conversation_ids)
+    ]
     db.commit()
 
+    asyncio.run(_send_intros(enterprise_id, team_id, deliveries))
+
+    return crud.finish_conversation_intros(db, conversation_ids)
+
 
 def create_conversation_pairs(channel: models.Channels, db):
-    members_list = channel.members_circle
-    if not members_list or len(members_list) == 0:
-        members_list = crud.get_cached_channel_member_ids(
-            db, channel.channel_id, channel.team_id, opted_users_only=True
-        )
+    members_list = crud.get_rotation_member_ids(db, channel)
 
-    installation = database.installation_store.find_installation(
-        enterprise_id=channel.enterprise_id, team_id=channel.team_id
-    )
+    installation = slack.get_installation(channel.enterprise_id, channel.team_id)
 
     if installation.bot_user_id in members_list:
         members_list.remove(installation.bot_user_id)
 
     if len(members_list) < 2:
-        channel.last_sent_on = datetime.utcnow().date()
-        db.commit()
+        crud.set_channel_last_sent_on(db, channel, datetime.utcnow().date())
         return
 
-    # For even number of people, the round robin tournament will match everyone at least once
-    # by using the circle method: https://en.wikipedia.org/wiki/Round-robin_tournament#Circle_method
-    # Because this works with even numbers only, for odd number ones - one member is randomly
-    # removed and they are added to one of the pairs generated randomly
+    today = datetime.utcnow().date()
+    last_met = crud.get_pair_history(db, channel, today - PAIR_HISTORY_HORIZON)
+    groups = helpers.group_members(
+        members_list, channel.group_size, channel.rotation_round, last_met, today, PAIR_HISTORY_HORIZON.days
+    )
+
+    channel.rotation_round += 1
+    return crud.save_channel_conversations(db, channel, groups)
 
-    count = len(members_list)
-    excluded_member = ""
-    if count % 2 != 0:
-        random_member_to_remove = random.randrange(count)
-        excluded_member = members_list[random_member_to_remove]
-        del members_list[random_member_to_remove]
 
-    pairs, members_circle = helpers.round_robin_match(members_list)
+async def _send_intros(enterprise_id, team_id, deliveries):
+    """Open the group DMs and send the intro for each conversation pair concurrently."""
+    async with aiohttp.ClientSession() as session:
+        client = slack.get_async_slack_client(enterprise_id, team_id, session)
+        await asyncio.gather(*(_send_intro(client, d) for d in deliveries))
 
-    if excluded_member:
-        random_pair = random.randrange(count // 2)
-        pairs[random_pair].append(excluded_member)
-        members_circle.insert(1, excluded_member)
 
-    conversations = crud.save_channel_conversations(db, channel, pairs)
-    channel.members_circle = members_circle
-    db.commit()
-    return conversations
+async def _send_intro(client, delivery):
+    idempotency_key = _intro_idempotency_key(delivery.pair_id)
+    try:
+        dm_channel_id = delivery.dm_channel_id
+        if delivery.status == "GENERATED":
+            response = await client.conversations_open(users=delivery.member_ids)
+            dm_channel_id = response.data["channel"]["id"]
+            await _save_pair_progress(crud.mark_pair_opened, delivery.pair_id, dm_channel_id)
+        elif await _is_intro_posted(client, dm_channel_id, idempotency_key):
+            # the intro went out but the worker stopped before recording it
+            await _save_pair_progress(crud.mark_pair_intro_sent, delivery.pair_id)
+            return
+
+        await client.chat_postMessage(
+            text=_intro_message(delivery.channel_id, delivery.member_ids),
+            channel=dm_channel_id,
+            metadata={"event_type": INTRO_EVENT_TYPE, "event_payload": {"idempotency_key": idempotency_key}},
+        )
+        await _save_pair_progress(crud.mark_pair_intro_sent, delivery.pair_id)
+    except Exception:
+        logger.exception("error sending intro", extra={"pair": delivery.pair_id})
+
+
+async def _is_intro_posted(client, dm_channel_id, idempotency_key) -> bool:
+    """Look for the intro carrying the idempotency key among the latest messages of the group DM."""
+    try:
+        response = await client.conversations_history(
+            channel=dm_channel_id, limit=INTRO_HISTORY_LIMIT, include_all_metadata=True
+        )
+    except SlackApiError:
+        # e.g. installations that haven't granted the history scopes yet, sending again is the lesser evil
+        logger.warning("could not check the DM history for a sent intro", exc_info=True)
+        return False
+
+    return any(
+        m.get("metadata", {}).get("event_payload", {}).get("idempotency_key") == idempotency_key
+        for m in response.data.get("messages", [])
+    )
+
+
+async def _save_pair_progress(transition, *args):
+    # a short session per step rather than the caller's, which isn't safe to share across the gathered sends,
+    # in a thread so that the other sends carry on while it commits
+    await asyncio.to_thread(_run_in_session, transition, *args)
+
+
+def _run_in_session(transition, *args):
+    with database.SessionLocal() as db:
+        transition(db, *args)
+
+
+def _intro_idempotency_key(pair_id):
+    return f"intro-{pair_id}"
+
+
+async def _send_midpoint_reminders(enterprise_id, team_id, pairs):
+    async with aiohttp.ClientSession() as session:
+        client = slack.get_async_slack_client(enterprise_id, team_id, session)
+        await asyncio.gather(*(_send_midpoint_reminder(client, p.id, p.dm_channel_id) for p in pairs))
+
+
+async def _send_midpoint_reminder(client, pair_id, dm_channel_id):
+    try:
+        await client.chat_postMessage(
+            text=":wave: Mid point reminder - if you haven't met yet, make it happen!",
+            channel=dm_channel_id,
+        )
+        await _save_pair_progress(crud.mark_pair_midpoint_sent, pair_id)
+    except Exception:
+        logger.exception("error sending midpoint")
 
 
 def _intro_message(channel_id, pair):
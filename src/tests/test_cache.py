@@ -0,0 +1,37 @@
+import unittest
+
+from unittest.mock import patch
+from src.cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    @patch("src.cache.time.monotonic")
+    def test_entries_expire(self, monotonic):
+        monotonic.return_value = 100.0
+        cache = TTLCache(10, 60)
+        cache.set("a", 1)
+
+        monotonic.return_value = 159.0
+        self.assertEqual(cache.get("a"), 1)
+
+        monotonic.return_value = 160.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_pop(self):
+        cache = TTLCache(10, 60)
+        cache.set("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+        self.assertIsNone(cache.get("a"))
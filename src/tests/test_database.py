@@ -0,0 +1,26 @@
+import unittest
+
+from unittest.mock import patch
+from sqlalchemy import text
+from src.db import database
+
+
+class TestSlowQueryLog(unittest.TestCase):
+    @patch("settings.DATABASE_SLOW_QUERY_MS", 5)
+    def test_logs_statements_over_threshold(self):
+        with database.engine.connect() as conn:
+            with self.assertLogs(database.logger, level="WARNING") as logs:
+                conn.execute(text("SELECT 1"))
+                conn.execute(text("SELECT pg_sleep(0.02)"))
+
+        self.assertEqual(1, len(logs.records))
+        self.assertIn("pg_sleep", logs.records[0].statement)
+        self.assertGreaterEqual(logs.records[0].duration_ms, 20)
+
+    @patch("settings.DATABASE_SLOW_QUERY_MS", 0)
+    def test_disabled_with_zero_threshold(self):
+        with database.engine.connect() as conn:
+            with patch.object(database.logger, "warning") as warning:
+                conn.execute(text("SELECT pg_sleep(0.01)"))
+
+        warning.assert_not_called()
@@ -0,0 +1,162 @@
+import asyncio
+import unittest
+
+from unittest.mock import patch, MagicMock
+from slack_sdk.errors import SlackApiError
+from src.db import database
+from src.dispatcher import TokenBucket, SlackDispatcher, RateLimitedClient, AsyncRateLimitedClient
+
+
+def _slack_error(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return SlackApiError("error", response)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self) -> None:
+        database.redis_client.delete("test_bucket")
+        self.bucket = TokenBucket("test_bucket", 60, 2)
+
+    @patch("src.dispatcher.time.time", return_value=100.0)
+    def test_waits_once_burst_is_used(self, _):
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertAlmostEqual(self.bucket.reserve(), 1)
+        self.assertAlmostEqual(self.bucket.reserve(), 2)
+
+    @patch("src.dispatcher.time.time")
+    def test_refills_over_time(self, time):
+        time.return_value = 100.0
+        for _ in range(2):
+            self.assertEqual(self.bucket.reserve(), 0)
+
+        time.return_value = 101.0
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertAlmostEqual(self.bucket.reserve(), 1)
+
+    @patch("src.dispatcher.time.time", return_value=100.0)
+    def test_pause(self, _):
+        self.bucket.pause(30)
+        self.assertAlmostEqual(self.bucket.reserve(), 31)
+
+    @patch("src.dispatcher.time.time", return_value=100.0)
+    def test_is_shared_between_processes(self, _):
+        # another process builds its own bucket on the same key
+        other = TokenBucket("test_bucket", 60, 2)
+        self.assertEqual(self.bucket.reserve(), 0)
+        self.assertEqual(other.reserve(), 0)
+        self.assertAlmostEqual(self.bucket.reserve(), 1)
+
+
+class TestSlackDispatcher(unittest.TestCase):
+    def setUp(self) -> None:
+        for key in database.redis_client.scan_iter("slack_rate:T*"):
+            database.redis_client.delete(key)
+
+    @patch("src.dispatcher.time.sleep")
+    def test_retries_only_rate_limited_call(self, sleep):
+        func = MagicMock(side_effect=[_slack_error(429, {"Retry-After": "3"}), "ok"])
+        dispatcher = SlackDispatcher(max_retries=2)
+
+        self.assertEqual(dispatcher.call("T1", "conversations.open", func, users=["a", "b"]), "ok")
+        self.assertEqual(func.call_count, 2)
+        self.assertGreaterEqual(sleep.call_args_list[-1].args[0], 3)
+
+    @patch("src.dispatcher.time.sleep")
+    def test_raises_when_retries_exhausted(self, _):
+        func = MagicMock(side_effect=_slack_error(429, {"retry-after": "1"}))
+        dispatcher = SlackDispatcher(max_retries=2)
+
+        self.assertRaises(SlackApiError, dispatcher.call, "T1", "users.info", func)
+        self.assertEqual(func.call_count, 3)
+
+    @patch("src.dispatcher.time.sleep")
+    def test_does_not_retry_other_errors(self, _):
+        func = MagicMock(side_effect=_slack_error(200))
+        dispatcher = SlackDispatcher(max_retries=2)
+
+        self.assertRaises(SlackApiError, dispatcher.call, "T1", "chat.postMessage", func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_buckets_are_per_workspace_and_tier(self):
+        dispatcher = SlackDispatcher()
+
+        def key(*args):
+            return dispatcher.bucket(*args).key
+
+        self.assertEqual(key("T1", "users.info"), key("T1", "conversations.members"))
+        self.assertNotEqual(key("T1", "users.info"), key("T2", "users.info"))
+        self.assertNotEqual(key("T1", "users.info"), key("T1", "conversations.open"))
+
+    def test_messages_are_limited_per_workspace_and_channel(self):
+        dispatcher = SlackDispatcher()
+
+        keys = [bucket.key for bucket in dispatcher.buckets("T1", "chat.postMessage", "C1")]
+        self.assertEqual(["slack_rate:T1:post_message", "slack_rate:T1:post_message:C1"], keys)
+        self.assertEqual(["slack_rate:T1:4"], [bucket.key for bucket in dispatcher.buckets("T1", "users.info", "C1")])
+
+    @patch("src.dispatcher.time.sleep")
+    @patch("src.dispatcher.time.time", return_value=100.0)
+    def test_messages_to_many_channels_are_throttled_together(self, _, sleep):
+        func = MagicMock(return_value="ok")
+        dispatcher = SlackDispatcher()
+
+        # every intro goes to a DM channel of its own
+        for i in range(12):
+            dispatcher.call("T1", "chat.postMessage", func, channel=f"D{i}", text="hi")
+        waits = [c.args[0] for c in sleep.call_args_list]
+        self.assertEqual([0] * 10, waits[:10])
+        self.assertAlmostEqual(0.6, waits[10])
+        self.assertAlmostEqual(1.2, waits[11])
+
+        # the channel's own limit holds even with tokens left in the workspace
+        database.redis_client.delete("slack_rate:T1:post_message")
+        for _ in range(4):
+            dispatcher.call("T1", "chat.postMessage", func, channel="C1", text="hi")
+        self.assertAlmostEqual(1, sleep.call_args_list[-1].args[0])
+
+    @patch("src.dispatcher.time.sleep")
+    @patch("src.dispatcher.time.time", return_value=100.0)
+    def test_rate_limited_message_pauses_the_workspace(self, _, sleep):
+        func = MagicMock(side_effect=[_slack_error(429, {"Retry-After": "30"}), "ok", "ok"])
+        dispatcher = SlackDispatcher()
+
+        dispatcher.call("T1", "chat.postMessage", func, channel="D1", text="hi")
+        dispatcher.call("T1", "chat.postMessage", func, channel="D2", text="hi")
+        self.assertGreaterEqual(sleep.call_args_list[-1].args[0], 30)
+
+    @patch("src.dispatcher.time.sleep")
+    def test_client_routes_methods_through_dispatcher(self, _):
+        dispatcher = MagicMock()
+        web_client = MagicMock()
+        client = RateLimitedClient(web_client, "T1", dispatcher)
+
+        client.chat_postMessage(channel="C1", text="hi")
+        dispatcher.call.assert_called_once_with(
+            "T1", "chat.postMessage", web_client.chat_postMessage, channel="C1", text="hi"
+        )
+
+    def test_async_client_bounds_requests_in_flight(self):
+        in_flight, max_in_flight = 0, 0
+
+        async def users_info(user):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return user
+
+        web_client = MagicMock()
+        web_client.users_info = users_info
+        dispatcher = SlackDispatcher()
+        # a new client is built for every batch of a workspace, they all share its cap
+        clients = [AsyncRateLimitedClient(web_client, "T1", 3, dispatcher) for _ in range(2)]
+
+        async def run():
+            return await asyncio.gather(*(clients[i % 2].users_info(user=str(i)) for i in range(10)))
+
+        self.assertEqual(asyncio.run(run()), [str(i) for i in range(10)])
+        self.assertEqual(max_in_flight, 3)
@@ -1,40 +1,92 @@
 import src.helpers as helpers
 import unittest
 
+from collections import Counter
+from datetime import date, datetime, timedelta
 
-class TestRoundRobin(unittest.TestCase):
-    def test_pairs_are_exclusive(self):
-        members = [1, 2, 3, 4, 5, 6]
-        pairs, circle = helpers.round_robin_match(members)
-        self.assertEqual(len(pairs), 3)
-        for pair in pairs:
-            pair.sort()
-        self.assertTrue(pairs[0] != pairs[1])
-        self.assertTrue(pairs[1] != pairs[2])
-        self.assertTrue(pairs[0] != pairs[2])
-        self.assertTrue(circle == [1, 6, 2, 3, 4, 5])
-
-    def test_repeated_matches(self):
-        members = [1, 2, 3, 4, 5, 6]
-
-        map = {}
-        for i in range(5):
-            pairs, members = helpers.round_robin_match(members)
-            for pair in pairs:
-                pair.sort()
-                key = "".join(str(x) for x in pair)
-                map[key] = True
-
-        # there should be 15 unique pairs i.e. 3 pairs from each of the 5 times
-        self.assertEqual(len(map), 15)
-
-    def test_invalid_arguments(self):
-        members = [1, 2, 3, 4, 5, 6]
-
-        # make sure regular call passes
-        pairs, _ = helpers.round_robin_match(members)
-        self.assertEqual(len(pairs), 3)
-
-        # test odd number of members
-        members.append(7)
-        self.assertRaises(ValueError, helpers.round_robin_match, members)
+
+class TestGrouping(unittest.TestCase):
+    def test_group_sizes(self):
+        self.assertEqual([3, 2], helpers.group_sizes(5, 2))
+        self.assertEqual([3, 3, 3, 3], helpers.group_sizes(12, 3))
+        self.assertEqual([4, 4, 3], helpers.group_sizes(11, 3))
+        # too many left over to add one to each group, so a group is one short
+        self.assertEqual([4, 3], helpers.group_sizes(7, 4))
+        self.assertEqual([3], helpers.group_sizes(3, 4))
+        self.assertEqual([], helpers.group_sizes(1, 2))
+
+    def test_rotation_pairs_everyone_once(self):
+        for members in ([1, 2, 3, 4, 5, 6], [1, 2, 3, 4, 5, 6, 7]):
+            met, trios = set(), []
+            for rotation_round in range(len(members) - 1 + len(members) % 2):
+                groups = helpers.rotation_groups(members, 2, rotation_round)
+                self.assertEqual(members, sorted(sum(groups, [])))
+                trios.extend(group for group in groups if len(group) == 3)
+                for group in groups:
+                    met.update(frozenset((a, b)) for a in group for b in group if a != b)
+
+            self.assertEqual(len(members) * (len(members) - 1) // 2, len(met))
+            # with an odd number of members, everyone joins the trio as often
+            self.assertEqual(len(set(Counter(sum(trios, [])).values())), 1 if trios else 0)
+
+    def test_rotation_groups(self):
+        groups = helpers.rotation_groups(list(range(10)), 3, 4)
+        self.assertEqual([4, 3, 3], [len(group) for group in groups])
+        self.assertEqual(list(range(10)), sorted(sum(groups, [])))
+
+
+class TestAvoidRecentGroups(unittest.TestCase):
+    today = date(2024, 3, 4)
+
+    def test_recent_pairs_swap_partners(self):
+        last_met = {("a", "b"): self.today - timedelta(14), ("c", "d"): self.today - timedelta(28)}
+        pairs = helpers.avoid_recent_groups([["a", "b"], ["c", "d"]], last_met, self.today, 182)
+
+        self.assertEqual(["a", "b", "c", "d"], sorted(sum(pairs, [])))
+        self.assertTrue(all(helpers.pairing_cost(a, b, last_met, self.today, 182) == 0 for a, b in pairs))
+
+    def test_prefers_the_pair_met_longest_ago(self):
+        # a met everyone, the swap to a-d pairs them with the one they met the longest ago
+        last_met = {
+            ("a", "b"): self.today - timedelta(7),
+            ("a", "c"): self.today - timedelta(14),
+            ("a", "d"): self.today - timedelta(70),
+        }
+        pairs = helpers.avoid_recent_groups([["a", "b"], ["c", "d"]], last_met, self.today, 182)
+        self.assertIn(sorted(["a", "d"]), [sorted(pair) for pair in pairs])
+
+    def test_meetings_older_than_horizon_are_ignored(self):
+        last_met = {("a", "b"): self.today - timedelta(200)}
+        self.assertEqual(0, helpers.pairing_cost("b", "a", last_met, self.today, 182))
+        self.assertEqual(
+            [["a", "b"], ["c", "d"]], helpers.avoid_recent_groups([["a", "b"], ["c", "d"]], last_met, self.today, 182)
+        )
+
+    def test_groups_keep_their_sizes(self):
+        last_met = {("a", "b"): self.today - timedelta(7), ("a", "c"): self.today - timedelta(7)}
+        groups = helpers.avoid_recent_groups([["a", "b", "c"], ["d", "e"]], last_met, self.today, 182)
+
+        self.assertEqual([3, 2], [len(group) for group in groups])
+        self.assertFalse({"b", "c"} & set(next(group for group in groups if "a" in group)))
+
+
+class TestNextConversationTime(unittest.TestCase):
+    def test_slot_in_the_same_week(self):
+        # monday 2024-03-04 10:30 utc, the slot is wednesday 9am in new york which is 14:00 utc
+        after = datetime(2024, 3, 4, 10, 30)
+        self.assertEqual(
+            datetime(2024, 3, 6, 14), helpers.next_conversation_time(after, 2, 9, "America/New_York")
+        )
+
+    def test_current_slot_counts_until_its_hour_is_over(self):
+        after = datetime(2024, 3, 4, 9, 59)
+        self.assertEqual(datetime(2024, 3, 4, 9), helpers.next_conversation_time(after, 0, 9, "UTC"))
+        after = datetime(2024, 3, 4, 10)
+        self.assertEqual(datetime(2024, 3, 11, 9), helpers.next_conversation_time(after, 0, 9, "UTC"))
+
+    def test_slot_keeps_local_hour_across_daylight_saving(self):
+        # new york moves to daylight saving time on 2024-03-10
+        after = datetime(2024, 3, 7)
+        self.assertEqual(
+            datetime(2024, 3, 11, 13), helpers.next_conversation_time(after, 0, 9, "America/New_York")
+        )
@@ -0,0 +1,68 @@
+import unittest
+
+from datetime import timedelta
+from unittest.mock import patch
+from src.db import database, leases
+
+
+class TestLeases(unittest.TestCase):
+    def setUp(self) -> None:
+        database.redis_client.delete("lease:test_lease")
+
+    def test_lease_is_exclusive_until_released(self):
+        with leases.hold_lease("test_lease") as lease:
+            self.assertIsNotNone(lease)
+            with leases.hold_lease("test_lease") as other:
+                self.assertIsNone(other)
+            lease.ensure_held()
+
+        with leases.hold_lease("test_lease") as lease:
+            self.assertIsNotNone(lease)
+
+    def test_fencing_tokens_increase(self):
+        with leases.hold_lease("test_lease") as first:
+            pass
+        with leases.hold_lease("test_lease") as second:
+            self.assertGreater(second.token, first.token)
+
+    def test_expired_lease_is_fenced_off(self):
+        lease = leases.Lease("test_lease", timedelta(seconds=60))
+        self.assertTrue(lease.acquire())
+        # the lease expired and someone else took it over
+        database.redis_client.delete(lease.key)
+        with leases.hold_lease("test_lease") as successor:
+            self.assertRaises(leases.LeaseLost, lease.ensure_held)
+            self.assertFalse(lease.renew())
+
+            # releasing a lost lease leaves the successor's alone
+            lease.release()
+            successor.ensure_held()
+
+    @patch("src.db.leases.time.monotonic")
+    def test_lease_not_renewed_in_time_is_lost(self, monotonic):
+        monotonic.return_value = 100.0
+        with leases.hold_lease("test_lease", timedelta(seconds=60)) as lease:
+            lease._stopped.set()
+            monotonic.return_value = 159.0
+            lease.ensure_held()
+
+            monotonic.return_value = 160.0
+            self.assertRaises(leases.LeaseLost, lease.ensure_held)
+
+            self.assertTrue(lease.renew())
+            lease.ensure_held()
+
+    def test_leased_task_is_skipped_while_the_lease_is_held(self):
+        runs = []
+
+        @leases.leased(key=lambda channel_id: channel_id)
+        def task(channel_id):
+            runs.append(channel_id)
+            leases.ensure_held()
+            return channel_id
+
+        with leases.hold_lease(f"{__name__}.task:C1"):
+            self.assertIsNone(task("C1"))
+            self.assertEqual("C2", task("C2"))
+        self.assertEqual("C1", task("C1"))
+        self.assertEqual(["C2", "C1"], runs)
@@ -0,0 +1,86 @@
+import json
+import time
+import unittest
+import main
+import src.slack_app  # registers the tasks
+
+from unittest.mock import patch
+from fastapi import HTTPException
+
+from task_runner import celery, queue_names, route_task, BULK, INTERACTIVE, LEGACY_QUEUE, SCHEDULED
+from src.db import database, queue_metrics
+
+
+class TestQueueRouting(unittest.TestCase):
+    def route(self, name, *args, **kwargs):
+        return route_task(name, args, kwargs, {}, task=celery.tasks[name])["queue"]
+
+    def test_tasks_of_a_workspace_share_a_queue_of_their_class(self):
+        cache = "src.tasks.member_management.cache_channel_members"
+        queue = self.route(cache, "C1", "T1", "E1")
+        self.assertIn(queue, queue_names(BULK))
+        self.assertEqual(queue, self.route(cache, "C2", "T1", "E1"))
+        self.assertEqual(
+            queue.replace(BULK, INTERACTIVE),
+            self.route("src.tasks.member_management.apply_member_events", channel_id="C1", team_id="T1"),
+        )
+        self.assertEqual(queue, self.route("src.tasks.pairing.generate_channel_conversations", 1, "T1"))
+        self.assertEqual(
+            queue.replace(BULK, INTERACTIVE),
+            self.route("src.tasks.pairing.force_generate_conversations", "C3", "T1"),
+        )
+        self.assertEqual(
+            {len(queue_names(BULK))},
+            {len({self.route(cache, "C1", f"T{i}", "E1") for i in range(1000)})},
+        )
+
+    def test_legacy_queue_is_drained(self):
+        self.assertIn(LEGACY_QUEUE, {queue.name for queue in celery.conf.task_queues})
+
+    def test_periodic_tasks_are_scheduled(self):
+        self.assertEqual(SCHEDULED, self.route("src.tasks.pairing.match_pairs_periodic"))
+        self.assertIsNone(route_task("celery.chord_unlock", (), {}, {}))
+
+
+class TestQueueMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        database.redis_client.delete("test_queue", "queue_waits:test_queue")
+
+    def tearDown(self) -> None:
+        self.setUp()
+
+    def test_depth_and_latency(self):
+        for wait in range(1, 21):
+            queue_metrics.record_wait("test_queue", wait)
+        now = time.time()
+        for enqueued_at in [now - 30, now - 10]:
+            database.redis_client.lpush("test_queue", json.dumps({"headers": {"enqueued_at": enqueued_at}}))
+
+        (metrics,) = queue_metrics.get_queue_metrics(["test_queue"])
+        self.assertEqual(2, metrics["depth"])
+        self.assertAlmostEqual(30, metrics["oldest_seconds"], delta=1)
+        self.assertEqual(11, metrics["wait_p50_seconds"])
+        self.assertEqual(20, metrics["wait_p95_seconds"])
+
+    def test_empty_queue(self):
+        self.assertEqual(
+            [
+                {
+                    "queue": "test_queue",
+                    "depth": 0,
+                    "oldest_seconds": None,
+                    "wait_p50_seconds": None,
+                    "wait_p95_seconds": None,
+                }
+            ],
+            queue_metrics.get_queue_metrics(["test_queue"]),
+        )
+
+    @patch("main.monitoring.get_queue_metrics", return_value=[])
+    def test_metrics_need_the_token(self, _):
+        with patch("settings.METRICS_TOKEN", None):
+            self.assertRaises(HTTPException, main.queue_metrics, "Bearer ")
+        with patch("settings.METRICS_TOKEN", "secret"):
+            self.assertRaises(HTTPException, main.queue_metrics, None)
+            self.assertRaises(HTTPException, main.queue_metrics, "Bearer wrong")
+            self.assertEqual([], main.queue_metrics("Bearer secret"))
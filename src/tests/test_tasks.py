@@ -1,11 +1,16 @@
-import os
+import asyncio
 import unittest
 import src.tasks.member_management as member_tasks
 import src.tasks.pairing as pairing_tasks
+import src.tasks.commands as command_tasks
+import src.slack_app as slack_app
+import src.helpers as helpers
 
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+from slack_sdk.errors import SlackApiError
+from sqlalchemy.exc import OperationalError
 from datetime import datetime, timedelta
-from src.db import database, models, crud
+from src.db import database, models, crud, leases, locks, member_events
 
 class TestTasks(unittest.TestCase):
     def setUp(self) -> None:
@@ -54,24 +59,190 @@ class TestTasks(unittest.TestCase):
             self.assertEqual(res, 4)
 
     @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_cache_channel_members_resumes_interrupted_sync(self, webclient):
+        channel_id, team_id, enterprise_id = "test_cid", "test_tid", "test_eid"
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, channel_id, team_id, enterprise_id)
+            crud.add_member_if_not_exists(db, "member_left", channel)
+
+            cursor_resp, no_cursor_resp = MagicMock(), MagicMock()
+            cursor_resp.data = {
+                "ok": True,
+                "members": ["member_1", "member_2"],
+                "response_metadata": {"next_cursor": "some_cursor_value"},
+            }
+            no_cursor_resp.data = {
+                "ok": True,
+                "members": ["member_3"],
+                "response_metadata": {"next_cursor": ""},
+            }
+            client_instance = MagicMock()
+            client_instance.conversations_members.side_effect = [
+                cursor_resp,
+                Exception("worker died"),
+                no_cursor_resp,
+            ]
+            webclient.return_value = client_instance
+
+            self.assertRaises(Exception, member_tasks.cache_channel_members, channel_id, team_id, enterprise_id)
+            member_tasks.cache_channel_members(channel_id, team_id, enterprise_id)
+
+            # the second run picks up from the saved cursor instead of the first page
+            self.assertEqual(3, client_instance.conversations_members.call_count)
+            self.assertEqual("some_cursor_value", client_instance.conversations_members.call_args.kwargs["cursor"])
+            self.assertEqual(
+                ["member_1", "member_2", "member_3"],
+                sorted(crud.get_cached_channel_member_ids(db, channel_id, team_id)),
+            )
+            self.assertEqual(0, db.query(models.ChannelMemberSyncs).count())
+
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_exclude_bots_from_cached_users(self, webclient):
+        channel_id, team_id, enterprise_id = "test_cid", "test_tid", "test_eid"
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, channel_id, team_id, enterprise_id)
+            for member in ["member_1", "bot_1", "deactivated_1"]:
+                crud.add_member_if_not_exists(db, member, channel)
+
+            users_resp = MagicMock()
+            users_resp.data = {
+                "ok": True,
+                "members": [
+                    {"id": "member_1", "is_bot": False},
+                    {"id": "bot_1", "is_bot": True},
+                    {"id": "deactivated_1", "is_bot": False, "deleted": True},
+                ],
+                "response_metadata": {"next_cursor": ""},
+            }
+            client_instance = MagicMock()
+            client_instance.users_list.return_value = users_resp
+            webclient.return_value = client_instance
+
+            member_tasks.exclude_bots_from_cached_users(channel_id, team_id, enterprise_id)
+            self.assertEqual(["member_1"], crud.get_cached_channel_member_ids(db, channel_id, team_id))
+
+            # the workspace index is reused instead of listing the users again
+            member_tasks.exclude_bots_from_cached_users(channel_id, team_id, enterprise_id)
+            client_instance.users_list.assert_called_once()
+            client_instance.users_info.assert_not_called()
+
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_remove_disabled_users(self, webclient):
+        channel_id, team_id, enterprise_id = "test_cid", "test_tid", "test_eid"
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, channel_id, team_id, enterprise_id)
+            for member in ["member_1", "member_2", "member_3", "member_4"]:
+                crud.add_member_if_not_exists(db, member, channel)
+
+            members_resp = MagicMock()
+            members_resp.data = {
+                "ok": True,
+                "members": ["member_1", "member_3"],
+                "response_metadata": {"next_cursor": ""},
+            }
+            client_instance = MagicMock()
+            client_instance.conversations_members.return_value = members_resp
+            webclient.return_value = client_instance
+
+            with patch.object(member_tasks.reconcile_workspace_members, "delay") as delay:
+                delay.side_effect = member_tasks.reconcile_workspace_members
+                member_tasks.remove_disabled_users()
+
+            db.refresh(channel)
+            self.assertEqual(["member_1", "member_3"], sorted(crud.get_cached_channel_member_ids(db, channel_id, team_id)))
+            self.assertEqual(["member_1", "member_3"], crud.get_rotation_member_ids(db, channel))
+
+            run = db.query(models.ReconciliationRuns).one()
+            self.assertIsNotNone(run.finished_on)
+            self.assertEqual(1, run.channels_reconciled)
+            self.assertEqual(2, run.members_removed)
+
+    @patch("src.tasks.member_management.get_excluded_user_ids", autospec=True)
+    def test_exclude_bots_from_removed_channel(self, get_excluded_user_ids):
+        member_tasks.exclude_bots_from_cached_users("removed_cid", "test_tid", "test_eid")
+        get_excluded_user_ids.assert_not_called()
+
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_reconcile_workspace_members_resumes_after_last_channel(self, webclient):
+        team_id, enterprise_id = "test_tid", "test_eid"
+        with database.SessionLocal() as db:
+            first = crud.add_channel(db, "channel_1", team_id, enterprise_id)
+            second = crud.add_channel(db, "channel_2", team_id, enterprise_id)
+            for channel in [first, second]:
+                crud.add_member_if_not_exists(db, "member_1", channel)
+                crud.add_member_if_not_exists(db, "member_2", channel)
+
+            members_resp = MagicMock()
+            members_resp.data = {
+                "ok": True,
+                "members": ["member_1"],
+                "response_metadata": {"next_cursor": ""},
+            }
+            client_instance = MagicMock()
+            client_instance.conversations_members.return_value = members_resp
+            webclient.return_value = client_instance
+
+            (shard_id,) = crud.start_reconciliation_run(db)
+            shard = crud.get_reconciliation_shard(db, shard_id)
+            crud.save_reconciliation_progress(db, shard, first.id, 0)
+
+            member_tasks.reconcile_workspace_members(shard_id)
+
+            self.assertEqual(1, client_instance.conversations_members.call_count)
+            self.assertEqual(2, len(crud.get_cached_channel_member_ids(db, "channel_1", team_id)))
+            self.assertEqual(["member_1"], crud.get_cached_channel_member_ids(db, "channel_2", team_id))
+
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_reconciliation_under_an_earlier_lease_is_fenced_off(self, webclient):
+        team_id, enterprise_id = "test_tid", "test_eid"
+        with database.SessionLocal() as db:
+            first = crud.add_channel(db, "channel_1", team_id, enterprise_id)
+            second = crud.add_channel(db, "channel_2", team_id, enterprise_id)
+            webclient.return_value.conversations_members.return_value.data = {
+                "ok": True,
+                "members": [],
+                "response_metadata": {"next_cursor": ""},
+            }
+
+            (shard_id,) = crud.start_reconciliation_run(db)
+            shard = crud.get_reconciliation_shard(db, shard_id)
+            # a worker that took the lease over later saved its progress
+            self.assertTrue(crud.save_reconciliation_progress(db, shard, first.id, 0, lease_token=10**15))
+            self.assertFalse(crud.save_reconciliation_progress(db, shard, second.id, 0, lease_token=10**15 - 1))
+
+            self.assertRaises(leases.LeaseLost, member_tasks.reconcile_workspace_members, shard_id)
+
+            db.refresh(shard)
+            self.assertEqual(first.id, shard.last_channel_id)
+            self.assertEqual(1, shard.channels_reconciled)
+            self.assertIsNone(shard.finished_on)
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
     def test_generate_and_send_conversations(self, webclient):
-        os.environ["CONVERSATION_DAY"] = str(datetime.now().weekday())
         self._insert_fake_channels_and_members("generate_and_send_conv_id", "test_eid")
 
         client_instance = MagicMock()
-        client_instance.conversations_open().data = {
+        client_instance.conversations_open = AsyncMock()
+        client_instance.conversations_open.return_value.data = {
             "ok": True,
             "channel": {"id": "test"},
         }
+        client_instance.chat_postMessage = AsyncMock()
         webclient.return_value = client_instance
         with database.SessionLocal() as db:
+            # every channel's weekly slot is the current hour
+            now = datetime.utcnow()
+            for channel in db.query(models.Channels).where(models.Channels.team_id == "generate_and_send_conv_id"):
+                crud.set_channel_schedule(db, channel, now.weekday(), now.hour, "UTC")
             channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_0").first()
-            channel.last_sent_on = (datetime.utcnow() - timedelta(13)).date()
+            crud.set_channel_last_sent_on(db, channel, (datetime.utcnow() - timedelta(13)).date())
             channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_1").first()
-            channel.last_sent_on = (datetime.utcnow() - timedelta(14)).date()
-            db.commit()
+            crud.set_channel_last_sent_on(db, channel, (datetime.utcnow() - timedelta(14)).date())
 
-            pairing_tasks.match_pairs_periodic()
+            with patch.object(pairing_tasks.generate_channel_conversations, "delay") as delay:
+                delay.side_effect = pairing_tasks.generate_channel_conversations
+                pairing_tasks.match_pairs_periodic()
+                self.assertEqual(2, delay.call_count)
 
             conversations = (
                 db.query(models.ChannelConversations)
@@ -84,8 +255,442 @@ class TestTasks(unittest.TestCase):
             three_members_conv = [c for c in conversations if c.channel_id == "channel_1"]
             six_members_conv = [c for c in conversations if c.channel_id == "channel_2"]
 
-            self.assertEqual(1, len(three_members_conv[0].conversations["pairs"]))
-            self.assertEqual(3, len(six_members_conv[0].conversations["pairs"]))
+            self.assertEqual(1, len(crud.get_conversation_pairs(db, three_members_conv[0].id)))
+            self.assertEqual(
+                ["INTRO_SENT"] * 3, [p.status for p in crud.get_conversation_pairs(db, six_members_conv[0].id)]
+            )
+            self.assertEqual("INTRO_SENT", six_members_conv[0].conversations["status"])
+            self.assertEqual(4, client_instance.chat_postMessage.await_count)
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
+    def test_send_failed_intros_retries_only_unsent_pairs(self, webclient):
+        self._insert_fake_channels_and_members("failed_intros_tid", "test_eid")
+
+        client_instance = MagicMock()
+        client_instance.conversations_open = AsyncMock()
+        client_instance.conversations_open.return_value.data = {"ok": True, "channel": {"id": "dm"}}
+        client_instance.chat_postMessage = AsyncMock()
+        webclient.return_value = client_instance
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_0").first()
+            conversation = crud.save_channel_conversations(db, channel, [["member_0", "member_1"], ["member_2", "member_3"]])
+            sent_pair, failed_pair = crud.get_conversation_pairs(db, conversation.id)
+            crud.mark_pair_opened(db, sent_pair.id, "dm_sent")
+            crud.mark_pair_intro_sent(db, sent_pair.id)
+            self.assertEqual(set(), crud.finish_conversation_intros(db, [conversation.id]))
+
+            pairing_tasks.send_failed_intros()
+
+            client_instance.conversations_open.assert_awaited_once_with(users=["member_2", "member_3"])
+            db.refresh(conversation)
+            self.assertEqual("INTRO_SENT", conversation.conversations["status"])
+            self.assertIsNotNone(conversation.sent_on)
+            self.assertEqual(
+                ["dm_sent", "dm"], [p.dm_channel_id for p in crud.get_conversation_pairs(db, conversation.id)]
+            )
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
+    def test_send_failed_intros_does_not_resend_posted_intro(self, webclient):
+        self._insert_fake_channels_and_members("resend_intros_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_0").first()
+            conversation = crud.save_channel_conversations(db, channel, [["member_0", "member_1"], ["member_2", "member_3"]])
+            posted_pair_id, unposted_pair_id = [p.id for p in crud.get_conversation_pairs(db, conversation.id)]
+            # the worker stopped after the DMs were opened, with only the first intro posted
+            crud.mark_pair_opened(db, posted_pair_id, "dm_posted")
+            crud.mark_pair_opened(db, unposted_pair_id, "dm_unposted")
+
+            async def conversations_history(channel, **kwargs):
+                response = MagicMock()
+                messages = {
+                    "dm_posted": [{"text": "intro", "metadata": {"event_payload": {"idempotency_key": f"intro-{posted_pair_id}"}}}],
+                    "dm_unposted": [],
+                }
+                response.data = {"ok": True, "messages": messages[channel]}
+                return response
+
+            client_instance = MagicMock()
+            client_instance.conversations_open = AsyncMock()
+            client_instance.conversations_history = AsyncMock(side_effect=conversations_history)
+            client_instance.chat_postMessage = AsyncMock()
+            webclient.return_value = client_instance
+
+            pairing_tasks.send_failed_intros()
+
+            client_instance.conversations_open.assert_not_awaited()
+            client_instance.chat_postMessage.assert_awaited_once()
+            self.assertEqual("dm_unposted", client_instance.chat_postMessage.call_args.kwargs["channel"])
+            self.assertEqual(
+                {"event_type": "smores_intro", "event_payload": {"idempotency_key": f"intro-{unposted_pair_id}"}},
+                client_instance.chat_postMessage.call_args.kwargs["metadata"],
+            )
+            self.assertEqual(
+                ["INTRO_SENT", "INTRO_SENT"], [p.status for p in crud.get_conversation_pairs(db, conversation.id)]
+            )
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
+    def test_send_midpoint_reminder_pages_by_workspace(self, webclient):
+        self._insert_fake_channels_and_members("midpoint_tid_1", "eid_1")
+        self._insert_fake_channels_and_members("midpoint_tid_2", "eid_2")
+        client_instance = MagicMock()
+        client_instance.chat_postMessage = AsyncMock()
+        webclient.return_value = client_instance
+        with database.SessionLocal() as db:
+            for team_id in ["midpoint_tid_1", "midpoint_tid_2"]:
+                channel = crud.get_channel(db, "channel_0", team_id)
+                conversation = crud.save_channel_conversations(db, channel, [["member_0", "member_1"], ["member_2", "member_3"]])
+                for pair in crud.get_conversation_pairs(db, conversation.id):
+                    pair.status, pair.dm_channel_id = "INTRO_SENT", f"dm_{pair.id}"
+                    pair.intro_sent_on = datetime.utcnow() - timedelta(8)
+            db.commit()
+
+            intro_sent_on = datetime.utcnow().date() - timedelta(8)
+            pages = list(crud.iter_pairs_pending_midpoint_reminder(db, intro_sent_on, page_size=3))
+            self.assertEqual(
+                [["eid_1", "eid_1"], ["eid_2"], ["eid_2"]], [[p.enterprise_id for p in page] for page in pages]
+            )
+
+            pairing_tasks.send_midpoint_reminder()
+
+            self.assertEqual(4, client_instance.chat_postMessage.await_count)
+            self.assertEqual(["eid_1", "eid_2"], [c.args[0] for c in webclient.call_args_list])
+            self.assertEqual([], list(crud.iter_pairs_pending_midpoint_reminder(db, intro_sent_on)))
+
+    def test_claim_channels_due_for_pairing(self):
+        self._insert_fake_channels_and_members("claim_tid", "test_eid")
+        with database.SessionLocal() as db:
+            now = datetime.utcnow()
+            for channel in db.query(models.Channels).where(models.Channels.team_id == "claim_tid"):
+                crud.set_channel_schedule(db, channel, now.weekday(), now.hour, "UTC")
+            paired = crud.get_channel(db, "channel_0", "claim_tid")
+            crud.set_channel_last_sent_on(db, paired, datetime.utcnow().date())
+            inactive = crud.get_channel(db, "channel_1", "claim_tid")
+            inactive.is_active = False
+            db.commit()
+
+            # a claim whose lease ran out is handed out again
+            (claimed,) = crud.claim_channels_due_for_pairing(db, 10, timedelta(minutes=-1))
+            self.assertEqual((crud.get_channel(db, "channel_2", "claim_tid").id, "claim_tid"), tuple(claimed))
+            self.assertEqual([claimed], crud.claim_channels_due_for_pairing(db, 10, timedelta(hours=1)))
+            self.assertEqual([], crud.claim_channels_due_for_pairing(db, 10, timedelta(hours=1)))
+
+    def test_channels_are_added_to_the_least_loaded_slot(self):
+        with database.SessionLocal() as db:
+            first = crud.add_channel(db, "channel_1", "slot_tid", "test_eid")
+            second = crud.add_channel(db, "channel_2", "slot_tid", "test_eid")
+            third = crud.add_channel(db, "channel_3", "slot_tid", "test_eid", "America/New_York")
+
+            self.assertEqual((0, 9), (first.conversation_day, first.conversation_hour))
+            self.assertEqual((0, 10), (second.conversation_day, second.conversation_hour))
+            # 9am in new york falls on a utc hour that's still free
+            self.assertEqual((0, 9), (third.conversation_day, third.conversation_hour))
+            start = datetime.utcnow() - timedelta(hours=1)
+            load = crud.get_projected_pairing_load(db, start, start + timedelta(weeks=1, hours=1))
+            self.assertEqual(
+                {first.next_pairing_on, second.next_pairing_on, third.next_pairing_on}, {row.hour for row in load}
+            )
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
+    def test_locked_channel_is_not_paired(self, webclient):
+        self._insert_fake_channels_and_members("locked_channel_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_0").first()
+
+            with locks.channel_lock(channel.id) as acquired:
+                self.assertTrue(acquired)
+                pairing_tasks.generate_channel_conversations(channel.id, channel.team_id)
+
+            self.assertEqual(0, db.query(models.ChannelConversations).count())
+            webclient.assert_not_called()
+
+    def test_pairs_avoid_members_who_met_recently(self):
+        self._insert_fake_channels_and_members("pair_history_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_2").first()
+            met = [["member_0", "member_5"], ["member_1", "member_2"], ["member_3", "member_4"]]
+            crud.save_channel_conversations(db, channel, met)
+            crud.save_channel_conversations(db, channel, met[:1])
+
+            history = crud.get_pair_history(db, channel, datetime.utcnow().date() - timedelta(weeks=1))
+            self.assertEqual({("member_0", "member_5"), ("member_1", "member_2"), ("member_3", "member_4")}, set(history))
+            self.assertEqual(
+                2,
+                db.query(models.PairHistory.times_met)
+                .where(models.PairHistory.member_a == "member_0", models.PairHistory.team_id == "pair_history_tid")
+                .scalar(),
+            )
+
+            # the rotation proposes the pairs that just met
+            order = ["member_0", "member_1", "member_3", "member_4", "member_2", "member_5"]
+            for member in db.query(models.ChannelMembers).where(models.ChannelMembers.team_id == "pair_history_tid"):
+                member.position = order.index(member.member_id)
+            db.commit()
+            self.assertEqual(order, crud.get_rotation_member_ids(db, channel))
+            conversation = pairing_tasks.create_conversation_pairs(channel, db)
+
+            pairs = [sorted(p.member_ids) for p in crud.get_conversation_pairs(db, conversation.id)]
+            self.assertEqual(3, len(pairs))
+            self.assertFalse([p for p in pairs if p in met])
+
+    def test_channel_is_marked_paired_with_its_round(self):
+        self._insert_fake_channels_and_members("paired_round_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.team_id == "paired_round_tid").first()
+            channel_pk = channel.id
+            with patch.object(crud, "set_channel_last_sent_on") as set_channel_last_sent_on:
+                conversation = pairing_tasks.create_conversation_pairs(channel, db)
+                set_channel_last_sent_on.assert_not_called()
+
+        # the round and the channel's next pairing were committed together
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).where(models.Channels.id == channel_pk).one()
+            self.assertIsNotNone(db.query(models.ChannelConversations).where(models.ChannelConversations.id == conversation.id).first())
+            self.assertEqual(datetime.utcnow().date(), channel.last_sent_on)
+            self.assertGreater(channel.next_pairing_on, datetime.utcnow() + timedelta(weeks=1))
+
+    def test_pair_history_is_pruned(self):
+        self._insert_fake_channels_and_members("pair_history_prune_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_2").first()
+            crud.save_channel_conversations(db, channel, [["member_0", "member_1"], ["member_2", "member_3"]])
+            crud.save_channel_conversations(db, channel, [["member_4", "member_5"]])
+            db.query(models.PairHistory).where(models.PairHistory.member_a == "member_0").update(
+                {"last_met_on": datetime.utcnow().date() - pairing_tasks.PAIR_HISTORY_HORIZON - timedelta(days=1)}
+            )
+            db.commit()
+
+            # the history of members who leave goes with them
+            crud.delete_members(db, {"member_5"}, channel)
+            crud.delete_member(db, "member_2", channel.channel_id, channel.team_id)
+            pairing_tasks.prune_pair_history()
+
+            self.assertEqual(0, db.query(models.PairHistory).where(models.PairHistory.team_id == "pair_history_prune_tid").count())
+
+    def test_members_rotate_in_the_order_they_joined(self):
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, "channel_0", "rotation_order_tid", "test_eid")
+            crud.add_members_if_not_exist(db, ["member_2", "member_0"], channel)
+            crud.add_member_if_not_exists(db, "member_1", channel)
+            self.assertEqual(1, crud.delete_member(db, "member_0", "channel_0", "rotation_order_tid"))
+            crud.add_member_if_not_exists(db, "member_0", channel)
+
+            self.assertEqual(["member_2", "member_1", "member_0"], crud.get_rotation_member_ids(db, channel))
+
+    def test_channel_group_size(self):
+        self._insert_fake_channels_and_members("group_size_tid", "test_eid")
+        with database.SessionLocal() as db:
+            channel = db.query(models.Channels).filter(models.Channels.channel_id == "channel_2").first()
+            crud.set_channel_group_size(db, channel, 4)
+
+            conversation = pairing_tasks.create_conversation_pairs(channel, db)
+
+            groups = [p.member_ids for p in crud.get_conversation_pairs(db, conversation.id)]
+            self.assertEqual([3, 3], sorted(len(group) for group in groups))
+            self.assertEqual([f"member_{i}" for i in range(6)], sorted(sum(groups, [])))
+            db.refresh(channel)
+            self.assertEqual(1, channel.rotation_round)
+
+    @patch("src.slack_app.get_async_slack_client", autospec=True)
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_apply_member_events(self, webclient, async_webclient):
+        channel_id, team_id = "channel_0", "member_events_tid"
+        member_events.take_member_events(channel_id, team_id)
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, channel_id, team_id, "test_eid")
+            crud.add_members_if_not_exist(db, ["member_left", "member_back"], channel)
+            crud.save_workspace_users(
+                db, team_id, [{"id": "member_new"}, {"id": "member_back"}, {"id": "bot", "is_bot": True}]
+            )
+
+        events = [
+            ("member_new", member_events.JOINED),
+            ("bot", member_events.JOINED),
+            ("member_left", member_events.LEFT),
+            ("member_unknown", member_events.JOINED),
+            ("member_back", member_events.LEFT),
+            ("member_back", member_events.JOINED),
+            ("member_gone", member_events.JOINED),
+            ("member_gone", member_events.LEFT),
+        ]
+        # only the first event of the window schedules a flush
+        scheduled = [member_events.buffer_member_event(channel_id, team_id, m, e) for m, e in events]
+        self.assertEqual([True] + [False] * 7, scheduled)
+
+        client_instance = MagicMock()
+        client_instance.users_info.return_value.data = {"user": {"id": "member_unknown"}}
+        webclient.return_value = client_instance
+        async_client_instance = MagicMock()
+        async_client_instance.chat_postMessage = AsyncMock()
+        async_webclient.return_value = async_client_instance
+
+        member_tasks.apply_member_events(channel_id, team_id)
+
+        with database.SessionLocal() as db:
+            self.assertEqual(
+                ["member_back", "member_new", "member_unknown"],
+                sorted(crud.get_cached_channel_member_ids(db, channel_id, team_id)),
+            )
+        client_instance.users_info.assert_called_once_with(user="member_unknown")
+        self.assertEqual(
+            ["member_new", "member_unknown"],
+            sorted(c.kwargs["channel"] for c in async_client_instance.chat_postMessage.await_args_list),
+        )
+        self.assertEqual({}, member_events.take_member_events(channel_id, team_id))
+        self.assertTrue(member_events.buffer_member_event(channel_id, team_id, "member_new", member_events.LEFT))
+        member_events.take_member_events(channel_id, team_id)
+
+    @patch("src.tasks.member_management.apply_member_events.delay")
+    def test_stale_member_events_are_flushed(self, apply_member_events):
+        channel_id, team_id = "channel_0", "stale_member_events_tid"
+        member_events.buffer_member_event(channel_id, team_id, "member_new", member_events.JOINED)
+        member_events.buffer_member_event("channel_1", team_id, "member_new", member_events.JOINED)
+        # the flush of the first channel was lost and its marker expired
+        database.redis_client.delete(f"member_events_flush:{team_id}:{channel_id}")
+
+        member_tasks.flush_stale_member_events()
+        member_tasks.flush_stale_member_events()
+
+        flushed = [c.args for c in apply_member_events.call_args_list if c.args[1] == team_id]
+        self.assertEqual([(channel_id, team_id)], flushed)
+        member_events.take_member_events(channel_id, team_id)
+        member_events.take_member_events("channel_1", team_id)
+
+    @patch("src.tasks.commands.WebhookClient", autospec=True)
+    def test_smores_command_runs_in_a_task(self, webhook):
+        context = MagicMock(team_id="command_tid", enterprise_id="test_eid", user_id="member_0")
+        command = {"text": "exclude member_1", "channel_id": "channel_0", "response_url": "https://hooks.example/1"}
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, "channel_0", "command_tid", "test_eid")
+            crud.add_members_if_not_exist(db, ["member_0", "member_1"], channel)
+
+        ack = AsyncMock()
+        with patch.object(command_tasks.run_smores_command, "apply_async") as apply_async:
+            asyncio.run(slack_app.handle_smores_command(ack, command, context))
+            ack.assert_awaited_once_with()
+            apply_async.assert_called_once_with(
+                ("exclude", "member_1", "channel_0", "command_tid", "test_eid", "member_0", "https://hooks.example/1")
+            )
+            # nothing has been removed until the task runs
+            with database.SessionLocal() as db:
+                self.assertEqual(2, len(crud.get_cached_channel_member_ids(db, "channel_0", "command_tid")))
+
+            command_tasks.run_smores_command(*apply_async.call_args.args[0])
+
+        with database.SessionLocal() as db:
+            self.assertEqual(["member_0"], crud.get_cached_channel_member_ids(db, "channel_0", "command_tid"))
+        webhook.assert_called_with("https://hooks.example/1")
+        webhook.return_value.send.assert_called_once_with(
+            text="User <@member_1> as been removed from pairings.", response_type="ephemeral"
+        )
+
+        ack.reset_mock()
+        with patch.object(command_tasks.run_smores_command, "apply_async") as apply_async:
+            asyncio.run(slack_app.handle_smores_command(ack, dict(command, text="group_size 9"), context))
+            apply_async.assert_not_called()
+        ack.assert_awaited_once_with("Group size should be a number from 2 to 4.")
+
+    @patch("src.tasks.commands.WebhookClient", autospec=True)
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_channel_enabled_again_is_paired_in_its_next_slot(self, webclient, webhook):
+        with database.SessionLocal() as db:
+            channel = crud.add_channel(db, "channel_0", "enable_again_tid", "test_eid")
+            # a slot that isn't the current one
+            crud.set_channel_schedule(db, channel, (datetime.utcnow().weekday() + 3) % 7, 10, "UTC")
+            crud.set_channel_last_sent_on(db, channel, (datetime.utcnow() - timedelta(weeks=10)).date())
+
+        for action in ["disable", "enable"]:
+            command_tasks.run_smores_command(
+                action, action, "channel_0", "enable_again_tid", "test_eid", "member_0", "https://hooks.example/1"
+            )
+
+        with database.SessionLocal() as db:
+            channel = crud.get_channel(db, "channel_0", "enable_again_tid")
+            self.assertTrue(channel.is_active)
+            self.assertEqual(
+                helpers.next_conversation_time(
+                    datetime.utcnow(), channel.conversation_day, channel.conversation_hour, channel.timezone
+                ),
+                channel.next_pairing_on,
+            )
+            self.assertEqual([], [c for c in crud.claim_channels_due_for_pairing(db, 10, timedelta(hours=1)) if c.id == channel.id])
+
+    @patch("src.tasks.commands.WebhookClient", autospec=True)
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_smores_schedule_command(self, webclient, webhook):
+        context = MagicMock(team_id="schedule_tid", enterprise_id="test_eid", user_id="member_0")
+        command = {"text": "schedule Friday 15", "channel_id": "channel_0", "response_url": "https://hooks.example/1"}
+        webclient.return_value.users_info.return_value.data = {"user": {"id": "member_0", "tz": "Europe/Paris"}}
+        with database.SessionLocal() as db:
+            crud.add_channel(db, "channel_0", "schedule_tid", "test_eid")
+
+        ack = AsyncMock()
+        with patch.object(command_tasks.run_smores_command, "apply_async") as apply_async:
+            for text in ["schedule", "schedule someday 15", "schedule friday 24"]:
+                asyncio.run(slack_app.handle_smores_command(ack, dict(command, text=text), context))
+            apply_async.assert_not_called()
+            self.assertEqual(3, ack.await_count)
+
+            asyncio.run(slack_app.handle_smores_command(ack, command, context))
+            apply_async.assert_called_once_with(
+                ("schedule", "4 15", "channel_0", "schedule_tid", "test_eid", "member_0", "https://hooks.example/1")
+            )
+            command_tasks.run_smores_command(*apply_async.call_args.args[0])
+
+        with database.SessionLocal() as db:
+            channel = crud.get_channel(db, "channel_0", "schedule_tid")
+            self.assertEqual((4, 15, "Europe/Paris"), (channel.conversation_day, channel.conversation_hour, channel.timezone))
+            self.assertEqual(
+                helpers.next_conversation_time(channel.added_on, 4, 15, "Europe/Paris"), channel.next_pairing_on
+            )
+        webhook.return_value.send.assert_called_once_with(
+            text="Conversations will now be sent on Fridays at 15:00 (Europe/Paris).", response_type="in_channel"
+        )
+
+    @patch("src.tasks.commands.WebhookClient", autospec=True)
+    @patch("src.slack_app.get_slack_client", autospec=True)
+    def test_smores_command_reports_slack_errors(self, webclient, webhook):
+        response = MagicMock()
+        response.data = {"ok": False, "error": "ratelimited"}
+        webclient.return_value.conversations_info.side_effect = SlackApiError("error", response)
+
+        command_tasks.run_smores_command(
+            "enable", "enable", "channel_0", "command_error_tid", "test_eid", "member_0", "https://hooks.example/1"
+        )
+
+        webhook.return_value.send.assert_called_once_with(
+            text="Slack couldn't complete `enable` right now, please try again.", response_type="ephemeral"
+        )
+
+    @patch("src.tasks.commands.WebhookClient", autospec=True)
+    @patch("src.db.crud.delete_member", autospec=True)
+    def test_smores_command_reports_database_errors(self, delete_member, webhook):
+        delete_member.side_effect = OperationalError("DELETE", {}, Exception("connection lost"))
+
+        command_tasks.run_smores_command(
+            "exclude", "member_1", "channel_0", "command_tid", "test_eid", "member_0", "https://hooks.example/1"
+        )
+
+        webhook.return_value.send.assert_called_once_with(
+            text="Something went wrong running `exclude`, please try again.", response_type="ephemeral"
+        )
+
+    def test_duplicate_event_deliveries_are_dropped(self):
+        event_id = f"Ev{datetime.utcnow().timestamp()}"
+        body = {"type": "event_callback", "event_id": event_id, "event": {"type": "member_joined_channel"}}
+
+        async def deliver(bodies):
+            responses = []
+            for body in bodies:
+                next_ = AsyncMock()
+                response = await slack_app.drop_duplicate_events(body, next_, MagicMock())
+                responses.append(response.status if next_.await_count == 0 else "handled")
+            return responses
+
+        # commands and interactions have no event id and are never dropped
+        self.assertEqual(
+            ["handled", 200, "handled", "handled"],
+            asyncio.run(deliver([body, dict(body), {"command": "/smores"}, {"command": "/smores"}])),
+        )
 
     def _insert_fake_channels_and_members(self, team_id, enterprise_id):
 
@@ -1,10 +1,93 @@
 import settings
+import inspect
+import logging
+import time
+import zlib
 
+from datetime import datetime
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import before_task_publish, task_prerun, worker_process_init
+from kombu import Queue
+
+
+logger = logging.getLogger(__name__)
 
 celery = Celery("smores", broker=settings.REDIS_URL)
-celery.autodiscover_tasks(["src.tasks.pairing", "src.tasks.member_management"])
+celery.autodiscover_tasks(
+    ["src.tasks.pairing", "src.tasks.member_management", "src.tasks.commands", "src.tasks.monitoring"]
+)
+
+# classes of work, each on its own queues so that a pool of workers can be sized per class
+INTERACTIVE = "interactive"
+BULK = "bulk"
+SCHEDULED = "scheduled"
+
+TASK_CLASSES = {
+    "src.tasks.commands.run_smores_command": INTERACTIVE,
+    "src.tasks.member_management.add_member_to_db": INTERACTIVE,
+    "src.tasks.member_management.apply_member_events": INTERACTIVE,
+    "src.tasks.pairing.force_generate_conversations": INTERACTIVE,
+    "src.tasks.member_management.cache_channel_members": BULK,
+    "src.tasks.member_management.exclude_bots_from_cached_users": BULK,
+    "src.tasks.member_management.reconcile_workspace_members": BULK,
+    "src.tasks.pairing.generate_channel_conversations": BULK,
+    "src.tasks.pairing.match_pairs_periodic": SCHEDULED,
+    "src.tasks.pairing.send_failed_intros": SCHEDULED,
+    "src.tasks.pairing.send_midpoint_reminder": SCHEDULED,
+    "src.tasks.pairing.report_pairing_load": SCHEDULED,
+    "src.tasks.pairing.prune_pair_history": SCHEDULED,
+    "src.tasks.member_management.remove_disabled_users": SCHEDULED,
+    "src.tasks.member_management.flush_stale_member_events": SCHEDULED,
+    "src.tasks.monitoring.report_queue_metrics": SCHEDULED,
+}
+
+
+# the single queue of every task before they were split by class. Tasks queued with a countdown or retried
+# before the split are restored to it, workers keep draining it until it stays empty in the queue metrics
+LEGACY_QUEUE = "celery"
+
+
+def queue_names(queue_class: str):
+    """The queues of a class of work, interactive and bulk work has one per slice of the workspaces."""
+    if queue_class == SCHEDULED:
+        return [SCHEDULED]
+    return [f"{queue_class}.{i}" for i in range(settings.CELERY_WORKSPACE_QUEUES)]
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Route a task to the queues of its class, and interactive and bulk tasks to the queue of their workspace.
+
+    Workers take turns between the queues they consume, so a workspace queueing thousands of tasks only
+    holds up the workspaces hashed to the same queue while the others keep being served.
+    """
+    queue_class = TASK_CLASSES.get(name)
+    if queue_class is None:
+        return None
+    if queue_class == SCHEDULED:
+        return {"queue": SCHEDULED}
+
+    # tasks sent by name don't come with their task
+    task = task or celery.tasks.get(name)
+    return {"queue": f"{queue_class}.{_workspace_slice(task, args, kwargs)}"}
+
+
+def _workspace_slice(task, args, kwargs) -> int:
+    # tasks without a team_id, e.g. the reconciliation shards of which a workspace has one, go by their first argument
+    arguments = inspect.signature(task.run).bind_partial(*args, **kwargs).arguments
+    key = arguments.get("team_id", next(iter(arguments.values()), ""))
+    return zlib.crc32(str(key).encode()) % settings.CELERY_WORKSPACE_QUEUES
+
+
+celery.conf.task_routes = (route_task,)
+celery.conf.task_default_queue = queue_names(INTERACTIVE)[0]
+# a worker consumes every queue of the classes it's configured for unless started with -Q
+celery.conf.task_queues = [
+    Queue(name) for queue_class in settings.CELERY_WORKER_QUEUE_CLASSES for name in queue_names(queue_class)
+] + [Queue(LEGACY_QUEUE)]
+# workers reserve one task at a time so the turns between queues aren't taken ahead by prefetched tasks
+celery.conf.worker_prefetch_multiplier = 1
 
 celery.conf.beat_schedule = {
     "match_pairs": {
@@ -19,8 +102,56 @@ celery.conf.beat_schedule = {
         "task": "src.tasks.pairing.send_midpoint_reminder",
         "schedule": 60 * 60,
     },
+    "report_pairing_load": {
+        "task": "src.tasks.pairing.report_pairing_load",
+        "schedule": crontab(hour=0, minute=0),
+    },
+    "prune_pair_history": {
+        "task": "src.tasks.pairing.prune_pair_history",
+        "schedule": crontab(hour=1, minute=0),
+    },
     "remove_disabled_users": {
         "task": "src.tasks.member_management.remove_disabled_users",
         "schedule": crontab(hour=0, minute=0, day_of_week="thursday"),
     },
+    "flush_stale_member_events": {
+        "task": "src.tasks.member_management.flush_stale_member_events",
+        "schedule": 5 * 60,
+    },
+    "report_queue_metrics": {
+        "task": "src.tasks.monitoring.report_queue_metrics",
+        "schedule": 60,
+    },
 }
+
+
+@worker_process_init.connect
+def reset_database_pool(**kwargs):
+    # connections opened before the worker forked can't be shared with the child processes
+    from src.db import database
+
+    database.engine.dispose(close=False)
+
+
+@before_task_publish.connect
+def stamp_enqueued_at(headers=None, **kwargs):
+    # the wait of a task in its queue is measured from here, retries are stamped again when they're queued
+    headers["enqueued_at"] = time.time()
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    from src.db import queue_metrics
+
+    request = task.request
+    queue = (request.delivery_info or {}).get("routing_key")
+    enqueued_at = getattr(request, "enqueued_at", None)
+    if queue is None or enqueued_at is None:
+        return
+
+    # tasks queued with a countdown only start waiting once they're due
+    due_at = datetime.fromisoformat(request.eta).timestamp() if request.eta else enqueued_at
+    try:
+        queue_metrics.record_wait(queue, time.time() - max(enqueued_at, due_at))
+    except Exception:
+        logger.warning("could not record the wait of a task", exc_info=True)